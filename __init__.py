@@ -1,2 +1,2 @@
-__author__ == "Craig Derington"
-__version__ == "0.0.1"
+__author__ = "Craig Derington"
+__version__ = "0.0.1"
@@ -0,0 +1,183 @@
+import logging
+import time
+
+from sqlalchemy import text
+
+import config
+from cache import redis_store
+from database import db_session
+from models import ClickBucket, Sequence
+
+logger = logging.getLogger(__name__)
+
+# redis keys
+MINUTE_KEY = "shorty:ts:{}"
+PENDING_KEY = "shorty:ts:pending"
+FLUSHING_KEY = "shorty:ts:flushing:{}:{}"
+FLUSH_ID_KEY = "shorty:ts:flush_id"
+FLUSH_LOCK_KEY = "shorty:ts:lock"
+
+# the sequences row holding the id of the last minute written, so one
+# that is retried after a crash is never counted twice
+APPLIED_SEQUENCE = "click_buckets"
+
+# resolution -> seconds per bucket
+RESOLUTIONS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400
+}
+
+UPSERT = text(
+    "INSERT INTO click_buckets (short_url, resolution, bucket, clicks) "
+    "VALUES (:short_url, :resolution, :bucket, :clicks) "
+    "ON CONFLICT (short_url, resolution, bucket) "
+    "DO UPDATE SET clicks = click_buckets.clicks + excluded.clicks"
+)
+
+
+def queue_click(pipe, short_url, now=None):
+    """
+    Count a click in the current minute's hash on a redis pipeline
+    """
+    minute = int(now or time.time()) // 60 * 60
+    key = MINUTE_KEY.format(minute)
+    pipe.hincrby(key, short_url, 1)
+    pipe.expire(key, 2 * 86400)
+    pipe.sadd(PENDING_KEY, minute)
+
+
+def choose_resolution(start, end):
+    """
+    Pick the coarsest resolution that still gives a useful series, so long
+    ranges are answered from the hour and day rollups
+    :return str
+    """
+    span = end - start
+    if span <= 6 * 3600 and start >= time.time() - config.ANALYTICS_MINUTE_RETENTION:
+        return "minute"
+    if span <= 7 * 86400 and start >= time.time() - config.ANALYTICS_HOUR_RETENTION:
+        return "hour"
+    return "day"
+
+
+class ClickAnalytics(object):
+    """
+    Per link click counts in minute buckets, rolled up into hour and day
+    buckets as they are written, with old fine grained buckets compacted
+    away
+    """
+    def __init__(self, redis_client, session):
+        self.redis = redis_client
+        self.session = session
+
+    def flush(self):
+        """
+        Write every completed minute held in redis to the bucket tables.  The
+        most recent minute is left alone in case a worker's clock is behind.
+        Each minute's hash is first renamed aside under a new flush id, then
+        written in one transaction with that id, so a minute left behind by
+        a crash is written once on the next flush.
+        :return number of minutes written
+        """
+        lock = self.redis.lock(FLUSH_LOCK_KEY, timeout=300, blocking_timeout=0)
+        if not lock.acquire():
+            return 0
+        try:
+            applied = self._applied_id()
+            # ids must keep rising even if redis lost the counter
+            if int(self.redis.get(FLUSH_ID_KEY) or 0) < applied:
+                self.redis.set(FLUSH_ID_KEY, applied)
+            cutoff = int(time.time()) // 60 * 60 - 60
+            for minute in sorted(int(m) for m in self.redis.smembers(PENDING_KEY)):
+                if minute >= cutoff:
+                    break
+                pipe = self.redis.pipeline()
+                pipe.srem(PENDING_KEY, minute)
+                pipe.rename(MINUTE_KEY.format(minute), FLUSHING_KEY.format(minute, self.redis.incr(FLUSH_ID_KEY)))
+                # a minute without clicks left has no hash to rename
+                pipe.execute(raise_on_error=False)
+            return self._write_flushing(applied)
+        finally:
+            lock.release()
+
+    def _applied_id(self):
+        sequence = self.session.query(Sequence).get(APPLIED_SEQUENCE)
+        self.session.commit()
+        return sequence.value if sequence is not None else 0
+
+    def _write_flushing(self, applied):
+        flushing = []
+        for key in self.redis.scan_iter(match=FLUSHING_KEY.format("*", "*"), count=1000):
+            minute, flush_id = key.decode().rsplit(":", 2)[1:]
+            flushing.append((int(flush_id), int(minute), key))
+        written = 0
+        for flush_id, minute, key in sorted(flushing):
+            if flush_id > applied:
+                rows = []
+                for short_url, clicks in self.redis.hgetall(key).items():
+                    short_url = short_url.decode()
+                    for resolution, width in RESOLUTIONS.items():
+                        rows.append({
+                            "short_url": short_url,
+                            "resolution": resolution[0],
+                            "bucket": minute // width * width,
+                            "clicks": int(clicks)
+                        })
+                try:
+                    if rows:
+                        self.session.execute(UPSERT, rows)
+                    self.session.merge(Sequence(name=APPLIED_SEQUENCE, value=flush_id))
+                    self.session.commit()
+                except Exception:
+                    self.session.rollback()
+                    raise
+                applied = flush_id
+                written += 1
+            self.redis.delete(key)
+        return written
+
+    def compact(self):
+        """
+        Drop minute and hour buckets that have aged out of their retention,
+        their clicks live on in the coarser rollups
+        :return number of rows removed
+        """
+        now = int(time.time())
+        removed = 0
+        for resolution, retention in (("m", config.ANALYTICS_MINUTE_RETENTION),
+                                      ("h", config.ANALYTICS_HOUR_RETENTION)):
+            removed += self.session.query(ClickBucket).filter(
+                ClickBucket.resolution == resolution,
+                ClickBucket.bucket < now - retention
+            ).delete(synchronize_session=False)
+        self.session.commit()
+        return removed
+
+    def series(self, short_urls, start, end, resolution=None):
+        """
+        Click counts per bucket for one or many links between two epoch
+        times.  Buckets without clicks are omitted.
+        :return tuple of (resolution, dict of short url -> [[bucket, clicks]])
+        """
+        resolution = resolution or choose_resolution(start, end)
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown resolution: {}".format(resolution))
+        width = RESOLUTIONS[resolution]
+        series = {short_url: [] for short_url in short_urls}
+        codes = list(series)
+        for i in range(0, len(codes), 500):
+            rows = self.session.query(
+                ClickBucket.short_url, ClickBucket.bucket, ClickBucket.clicks
+            ).filter(
+                ClickBucket.short_url.in_(codes[i:i + 500]),
+                ClickBucket.resolution == resolution[0],
+                ClickBucket.bucket >= start // width * width,
+                ClickBucket.bucket < end
+            ).order_by(ClickBucket.short_url, ClickBucket.bucket)
+            for short_url, bucket, clicks in rows:
+                series[short_url].append([bucket, clicks])
+        return resolution, series
+
+
+click_analytics = ClickAnalytics(redis_store, db_session)
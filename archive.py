@@ -0,0 +1,186 @@
+"""
+The cold tier.  Expired and archived links are moved out of the urls
+tables into archived_urls, in a database of their own, so the hot tables
+and their indexes only hold links that can still be followed.
+"""
+import datetime
+import logging
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, and_, exc, func, or_, select
+
+import config
+from database import make_engine, upgrade_schema
+from models import URL
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# every urls column, without the foreign key to users, which stays behind
+# on the main database, plus when and why the row was archived.  The
+# original id is kept but only unique within its shard.
+archived_urls = Table(
+    "archived_urls",
+    metadata,
+    Column("archive_id", Integer, primary_key=True),
+    *[Column(column.name, column.type) for column in URL.__table__.columns],
+    Column("archived_on_date", DateTime),
+    Column("archive_reason", String(16)),
+    Index("ix_archived_urls_short_url", "short_url", unique=True)
+)
+
+
+def live_clause(now):
+    """
+    The links that have not expired at now
+    :return ClauseElement
+    """
+    return and_(
+        or_(URL.expires_at.is_(None), URL.expires_at > now),
+        or_(URL.max_clicks.is_(None), func.coalesce(URL.clicks, 0) < URL.max_clicks)
+    )
+
+
+def due_clauses(now):
+    """
+    The links to archive at now, by reason.  Each clause can use an index
+    of its own, so a sweep does not scan the table.
+    :return list of (reason, ClauseElement)
+    """
+    return [
+        ("archived", URL.archived.is_(True)),
+        ("expired", URL.expires_at <= now),
+        ("max_clicks", and_(URL.max_clicks.isnot(None), func.coalesce(URL.clicks, 0) >= URL.max_clicks))
+    ]
+
+
+class ArchiveStore(object):
+    """
+    The archived_urls table, looked up by the resolver when a code is not
+    in the hot tier
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    def create(self):
+        """
+        Create the archive table, adding any columns and indexes that
+        a table from an older release is missing
+        """
+        metadata.create_all(bind=self.engine)
+        for added in upgrade_schema(metadata, self.engine):
+            logger.info("Added %s to the archive", added)
+
+    def contains(self, short_url):
+        """
+        :return True when the short code has been archived
+        """
+        with self.engine.connect() as conn:
+            return conn.execute(select([archived_urls.c.archive_id]).where(
+                archived_urls.c.short_url == short_url).limit(1)).first() is not None
+
+    def insert(self, rows):
+        """
+        Copy rows into the archive.  A row already there, left by an
+        interrupted move, is skipped.
+        """
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(archived_urls.insert(), rows)
+        except exc.IntegrityError:
+            for row in rows:
+                try:
+                    with self.engine.begin() as conn:
+                        conn.execute(archived_urls.insert(), [row])
+                except exc.IntegrityError:
+                    logger.info("%s is already archived", row["short_url"])
+
+    def short_urls(self, batch_size):
+        """
+        Stream every archived short code
+        :return generator of str
+        """
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(select([archived_urls.c.short_url]))
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for (short_url,) in rows:
+                    yield short_url
+
+
+class Archiver(object):
+    """
+    Move expired and archived links from every shard to the archive in
+    batches.  Each batch is copied, then deleted from its shard, so a run
+    cut short leaves rows in both tiers, which the next run tidies up.
+    SQLite shards are vacuumed once enough of their pages are free.
+    """
+    def __init__(self, shards, store, batch_size, vacuum_free_ratio, vacuum_min_pages):
+        self.shards = shards
+        self.store = store
+        self.batch_size = batch_size
+        self.vacuum_free_ratio = vacuum_free_ratio
+        self.vacuum_min_pages = vacuum_min_pages
+
+    def run(self, max_batches=None, on_moved=None, batch_size=None, now=None):
+        """
+        Archive up to max_batches batches per shard.  on_moved is called
+        with the short codes of each batch moved.
+        :return dict of shard index -> rows moved
+        """
+        batch_size = batch_size or self.batch_size
+        now = now or datetime.datetime.now()
+        table = URL.__table__
+        moved = {}
+        for shard in self.shards:
+            batches = 0
+            for reason, clause in due_clauses(now):
+                while max_batches is None or batches < max_batches:
+                    with shard.engine.connect() as conn:
+                        rows = conn.execute(select([table]).where(clause).order_by(
+                            table.c.id).limit(batch_size)).fetchall()
+                    if not rows:
+                        break
+                    batches += 1
+                    self.store.insert([dict(row, archived_on_date=now, archive_reason=reason) for row in rows])
+                    with shard.engine.begin() as conn:
+                        conn.execute(table.delete().where(table.c.id.in_([row["id"] for row in rows])))
+                    moved[shard.index] = moved.get(shard.index, 0) + len(rows)
+                    if on_moved is not None:
+                        on_moved([row["short_url"] for row in rows if row["short_url"] is not None])
+            if moved.get(shard.index):
+                self.compact(shard)
+        return moved
+
+    def compact(self, shard):
+        """
+        VACUUM a SQLite shard whose free pages pass the threshold, then
+        truncate its write-ahead log.  Server databases reclaim space with
+        their own autovacuum.
+        :return True when the shard was vacuumed
+        """
+        if shard.engine.dialect.name != "sqlite":
+            return False
+        with shard.engine.connect() as conn:
+            free = conn.execute("PRAGMA freelist_count").scalar()
+            pages = conn.execute("PRAGMA page_count").scalar()
+            if free < self.vacuum_min_pages or free < pages * self.vacuum_free_ratio:
+                return False
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info("Vacuumed shard %s, %s of %s pages were free", shard.index, free, pages)
+        return True
+
+
+archive_engine = make_engine(config.ARCHIVE_DATABASE_URI)
+archive_store = ArchiveStore(archive_engine)
+archiver = Archiver(
+    shard_router,
+    archive_store,
+    batch_size=config.ARCHIVE_BATCH_SIZE,
+    vacuum_free_ratio=config.ARCHIVE_VACUUM_FREE_RATIO,
+    vacuum_min_pages=config.ARCHIVE_VACUUM_MIN_PAGES
+)
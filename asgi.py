@@ -0,0 +1,288 @@
+"""
+An asyncio entry point for the redirect and lookup endpoints, for edge
+nodes that need many concurrent keep-alive connections per process:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5581 --workers 2
+
+It shares the cache keys, lookup statement, click pipeline, rate limits
+and short code filter with the Flask app; management pages stay on Flask.  SQLite is read natively
+through aiosqlite, one connection per shard, other databases through
+the shared engines on a thread.
+"""
+import asyncio
+import json
+import logging
+
+import redis
+import redis.asyncio as aioredis
+from sqlalchemy.dialects import sqlite
+
+import config
+import metrics
+from archive import archive_store
+from bloom import short_url_filter
+from cache import (GONE, GONE_MARKER, INVALIDATE_CHANNEL, LRUCache, MISSING, MISSING_KEY, URL_KEY,
+                   decode_entry, encode_entry, is_expired, lookup_query, resolved_from_row)
+from clicks import queue_record
+from events import click_event
+from ratelimit import TOKEN_BUCKET, classify, client_identity, limiter
+from redirector import SHORT_PATH, redirect_policy
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_PATH = "/api/lookup/"
+
+
+class AsyncResolver(object):
+    """
+    The asyncio counterpart of cache.URLResolver, with the same layers:
+    a per-process LRU, the shared redis hash, the short code's shard, then
+    the archive, which is read on a thread
+    """
+    def __init__(self, redis_client, shards, maxsize, ttl, negative_ttl, archive=None, gone_ttl=None,
+                 shared_ttl=None):
+        self.redis = redis_client
+        self.shards = shards
+        self.archive = archive
+        self.negative_ttl = negative_ttl
+        self.gone_ttl = gone_ttl
+        self.shared_ttl = shared_ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.dbs = {}
+
+    async def open(self):
+        for shard in self.shards:
+            url = shard.read_engine.url
+            if url.get_backend_name() == "sqlite":
+                import aiosqlite
+                db = await aiosqlite.connect(url.database)
+                await db.execute("PRAGMA query_only=ON")
+                await db.execute("PRAGMA busy_timeout={}".format(int(config.SQLITE_BUSY_TIMEOUT)))
+                await db.execute("PRAGMA mmap_size={}".format(int(config.SQLITE_MMAP_SIZE)))
+                self.dbs[shard.index] = db
+
+    async def close(self):
+        for db in self.dbs.values():
+            await db.close()
+        await self.redis.close()
+
+    async def resolve(self, short_url):
+        entry = self.local.get(short_url)
+        if entry is None:
+            entry = await self._from_redis(short_url)
+            if entry is None:
+                entry = await self._from_db(short_url)
+                await self._to_redis(short_url, entry)
+            if entry is MISSING:
+                self.local.set(short_url, entry, ttl=self.negative_ttl)
+            elif entry is GONE:
+                self.local.set(short_url, entry, ttl=self.gone_ttl)
+            else:
+                self.local.set(short_url, entry)
+        if entry is MISSING:
+            return None
+        if entry is not GONE and is_expired(entry):
+            return GONE
+        return entry
+
+    async def listen(self):
+        """
+        Drop the codes other workers invalidate from the LRU, until cancelled
+        """
+        missed = False
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                if missed:
+                    # anything published while unsubscribed was lost
+                    self.local.clear()
+                    missed = False
+                async for message in pubsub.listen():
+                    for short_url in json.loads(message["data"]):
+                        self.local.delete(short_url)
+            except redis.exceptions.RedisError as err:
+                logger.warning("Resolver invalidations unavailable: %s", err)
+                await asyncio.sleep(1)
+            missed = True
+
+    async def record(self, url, event):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            queue_record(pipe, url.short_url, event)
+            await pipe.execute()
+        except redis.exceptions.RedisError as err:
+            logger.warning("Click buffer unavailable, click dropped: %s", err)
+
+    async def _from_redis(self, short_url):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(URL_KEY.format(short_url))
+            pipe.get(MISSING_KEY.format(short_url))
+            raw, missing = await pipe.execute()
+        except redis.exceptions.RedisError as err:
+            logger.warning("Redis URL cache unavailable: %s", err)
+            return None
+        if raw is not None:
+            return decode_entry(raw)
+        if missing is not None:
+            return GONE if missing == GONE_MARKER else MISSING
+        return None
+
+    async def _to_redis(self, short_url, entry):
+        try:
+            if entry is MISSING:
+                await self.redis.set(MISSING_KEY.format(short_url), 1, ex=self.negative_ttl)
+            elif entry is GONE:
+                await self.redis.set(MISSING_KEY.format(short_url), GONE_MARKER, ex=self.gone_ttl)
+            else:
+                await self.redis.set(URL_KEY.format(short_url), encode_entry(entry), ex=self.shared_ttl)
+        except redis.exceptions.RedisError as err:
+            logger.warning("Redis URL cache unavailable: %s", err)
+
+    async def _from_db(self, short_url):
+        db = self.dbs.get(self.shards.index_for(short_url))
+        if db is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self._from_engine, short_url)
+        dialect = sqlite.dialect()
+        compiled = lookup_query(short_url).compile(dialect=dialect)
+        params = []
+        for name in compiled.positiontup:
+            # datetimes are stored in SQLAlchemy's own format
+            process = compiled.binds[name].type.bind_processor(dialect)
+            params.append(process(compiled.params[name]) if process else compiled.params[name])
+        async with db.execute(str(compiled), params) as cursor:
+            columns = [column[0] for column in cursor.description]
+            row = await cursor.fetchone()
+        if row is None:
+            if self.archive is not None and await asyncio.get_running_loop().run_in_executor(
+                    None, self.archive.contains, short_url):
+                return GONE
+            return MISSING
+        return resolved_from_row(zip(columns, row))
+
+    def _from_engine(self, short_url):
+        with self.shards.shard_for(short_url).read_engine.connect() as conn:
+            row = conn.execute(lookup_query(short_url)).first()
+        if row is None:
+            if self.archive is not None and self.archive.contains(short_url):
+                return GONE
+            return MISSING
+        return resolved_from_row(row)
+
+
+def _header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _environ(scope):
+    # the parts of a WSGI environ client_identity reads
+    client = scope.get("client")
+    return {
+        "REMOTE_ADDR": client[0] if client else "",
+        "HTTP_X_API_KEY": _header(scope, b"x-api-key"),
+        "HTTP_X_FORWARDED_FOR": _header(scope, b"x-forwarded-for") or ""
+    }
+
+
+async def _send(send, status, headers, body=b""):
+    headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+    headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+class RedirectApp(object):
+    """
+    A bare ASGI application serving GET /<code> redirects and
+    GET /api/lookup/<code> as JSON, both rate limited as redirects
+    """
+    def __init__(self):
+        self.resolver = None
+        self.listener = None
+        self.bucket = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.resolver = AsyncResolver(
+                    aioredis.from_url(config.REDIS_URL),
+                    shard_router,
+                    maxsize=config.RESOLVER_CACHE_SIZE,
+                    ttl=config.RESOLVER_CACHE_TTL,
+                    negative_ttl=config.RESOLVER_NEGATIVE_TTL,
+                    archive=archive_store,
+                    gone_ttl=config.RESOLVER_GONE_TTL,
+                    shared_ttl=config.RESOLVER_SHARED_TTL
+                )
+                await self.resolver.open()
+                self.bucket = self.resolver.redis.register_script(TOKEN_BUCKET)
+                self.listener = asyncio.ensure_future(self.resolver.listen())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.listener.cancel()
+                await self.resolver.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, send):
+        method = scope["method"]
+        path = scope["path"]
+        if method not in ("GET", "HEAD"):
+            return await _send(send, 405, [("allow", "GET, HEAD")])
+        lookup = path.startswith(LOOKUP_PATH)
+        if lookup:
+            path = path[len(LOOKUP_PATH) - 1:]
+        rule = classify(method, path)
+        if rule is not None and rule in limiter.rules:
+            identity = client_identity(_environ(scope), config.RATE_LIMIT_PROXY_HOPS, config.API_KEYS)
+            allowed, wait = await limiter.allow_async(rule, identity, self.bucket)
+            metrics.RATE_LIMITED.labels(rule, "allowed" if allowed else "denied").inc()
+            if not allowed:
+                return await _send(send, 429, [
+                    ("content-type", "text/plain"),
+                    ("retry-after", str(max(1, int(wait + 0.999))))
+                ], b"Too Many Requests")
+        match = SHORT_PATH.match(path)
+        url = await self._resolve(match.group(1)) if match else None
+        if lookup:
+            if url is None:
+                return await _send(send, 404, [("content-type", "application/json")], b'{"error":"Not Found"}')
+            if url is GONE:
+                return await _send(send, 410, [("content-type", "application/json")], b'{"error":"Gone"}')
+            body = json.dumps({"short_url": url.short_url, "full_url": url.full_url}).encode()
+            return await _send(send, 200, [("content-type", "application/json")], body)
+        if url is None:
+            return await _send(send, 404, [("content-type", "text/plain")], b"Not Found")
+        if url is GONE:
+            return await _send(send, 410, [("content-type", "text/plain")], b"Gone")
+        if method == "GET":
+            client = scope.get("client")
+            await self.resolver.record(url, click_event(
+                url.short_url,
+                client[0] if client else None,
+                _header(scope, b"user-agent"),
+                _header(scope, b"referer")
+            ))
+        status, headers = redirect_policy(url)
+        await _send(send, status, headers)
+
+    async def _resolve(self, short_url):
+        # codes the filter has never seen do not reach the resolver
+        if not await short_url_filter.might_contain_async(short_url, self.resolver.redis):
+            return None
+        return await self.resolver.resolve(short_url)
+
+
+application = RedirectApp()
@@ -0,0 +1,2 @@
+# bench, reproducible benchmarks for the create and redirect paths.
+# Run "python -m bench --help" from the project root.
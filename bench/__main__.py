@@ -0,0 +1,106 @@
+"""
+Benchmarks for shorty's create and redirect paths.
+
+    python -m bench run --sizes 1000,10000,100000 --output before.json
+    python -m bench load --url http://127.0.0.1:5580 --processes 8
+    python -m bench boot --profiles redirect-only,admin,worker
+    python -m bench compare before.json after.json
+
+"run" and "boot" work in process against a scratch SQLite file and redis database
+15, which it flushes.  "load" drives a server started separately with
+rate limits off and the --api-key it is given, e.g.
+SHORTY_DISABLE_RATE_LIMITS=1 SHORTY_API_KEYS=bench:1 gunicorn -w 2
+wsgi:application.  Links point at a local stub server, so no external
+site is contacted.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from bench import report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="in process benchmarks with the Flask test client")
+    run.add_argument("--sizes", default="1000,10000", help="comma separated table sizes to seed")
+    run.add_argument("--requests", type=int, default=2000, help="redirects timed per scenario")
+    run.add_argument("--repeats", type=int, default=50, help="index renders timed per table size")
+    run.add_argument("--database", help="SQLAlchemy URI, defaults to a scratch SQLite file")
+    run.add_argument("--redis", default="redis://localhost:6379/15", help="redis database to use and flush")
+    run.add_argument("--output", help="also write the JSON results to this file")
+
+    load = commands.add_parser("load", help="multi process HTTP load against a running server")
+    load.add_argument("--url", default="http://127.0.0.1:5580")
+    load.add_argument("--links", type=int, default=1000, help="links to create before the run")
+    load.add_argument("--processes", type=int, default=4)
+    load.add_argument("--duration", type=float, default=10.0, help="seconds")
+    load.add_argument("--api-key", default="bench", help="one of the server's SHORTY_API_KEYS")
+    load.add_argument("--output")
+
+    boot = commands.add_parser("boot", help="import and first request time of each app profile")
+    boot.add_argument("--profiles", default="redirect-only,admin,worker", help="comma separated profiles")
+    boot.add_argument("--repeats", type=int, default=5, help="fresh processes booted per profile")
+    boot.add_argument("--database", help="SQLAlchemy URI, defaults to a scratch SQLite file")
+    boot.add_argument("--redis", default="redis://localhost:6379/15", help="redis database to use and flush")
+    boot.add_argument("--output")
+
+    compare = commands.add_parser("compare", help="report regressions between two result files")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.10, help="allowed change, as a fraction")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = report.compare(baseline, current, args.threshold)
+        for line in regressions:
+            print(line)
+        return 1 if regressions else 0
+
+    if args.command in ("run", "boot"):
+        # the app reads its database and redis locations at import time
+        scratch = tempfile.mkdtemp(prefix="shorty-bench-")
+        os.environ["SHORTY_DATABASE_URI"] = args.database or "sqlite:///" + os.path.join(scratch, "bench.db")
+        os.environ["SHORTY_ARCHIVE_DATABASE_URI"] = "sqlite:///" + os.path.join(scratch, "bench-archive.db")
+        os.environ["SHORTY_REDIS_URL"] = args.redis
+        os.environ["SHORTY_DISABLE_RATE_LIMITS"] = "1"
+        os.environ["SHORTY_API_KEYS"] = "bench:1"
+        import redis
+        redis.from_url(args.redis).flushdb()
+
+    if args.command == "boot":
+        from bench import boot as boot_driver
+        profiles = [profile for profile in args.profiles.split(",") if profile]
+        results = boot_driver.run(profiles, args.repeats)
+        parameters = {"profiles": profiles, "repeats": args.repeats}
+        report.write({"meta": report.metadata(), "parameters": parameters, "results": results}, args.output)
+        return 0
+
+    from bench.stub import start_stub
+    stub, target = start_stub()
+    if args.command == "run":
+        from bench import inprocess
+        sizes = [int(size) for size in args.sizes.split(",") if size]
+        results = inprocess.run(sizes, args.requests, args.repeats, target)
+        parameters = {"sizes": sizes, "requests": args.requests, "repeats": args.repeats}
+    else:
+        from bench import load as load_driver
+        results = load_driver.run(args.url, target, args.links, args.processes, args.duration, args.api_key)
+        parameters = {"url": args.url, "links": args.links, "processes": args.processes, "duration": args.duration}
+    stub.shutdown()
+    report.write({"meta": report.metadata(), "parameters": parameters, "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
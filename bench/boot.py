@@ -0,0 +1,81 @@
+"""
+Boot time per app profile.  Each sample is a fresh interpreter which
+imports the app, builds it with create_app and serves one request:
+
+    python -m bench boot --profiles redirect-only,admin,worker
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench.report import percentiles
+
+# optional subsystems, reported when a profile ends up importing them
+SUBSYSTEMS = ("celery", "flask_session", "flask_mailman", "flask_login", "requests", "lxml")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(profile):
+    """
+    Boot one profile in this process, the worker profile by importing the
+    celery tasks, and time its first request
+    :return dict
+    """
+    started = time.perf_counter()
+    if profile == "worker":
+        import tasks  # noqa: F401, builds the worker app
+        booted = time.perf_counter()
+        first_request = None
+    else:
+        from app import create_app
+        app = create_app(profile)
+        booted = time.perf_counter()
+        client = app.test_client()
+        t = time.perf_counter()
+        client.get("/" if profile == "admin" else "/zzzzzzz")
+        first_request = time.perf_counter() - t
+    return {
+        "boot": booted - started,
+        "first_request": first_request,
+        "modules": len(sys.modules),
+        "subsystems": [name for name in SUBSYSTEMS if name in sys.modules]
+    }
+
+
+def _child(args):
+    return json.loads(subprocess.check_output(
+        [sys.executable, "-m", "bench.boot"] + args, cwd=ROOT, env=os.environ.copy()
+    ).decode().strip().splitlines()[-1])
+
+
+def run(profiles, repeats):
+    """
+    Create the schema, then boot each profile repeats times
+    :return dict
+    """
+    _child(["--init-db"])
+    results = {}
+    for profile in profiles:
+        samples = [_child([profile]) for _ in range(repeats)]
+        results[profile] = {
+            "boot": percentiles([sample["boot"] for sample in samples]),
+            "modules": samples[-1]["modules"],
+            "subsystems": samples[-1]["subsystems"]
+        }
+        if samples[-1]["first_request"] is not None:
+            results[profile]["first_request"] = percentiles([sample["first_request"] for sample in samples])
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--init-db":
+        from archive import archive_store
+        from shards import init_shards, shard_router
+        init_shards(shard_router)
+        archive_store.create()
+        print(json.dumps({}))
+    else:
+        print(json.dumps(measure(sys.argv[1])))
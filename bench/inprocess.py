@@ -0,0 +1,104 @@
+import json
+import random
+import string
+import time
+
+from bench.report import percentiles
+
+# headers a browser sends with the shortening form, index() records them
+FORM_HEADERS = {
+    "Accept": "text/html",
+    "Accept-Encoding": "gzip, deflate"
+}
+
+# the bulk API key __main__ configures for in process runs
+API_KEY = "bench"
+
+
+def timed(fn, count):
+    """
+    Call fn count times
+    :return dict of latency percentiles and throughput
+    """
+    samples = []
+    started = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    summary = percentiles(samples)
+    summary["requests_per_sec"] = round(count / elapsed, 1) if elapsed else None
+    return summary
+
+
+def seed(client, target, start, count):
+    """
+    Create count links pointing at the stub server through the bulk API
+    :return tuple of (short codes, seconds taken)
+    """
+    body = "\n".join("{}/page/{}".format(target, i) for i in range(start, start + count))
+    t = time.perf_counter()
+    response = client.post("/api/urls/bulk", data=body, content_type="application/x-ndjson",
+                           headers={"X-Api-Key": API_KEY})
+    elapsed = time.perf_counter() - t
+    codes = [result["short_url"] for result in map(json.loads, response.data.splitlines())
+             if "short_url" in result]
+    return codes, elapsed
+
+
+def run(sizes, requests, repeats, target):
+    """
+    Seed the database up to each size in turn, timing the index page at
+    each size, then time link creation and redirects in process
+    :return dict
+    """
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    import wsgi
+    from archive import archive_store
+    from leaderboard import leaderboard
+    from shards import init_shards, shard_router
+
+    init_shards(shard_router)
+    archive_store.create()
+    client = wsgi.app.test_client()
+    edge = Client(wsgi.application, BaseResponse)
+    results = {"create": {}, "index": {}, "redirect": {}}
+
+    codes = []
+    seed_seconds = 0.0
+    for size in sorted(sizes):
+        if size > len(codes):
+            created, elapsed = seed(client, target, len(codes), size - len(codes))
+            codes.extend(created)
+            seed_seconds += elapsed
+            for shard in shard_router:
+                shard.session.execute("UPDATE urls SET clicks = abs(random()) % 1000")
+                shard.session.commit()
+            shard_router.remove()
+            leaderboard.rebuild()
+        results["index"][str(size)] = timed(lambda: client.get("/"), repeats)
+
+    results["create"]["bulk"] = {
+        "links": len(codes),
+        "seconds": round(seed_seconds, 3),
+        "links_per_sec": round(len(codes) / seed_seconds, 1) if seed_seconds else None
+    }
+    results["create"]["form"] = timed(lambda: client.post(
+        "/",
+        data={"url": "{}/form/{}".format(target, random.random()), "fetch-url": "1"},
+        headers=FORM_HEADERS
+    ), max(1, requests // 10))
+
+    sample = [random.choice(codes) for _ in range(requests)]
+    junk = ["".join(random.choice(string.ascii_letters) for _ in range(7)) for _ in range(requests)]
+    for name, app_client, paths in (
+        ("middleware", edge, sample),
+        ("flask", client, sample),
+        ("middleware_unknown", edge, junk)
+    ):
+        paths = iter(paths)
+        results["redirect"][name] = timed(lambda: app_client.get("/" + next(paths)), requests)
+    return results
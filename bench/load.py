@@ -0,0 +1,81 @@
+import http.client
+import json
+import multiprocessing
+import random
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from bench.report import percentiles
+
+
+def create_links(base_url, target, count, api_key):
+    """
+    Create links on a running server through its bulk API
+    :return list of short codes
+    """
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    body = "\n".join("{}/load/{}".format(target, i) for i in range(count))
+    conn.request("POST", "/api/urls/bulk", body=body.encode(), headers={
+        "Content-Type": "application/x-ndjson",
+        "X-Api-Key": api_key
+    })
+    response = conn.getresponse()
+    codes = [result["short_url"] for result in map(json.loads, response.read().splitlines())
+             if "short_url" in result]
+    conn.close()
+    return codes
+
+
+def _worker(base_url, codes, duration, queue):
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+    samples = []
+    statuses = Counter()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        t = time.perf_counter()
+        try:
+            conn.request("GET", "/" + random.choice(codes))
+            response = conn.getresponse()
+            response.read()
+            statuses[response.status] += 1
+            if response.getheader("Connection", "").lower() == "close":
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            statuses["error"] += 1
+            conn.close()
+        samples.append(time.perf_counter() - t)
+    conn.close()
+    queue.put((samples, dict(statuses)))
+
+
+def run(base_url, target, links, processes, duration, api_key):
+    """
+    Drive redirects against a running server, e.g. gunicorn, from several
+    processes each holding a keep-alive connection
+    :return dict
+    """
+    codes = create_links(base_url, target, links, api_key)
+    if not codes:
+        raise RuntimeError("Could not create any links on {}".format(base_url))
+    queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_worker, args=(base_url, codes, duration, queue))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    samples = []
+    statuses = Counter()
+    for _ in workers:
+        worker_samples, worker_statuses = queue.get()
+        samples.extend(worker_samples)
+        statuses.update(worker_statuses)
+    for worker in workers:
+        worker.join()
+    summary = percentiles(samples)
+    summary["requests_per_sec"] = round(len(samples) / duration, 1)
+    summary["statuses"] = {str(k): v for k, v in statuses.items()}
+    return {"redirect": {"http": summary}, "processes": processes, "links": len(codes)}
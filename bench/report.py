@@ -0,0 +1,90 @@
+import json
+import os
+import platform
+import subprocess
+import time
+
+
+def percentiles(samples):
+    """
+    Summarize latency samples, given in seconds, in milliseconds
+    :return dict
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    total = sum(ordered)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(total / len(ordered) * 1000, 3),
+        "p50_ms": at(0.50),
+        "p90_ms": at(0.90),
+        "p99_ms": at(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3)
+    }
+
+
+def metadata():
+    """
+    Describe the run so results can be compared later
+    :return dict
+    """
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count()
+    }
+
+
+def write(results, path=None):
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if path:
+        with open(path, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current, threshold):
+    """
+    Compare two result files.  Latencies that grew, or rates that fell, by
+    more than threshold (a fraction) are reported as regressions.
+    :return list of regression descriptions
+    """
+    old = _flatten(baseline.get("results", {}))
+    new = _flatten(current.get("results", {}))
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name], new[name]
+        if not before:
+            continue
+        change = (after - before) / before
+        if name.endswith("_ms") and change > threshold:
+            regressions.append("{}: {} -> {} ms (+{:.0%})".format(name, before, after, change))
+        elif name.endswith("_per_sec") and -change > threshold:
+            regressions.append("{}: {} -> {} per sec ({:.0%})".format(name, before, after, change))
+    return regressions
@@ -0,0 +1,38 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAGE = b"<html><head><title>Benchmark target</title></head><body>ok</body></html>"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the external sites links point at, answering every
+    request immediately with a small page
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.send_header("ETag", '"bench"')
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub(host="127.0.0.1", port=0):
+    """
+    Serve the stub on a background thread
+    :return tuple of (server, base url)
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://{}:{}".format(host, server.server_address[1])
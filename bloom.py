@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+import redis
+from sqlalchemy import exc, func
+
+import config
+from archive import archive_store
+from cache import redis_store
+from models import URL
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+# redis keys, named for the filter's size so a resize starts afresh
+BLOOM_KEY = "shorty:bloom:{}:{}"
+BLOOM_LOCK_KEY = "shorty:bloom:lock"
+
+
+def bloom_size(capacity, error_rate):
+    """
+    The optimal number of bits and hash functions for a filter
+    :return tuple of (bits, hashes)
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(bits / capacity * math.log(2))))
+    return bits, hashes
+
+
+class ShortURLFilter(object):
+    """
+    A bloom filter of every short code ever created, used to turn away
+    junk codes before any cache or database lookup.  The filter lives in
+    redis as a bitmap; each worker keeps a copy, refreshed by a background
+    thread, and only asks redis about codes its copy has not seen.
+    """
+    def __init__(self, redis_client, shards, capacity, error_rate, refresh, archive=None):
+        self.redis = redis_client
+        self.shards = shards
+        self.archive = archive
+        self.bits, self.hashes = bloom_size(capacity, error_rate)
+        self.key = BLOOM_KEY.format(self.bits, self.hashes)
+        self.refresh = refresh
+        self._local = None
+        self._pid = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def positions(self, short_url):
+        digest = hashlib.blake2b(short_url.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def might_contain(self, short_url):
+        """
+        False only if the short code has certainly never been created.
+        Fails open until this worker has a copy of the filter and if redis
+        is unavailable.
+        :return bool
+        """
+        known, positions = self._check_local(short_url)
+        if known:
+            return True
+        try:
+            # the code may have been created since the copy was taken
+            pipe = self.redis.pipeline(transaction=False)
+            for p in positions:
+                pipe.getbit(self.key, p)
+            return all(pipe.execute())
+        except redis.exceptions.RedisError as err:
+            logger.warning("Short URL filter unavailable: %s", err)
+            return True
+
+    async def might_contain_async(self, short_url, redis_client):
+        """
+        As might_contain, checking redis through an asyncio client
+        :return bool
+        """
+        known, positions = self._check_local(short_url)
+        if known:
+            return True
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for p in positions:
+                pipe.getbit(self.key, p)
+            return all(await pipe.execute())
+        except redis.exceptions.RedisError as err:
+            logger.warning("Short URL filter unavailable: %s", err)
+            return True
+
+    def _check_local(self, short_url):
+        # True when this worker's copy has the code or there is no copy
+        # yet, along with the code's bit positions
+        if self._pid != os.getpid():
+            # first use, or a forked worker whose refresh thread stayed behind
+            self.start()
+        local = self._local
+        if local is None:
+            return True, None
+        positions = self.positions(short_url)
+        return all(local[p >> 3] & (0x80 >> (p & 7)) for p in positions), positions
+
+    def add_many(self, short_urls):
+        """
+        Record newly created short codes.  Codes that cannot be written
+        are retried with the next call.
+        """
+        short_urls = self._pending + list(short_urls)
+        self._pending = []
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for short_url in short_urls:
+                for p in self.positions(short_url):
+                    pipe.setbit(self.key, p, 1)
+                    if self._local is not None:
+                        self._local[p >> 3] |= 0x80 >> (p & 7)
+            pipe.execute()
+        except redis.exceptions.RedisError as err:
+            logger.error("Could not add %s codes to the short URL filter: %s", len(short_urls), err)
+            self._pending = short_urls
+
+    def rebuild(self, chunk_size=50000):
+        """
+        Build the filter from the urls table of every shard and the archive,
+        so archived codes still reach the resolver and get a 410, and swap
+        it into redis.  Codes created while the tables were being read are
+        added again afterwards.
+        :return number of codes loaded
+        """
+        high_water = [shard.read_session.query(func.max(URL.id)).scalar() or 0 for shard in self.shards]
+        bitmap = bytearray((self.bits + 7) // 8)
+        loaded = 0
+        for shard, shard_high_water in zip(self.shards, high_water):
+            query = shard.read_session.query(URL.short_url).filter(
+                URL.id <= shard_high_water
+            ).yield_per(chunk_size)
+            for (short_url,) in query:
+                for p in self.positions(short_url):
+                    bitmap[p >> 3] |= 0x80 >> (p & 7)
+                loaded += 1
+        if self.archive is not None:
+            for short_url in self.archive.short_urls(chunk_size):
+                for p in self.positions(short_url):
+                    bitmap[p >> 3] |= 0x80 >> (p & 7)
+                loaded += 1
+        building = self.key + ":building"
+        self.redis.set(building, bytes(bitmap))
+        self.redis.rename(building, self.key)
+        late = []
+        for shard, shard_high_water in zip(self.shards, high_water):
+            late.extend(short_url for (short_url,) in shard.read_session.query(URL.short_url).filter(
+                URL.id > shard_high_water))
+        self.add_many(late)
+        self.shards.remove_readers()
+        return loaded + len(late)
+
+    def start(self):
+        """
+        Load this worker's copy of the filter and keep it fresh from a
+        daemon thread, so no request waits on the bitmap or a rebuild
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._local = None
+            threading.Thread(target=self._refresh_forever, name="bloom-refresh", daemon=True).start()
+
+    def load(self):
+        """
+        Replace this worker's copy with the filter in redis, building the
+        filter first when it is missing and no other worker is building it
+        :return True when a copy was loaded
+        """
+        raw = self.redis.get(self.key)
+        if raw is None:
+            lock = self.redis.lock(BLOOM_LOCK_KEY, timeout=600, blocking_timeout=0)
+            if lock.acquire():
+                try:
+                    if not self.redis.exists(self.key):
+                        logger.info("Building the short URL filter.")
+                        self.rebuild()
+                finally:
+                    lock.release()
+            raw = self.redis.get(self.key)
+        if raw is None:
+            # fail open until the filter has been built
+            self._local = None
+            return False
+        self._local = bytearray(raw.ljust((self.bits + 7) // 8, b"\0"))
+        return True
+
+    def _refresh_forever(self):
+        while True:
+            try:
+                self.load()
+            except (redis.exceptions.RedisError, exc.SQLAlchemyError) as err:
+                logger.warning("Could not refresh the short URL filter: %s", err)
+            time.sleep(self.refresh)
+
+
+short_url_filter = ShortURLFilter(
+    redis_store,
+    shard_router,
+    capacity=config.BLOOM_CAPACITY,
+    error_rate=config.BLOOM_ERROR_RATE,
+    refresh=config.BLOOM_REFRESH_INTERVAL,
+    archive=archive_store
+)
@@ -0,0 +1,223 @@
+import datetime
+import hashlib
+import json
+import uuid
+from itertools import islice
+from urllib.parse import urlparse
+
+from sqlalchemy import exc
+
+import config
+from bloom import short_url_filter
+from cache import resolver, url_count
+from codes import code_generator
+from models import URL
+from urlnorm import find_duplicates, url_fingerprint
+
+
+def read_ndjson(stream):
+    """
+    Yield the items of a newline delimited request body, one JSON
+    value or bare URL per line
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        line = line.decode("utf-8", "replace") if isinstance(line, bytes) else line
+        if line[0] in "{\"":
+            try:
+                yield json.loads(line)
+            except ValueError as err:
+                yield {"error": "Invalid JSON: {}".format(str(err))}
+        else:
+            yield line
+
+
+def clean_url(item):
+    """
+    Validate one submitted item
+    :return the URL to shorten
+    :raise ValueError
+    """
+    if isinstance(item, dict):
+        if "error" in item:
+            raise ValueError(item["error"])
+        item = item.get("url")
+    if not isinstance(item, str) or not item:
+        raise ValueError("Expected a URL string")
+    if len(item) > 5000:
+        raise ValueError("URL is too long")
+    parsed = urlparse(item.strip())
+    if parsed.scheme not in ("http", "https") or not parsed.netloc:
+        raise ValueError("Invalid URL format")
+    try:
+        parsed.port
+    except ValueError:
+        raise ValueError("Invalid URL port")
+    return parsed.geturl()
+
+
+def clean_expiry(item, now):
+    """
+    Validate the expiry of one submitted item: expires_in seconds from
+    now and max_clicks, either falling back to LINK_DEFAULT_TTL and none
+    :return tuple of (expires_at, max_clicks)
+    :raise ValueError
+    """
+    options = item if isinstance(item, dict) else {}
+    expires_in = options.get("expires_in", config.LINK_DEFAULT_TTL)
+    max_clicks = options.get("max_clicks")
+    for name, value in (("expires_in", expires_in), ("max_clicks", max_clicks)):
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or not 0 < value < 2 ** 31):
+            raise ValueError("{} must be a positive whole number".format(name))
+    expires_at = None if expires_in is None else now + datetime.timedelta(seconds=expires_in)
+    return expires_at, max_clicks
+
+
+def new_url_row(full_url, short_url, fingerprint, user_id, now, expires_at=None, max_clicks=None):
+    """
+    Build the insert mapping for a new short URL
+    :return dict
+    """
+    url_hash = hashlib.sha256(uuid.uuid4().bytes + full_url.encode()).hexdigest()
+    return {
+        "user_id": user_id,
+        "name": None,
+        "full_url": full_url,
+        "short_url": short_url,
+        "full_hash": url_hash,
+        "normalized_hash": fingerprint,
+        "global_id": str(uuid.uuid4()),
+        "created_on_date": now,
+        "modified_date": now,
+        "clicks": 0,
+        "archived": False,
+        "is_url_active": True,
+        "expires_at": expires_at,
+        "max_clicks": max_clicks
+    }
+
+
+def bulk_shorten(shards, items, user_id, chunk_size=None, dedupe=False):
+    """
+    Shorten an iterable of submitted URLs, inserting each chunk with one
+    executemany per shard, each in its own transaction.  Results are
+    yielded per item, in input order, as soon as their chunk commits.
+    Items may set expires_in and max_clicks.  With dedupe, URLs the user
+    has already shortened get their existing code back while it still
+    redirects.
+    :return generator of result dicts
+    """
+    chunk_size = chunk_size or config.BULK_CHUNK_SIZE
+    numbered = enumerate(items)
+    while True:
+        chunk = list(islice(numbered, chunk_size))
+        if not chunk:
+            break
+        now = datetime.datetime.now()
+        results = []
+        for index, item in chunk:
+            try:
+                full_url = clean_url(item)
+                results.append({
+                    "index": index,
+                    "full_url": full_url,
+                    "fingerprint": url_fingerprint(full_url),
+                    "expiry": clean_expiry(item, now)
+                })
+            except ValueError as err:
+                results.append({"index": index, "error": str(err)})
+        # every valid item gets a new code, unless dedupe finds one for it
+        fresh = {}
+        created = []
+        for result in results:
+            if "full_url" not in result:
+                continue
+            if dedupe and result["fingerprint"] in fresh:
+                result["same_as"] = fresh[result["fingerprint"]]
+                continue
+            if dedupe:
+                fresh[result["fingerprint"]] = result
+            created.append(result)
+        if dedupe and fresh:
+            for fingerprint, row in find_duplicates(shards, user_id, fresh).items():
+                fresh[fingerprint]["existing"] = row.short_url
+            created = [result for result in created if "existing" not in result]
+        rows = []
+        for result, short_url in zip(created, code_generator.take(len(created))):
+            result["row"] = new_url_row(result["full_url"], short_url, result["fingerprint"], user_id, now,
+                                        *result["expiry"])
+            rows.append(result["row"])
+        for result in _insert(shards, rows, results):
+            yield result
+
+
+def _insert(shards, rows, results):
+    if rows:
+        # the filter must know a code before anyone can be handed it
+        short_url_filter.add_many([row["short_url"] for row in rows])
+        pending = [result for result in results if "row" in result]
+        for attempt in range(config.CODE_RETRIES + 1):
+            if attempt:
+                # a code can already be taken when the counter was lost with
+                # redis, so the items that conflicted get fresh ones
+                for result, short_url in zip(pending, code_generator.take(len(pending))):
+                    del result["error"]
+                    result["row"]["short_url"] = short_url
+                short_url_filter.add_many([result["row"]["short_url"] for result in pending])
+            failed = []
+            for shard, shard_results in shards.group(pending, key=lambda result: result["row"]["short_url"]).items():
+                failed.extend(_insert_shard(shard.session, shard_results))
+            pending = failed
+            if not pending:
+                break
+        resolver.invalidate_many([row["short_url"] for row in rows])
+        url_count.incr(sum(1 for result in results if "row" in result and "error" not in result))
+    for result in results:
+        row = result.pop("row", None)
+        full_url = result.pop("full_url", None)
+        same_as = result.pop("same_as", None)
+        existing = result.pop("existing", None)
+        result.pop("fingerprint", None)
+        result.pop("expiry", None)
+        if same_as is not None:
+            # a repeat within this chunk shares the first submission's outcome
+            if "error" in same_as:
+                result["error"] = same_as["error"]
+            else:
+                result["url"] = full_url
+                result["short_url"] = same_as["short_url"]
+                result["existing"] = True
+        elif existing is not None:
+            result["url"] = full_url
+            result["short_url"] = existing
+            result["existing"] = True
+        elif row is not None and "error" not in result:
+            result["url"] = full_url
+            result["short_url"] = row["short_url"]
+        yield result
+
+
+def _insert_shard(session, results):
+    """
+    Insert the rows of results into one shard
+    :return list of the results that conflicted
+    """
+    try:
+        session.execute(URL.__table__.insert(), [result["row"] for result in results])
+        session.commit()
+        return []
+    except exc.IntegrityError:
+        session.rollback()
+    # retry one by one so a single conflict only fails its own item
+    failed = []
+    for result in results:
+        try:
+            session.execute(URL.__table__.insert(), [result["row"]])
+            session.commit()
+        except exc.IntegrityError as err:
+            session.rollback()
+            result["error"] = "Could not create short URL: {}".format(str(err.orig))
+            failed.append(result)
+    return failed
@@ -0,0 +1,414 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import redis
+from sqlalchemy import and_, event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+import config
+import metrics
+from archive import archive_store
+from models import URL
+from purge import purger
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+# shared redis connection pool
+redis_store = redis.from_url(config.REDIS_URL)
+
+# redis keys
+URL_KEY = "shorty:url:{}"
+MISSING_KEY = "shorty:urls:missing:{}"
+URL_COUNT_KEY = "shorty:urls:count"
+
+# redis pub/sub channel of JSON lists of short codes every worker drops
+# from its LRU
+INVALIDATE_CHANNEL = "shorty:urls:invalidated"
+
+# only adjust the cached count if it is there to adjust
+INCR_IF_EXISTS = """
+if redis.call("exists", KEYS[1]) == 1 then
+    return redis.call("incrby", KEYS[1], ARGV[1])
+end
+"""
+
+# the cached form of a short url, enough to serve a redirect; a policy
+# field left as None falls back to the config default.  expires_at is in
+# seconds since the epoch and clicks is the count when it was looked up,
+# for the click cap.
+ResolvedURL = namedtuple(
+    "ResolvedURL",
+    ["id", "short_url", "full_url", "redirect_status", "cache_max_age", "redirect_vary",
+     "expires_at", "max_clicks", "clicks"],
+    defaults=(None, None, None, None, None, None)
+)
+
+# the URL columns a cached redirect depends on
+REDIRECT_ATTRS = ("short_url", "full_url", "archived", "is_url_active", "expires_at", "max_clicks",
+                  "redirect_status", "cache_max_age", "redirect_vary")
+
+# sentinels cached for short codes that do not exist, and returned for
+# those that have expired or been moved to the archive
+MISSING = object()
+GONE = object()
+
+# the value of a MISSING_KEY entry for an archived code
+GONE_MARKER = b"gone"
+
+
+def lookup_query(short_url):
+    """
+    The statement resolving a short code to a live URL, its columns match
+    the fields of ResolvedURL.  Expired links are returned, so they can be
+    told apart from unknown codes.
+    :return Select
+    """
+    return select([
+        URL.id, URL.short_url, URL.full_url, URL.redirect_status, URL.cache_max_age, URL.redirect_vary,
+        URL.expires_at, URL.max_clicks, URL.clicks
+    ]).where(and_(
+        URL.short_url == short_url,
+        URL.archived.isnot(True),
+        URL.is_url_active.isnot(False)
+    )).limit(1)
+
+
+def resolved_from_row(row):
+    """
+    Build the cached form of a lookup_query row
+    :return ResolvedURL
+    """
+    fields = dict(row)
+    expires_at = fields["expires_at"]
+    if isinstance(expires_at, str):
+        # read raw from SQLite, as the asgi resolver does
+        expires_at = datetime.datetime.fromisoformat(expires_at)
+    if expires_at is not None:
+        fields["expires_at"] = expires_at.timestamp()
+    return ResolvedURL(**fields)
+
+
+def is_expired(entry, now=None):
+    """
+    :return True when a resolved URL is past its expiry or click cap
+    """
+    if entry.expires_at is not None and entry.expires_at <= (now or time.time()):
+        return True
+    return entry.max_clicks is not None and (entry.clicks or 0) >= entry.max_clicks
+
+
+def encode_entry(entry):
+    """
+    Serialize a resolved URL for the shared redis cache
+    :return str
+    """
+    return json.dumps(entry._asdict(), separators=(",", ":"))
+
+
+def decode_entry(raw):
+    """
+    Load a resolved URL from the shared redis cache
+    :return ResolvedURL
+    """
+    return ResolvedURL(**json.loads(raw))
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe least recently used cache with per entry expiry
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class URLResolver(object):
+    """
+    Resolve short codes through a per-worker LRU, then the shared redis
+    cache, then the hot urls table and, when the code is not there, the
+    archive.  Misses are cached at both layers for a shorter period so
+    junk codes do not reach the database either; archived codes are
+    cached as GONE for longer.  Invalidations are published to every
+    worker, so none keeps serving a changed link from its LRU.
+    """
+    def __init__(self, redis_client, shards, maxsize, ttl, negative_ttl, archive=None, gone_ttl=None,
+                 shared_ttl=None):
+        self.redis = redis_client
+        self.shards = shards
+        self.archive = archive
+        self.negative_ttl = negative_ttl
+        self.gone_ttl = gone_ttl
+        self.shared_ttl = shared_ttl
+        self.local = LRUCache(maxsize, ttl)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def resolve(self, short_url):
+        """
+        Look up a short code
+        :return ResolvedURL, GONE or None
+        """
+        if self._pid != os.getpid():
+            self.start()
+        entry = self.local.get(short_url)
+        metrics.cache_result("local", entry is not None)
+        if entry is None:
+            entry = self._from_redis(short_url)
+            metrics.cache_result("redis", entry is not None)
+            if entry is None:
+                entry = self._from_db(short_url)
+                self._to_redis(short_url, entry)
+            if entry is MISSING:
+                self.local.set(short_url, entry, ttl=self.negative_ttl)
+            elif entry is GONE:
+                self.local.set(short_url, entry, ttl=self.gone_ttl)
+            else:
+                self.local.set(short_url, entry)
+        if entry is MISSING:
+            return None
+        if entry is not GONE and is_expired(entry):
+            # cached before it expired, and not archived yet
+            return GONE
+        return entry
+
+    def invalidate(self, short_url):
+        """
+        Drop any cached mapping, positive or negative, for a short code
+        """
+        self.invalidate_many([short_url])
+
+    def invalidate_many(self, short_urls):
+        """
+        Drop cached mappings for several short codes in one round trip
+        """
+        if not short_urls:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for short_url in short_urls:
+            self.local.delete(short_url)
+            pipe.delete(MISSING_KEY.format(short_url), URL_KEY.format(short_url))
+        pipe.publish(INVALIDATE_CHANNEL, json.dumps(list(short_urls)))
+        try:
+            pipe.execute()
+        except redis.exceptions.RedisError as err:
+            logger.warning("Could not invalidate %s cached URLs: %s", len(short_urls), err)
+
+    def start(self):
+        """
+        Subscribe this worker's LRU to the invalidations published by every
+        worker, from a daemon thread
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen_forever, name="resolver-invalidate", daemon=True).start()
+
+    def _listen_forever(self):
+        missed = False
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                if missed:
+                    # anything published while unsubscribed was lost
+                    self.local.clear()
+                    missed = False
+                for message in pubsub.listen():
+                    for short_url in json.loads(message["data"]):
+                        self.local.delete(short_url)
+            except redis.exceptions.RedisError as err:
+                logger.warning("Resolver invalidations unavailable: %s", err)
+                time.sleep(1)
+            missed = True
+
+    def warm(self, entries, shared=False, batch_size=1000):
+        """
+        Preload resolved URLs into this worker's LRU, and with shared into
+        redis without overwriting entries already there
+        :return number of entries loaded
+        """
+        loaded = 0
+        pipe = self.redis.pipeline(transaction=False)
+        for entry in entries:
+            self.local.set(entry.short_url, entry)
+            if shared:
+                pipe.set(URL_KEY.format(entry.short_url), encode_entry(entry), nx=True, ex=self.shared_ttl)
+            loaded += 1
+            if shared and loaded % batch_size == 0:
+                pipe.execute()
+        if shared:
+            pipe.execute()
+        return loaded
+
+    def _from_redis(self, short_url):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(URL_KEY.format(short_url))
+            pipe.get(MISSING_KEY.format(short_url))
+            raw, missing = pipe.execute()
+        except redis.exceptions.RedisError as err:
+            logger.warning("Redis URL cache unavailable: %s", err)
+            return None
+        if raw is not None:
+            return decode_entry(raw)
+        if missing is not None:
+            return GONE if missing == GONE_MARKER else MISSING
+        return None
+
+    def _to_redis(self, short_url, entry):
+        try:
+            if entry is MISSING:
+                self.redis.set(MISSING_KEY.format(short_url), 1, ex=self.negative_ttl)
+            elif entry is GONE:
+                self.redis.set(MISSING_KEY.format(short_url), GONE_MARKER, ex=self.gone_ttl)
+            else:
+                self.redis.set(URL_KEY.format(short_url), encode_entry(entry), ex=self.shared_ttl)
+        except redis.exceptions.RedisError as err:
+            logger.warning("Redis URL cache unavailable: %s", err)
+
+    def _from_db(self, short_url):
+        row = self.shards.read_session_for(short_url).execute(lookup_query(short_url)).first()
+        if row is None:
+            if self.archive is not None and self.archive.contains(short_url):
+                return GONE
+            return MISSING
+        return resolved_from_row(row)
+
+
+class URLCounter(object):
+    """
+    An approximate count of short urls kept in redis.  Creates and deletes
+    adjust it as they happen; it is recounted from the table when it
+    expires, which bounds any drift.  The recount sums every shard.
+    """
+    def __init__(self, redis_client, shards, ttl):
+        self.redis = redis_client
+        self.shards = shards
+        self.ttl = ttl
+        self._incr = redis_client.register_script(INCR_IF_EXISTS)
+
+    def get(self):
+        """
+        :return int
+        """
+        try:
+            total = self.redis.get(URL_COUNT_KEY)
+            if total is not None:
+                return int(total)
+        except redis.exceptions.RedisError as err:
+            logger.warning("Redis URL count unavailable: %s", err)
+        total = sum(shard.session.query(URL.id).count() for shard in self.shards)
+        try:
+            self.redis.set(URL_COUNT_KEY, total, ex=self.ttl)
+        except redis.exceptions.RedisError:
+            pass
+        return total
+
+    def incr(self, amount=1):
+        try:
+            self._incr(keys=[URL_COUNT_KEY], args=[amount])
+        except redis.exceptions.RedisError as err:
+            logger.warning("Could not update the URL count: %s", err)
+
+
+resolver = URLResolver(
+    redis_store,
+    shard_router,
+    maxsize=config.RESOLVER_CACHE_SIZE,
+    ttl=config.RESOLVER_CACHE_TTL,
+    negative_ttl=config.RESOLVER_NEGATIVE_TTL,
+    archive=archive_store,
+    gone_ttl=config.RESOLVER_GONE_TTL,
+    shared_ttl=config.RESOLVER_SHARED_TTL
+)
+
+url_count = URLCounter(redis_store, shard_router, ttl=config.URL_COUNT_TTL)
+
+
+def forget_urls(short_urls):
+    """
+    Drop links moved out of the urls tables, to the archive, from the
+    resolver caches, caching proxies and the URL count
+    """
+    if not short_urls:
+        return
+    resolver.invalidate_many(short_urls)
+    purger.purge_many(short_urls)
+    url_count.incr(-len(short_urls))
+
+
+# invalidate cached mappings once a change to a URL row is committed
+@event.listens_for(URL, "after_insert")
+@event.listens_for(URL, "after_update")
+@event.listens_for(URL, "after_delete")
+def _queue_invalidation(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("stale_short_urls", set()).add(target.short_url)
+
+
+# and purge redirects cached by proxies when what they serve has changed
+@event.listens_for(URL, "after_update")
+@event.listens_for(URL, "after_delete")
+def _queue_purge(mapper, connection, target):
+    session = object_session(target)
+    state = inspect(target)
+    if session is not None and (state.deleted or any(
+            state.attrs[name].history.has_changes() for name in REDIRECT_ATTRS)):
+        session.info.setdefault("purge_short_urls", set()).add(target.short_url)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    stale = session.info.pop("stale_short_urls", None)
+    if stale:
+        resolver.invalidate_many(list(stale))
+    purge = session.info.pop("purge_short_urls", None)
+    if purge:
+        purger.purge_many(list(purge))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session):
+    session.info.pop("stale_short_urls", None)
+    session.info.pop("purge_short_urls", None)
@@ -0,0 +1,52 @@
+"""
+The Celery app, kept apart from the Flask app factory so that web workers
+only import Celery when they queue a task:
+
+    celery -A celery_app worker -B
+"""
+from celery import Celery, signals
+
+import config
+import metrics
+
+beat_schedule = {
+    "flush-clicks": {
+        "task": "tasks.flush_clicks",
+        "schedule": config.CLICK_FLUSH_INTERVAL
+    },
+    "ingest-visitors": {
+        "task": "tasks.ingest_visitors",
+        "schedule": config.VISITOR_INGEST_INTERVAL
+    },
+    "process-visitors": {
+        "task": "tasks.process_visitors",
+        "schedule": config.VISITOR_PROCESS_INTERVAL
+    },
+    "rollup-clicks": {
+        "task": "tasks.rollup_clicks",
+        "schedule": config.ANALYTICS_FLUSH_INTERVAL
+    },
+    "check-links": {
+        "task": "tasks.check_links",
+        "schedule": config.LINK_CHECK_INTERVAL
+    },
+    "archive-links": {
+        "task": "tasks.archive_links",
+        "schedule": config.ARCHIVE_INTERVAL
+    }
+}
+if config.URL_INDEX_PATH:
+    beat_schedule["build-url-index"] = {
+        "task": "tasks.build_url_index",
+        "schedule": config.URL_INDEX_INTERVAL
+    }
+
+celery = Celery("shorty", broker=config.CELERY_BROKER_URL, include=["tasks"])
+celery.conf.update(
+    CELERY_RESULT_BACKEND=config.CELERY_RESULT_BACKEND,
+    CELERY_ACCEPT_CONTENT=config.CELERY_ACCEPT_CONTENT.split(","),
+    CELERYBEAT_SCHEDULE=beat_schedule
+)
+signals.task_prerun.connect(metrics.task_timer.prerun, weak=False)
+signals.task_postrun.connect(metrics.task_timer.postrun, weak=False)
+signals.worker_process_shutdown.connect(lambda pid=None, **kwargs: metrics.mark_process_dead(pid), weak=False)
@@ -0,0 +1,126 @@
+import logging
+
+import redis
+from sqlalchemy import case, func
+
+import config
+from cache import redis_store, resolver
+from analytics import queue_click as queue_timeseries
+from events import queue_event
+from leaderboard import queue_click
+from models import URL
+from purge import purger
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+# redis keys
+CLICKS_KEY = "shorty:clicks"
+FLUSHING_KEY = "shorty:clicks:flushing"
+FLUSH_LOCK_KEY = "shorty:clicks:lock"
+
+
+def queue_record(pipe, short_url, event=None):
+    """
+    Queue every redis write for one click on a pipeline, which may be
+    a synchronous or an asyncio one
+    """
+    pipe.hincrby(CLICKS_KEY, short_url, 1)
+    queue_click(pipe, short_url)
+    queue_timeseries(pipe, short_url)
+    if event is not None:
+        queue_event(pipe, event)
+
+
+class ClickCounter(object):
+    """
+    Buffer click increments in a redis hash and apply them to the
+    urls table in periodic batches.  A redirect costs one HINCRBY
+    instead of an UPDATE and COMMIT against the database.
+    """
+    def __init__(self, redis_client, shards, chunk_size):
+        self.redis = redis_client
+        self.shards = shards
+        self.chunk_size = chunk_size
+
+    def record(self, url, event=None):
+        """
+        Count a click on a resolved URL, updating the leaderboard and time
+        series and appending its click event to the event stream in the same
+        round trip
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            queue_record(pipe, url.short_url, event)
+            pipe.execute()
+        except redis.exceptions.RedisError as err:
+            # fall back to a direct write rather than drop the click
+            logger.warning("Click buffer unavailable, writing through: %s", err)
+            self.apply({url.short_url: 1})
+
+    def flush(self):
+        """
+        Move the buffered counts aside and apply them in one transaction
+        per shard.  Counts left over from a failed flush are retried first;
+        each shard's codes are dropped from them once it commits, so a crash
+        between a commit and its cleanup can at worst count a batch twice.
+        :return number of clicks written
+        """
+        lock = self.redis.lock(FLUSH_LOCK_KEY, timeout=300, blocking_timeout=0)
+        if not lock.acquire():
+            return 0
+        try:
+            if not self.redis.exists(FLUSHING_KEY):
+                try:
+                    self.redis.rename(CLICKS_KEY, FLUSHING_KEY)
+                except redis.exceptions.ResponseError:
+                    # nothing buffered since the last flush
+                    return 0
+            pending = self.redis.hgetall(FLUSHING_KEY)
+            counts = {k.decode(): int(v) for k, v in pending.items()}
+            self.apply(counts, applied=lambda codes: self.redis.hdel(FLUSHING_KEY, *codes))
+            self.redis.delete(FLUSHING_KEY)
+            return sum(counts.values())
+        finally:
+            lock.release()
+
+    def apply(self, counts, applied=None):
+        """
+        Add click counts keyed by short code using bulk UPDATE ... CASE
+        statements, committing once per shard and then passing that shard's
+        codes to applied.  Links that reach their click cap are dropped from
+        the caches so they stop redirecting.
+        """
+        for shard, codes in self.shards.group(counts).items():
+            capped = []
+            try:
+                for start in range(0, len(codes), self.chunk_size):
+                    chunk = {code: counts[code] for code in codes[start:start + self.chunk_size]}
+                    shard.session.execute(
+                        URL.__table__.update().where(
+                            URL.short_url.in_(list(chunk))
+                        ).values(
+                            clicks=func.coalesce(URL.clicks, 0) + case(chunk, value=URL.short_url, else_=0)
+                        )
+                    )
+                    capped.extend(short_url for (short_url,) in shard.session.query(URL.short_url).filter(
+                        URL.short_url.in_(list(chunk)),
+                        URL.max_clicks.isnot(None),
+                        func.coalesce(URL.clicks, 0) >= URL.max_clicks
+                    ))
+                shard.session.commit()
+            except Exception:
+                shard.session.rollback()
+                raise
+            if capped:
+                resolver.invalidate_many(capped)
+                purger.purge_many(capped)
+            if applied is not None:
+                applied(codes)
+
+
+click_counter = ClickCounter(
+    redis_store,
+    shard_router,
+    chunk_size=config.CLICK_FLUSH_CHUNK_SIZE
+)
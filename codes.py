@@ -0,0 +1,278 @@
+import os
+import threading
+
+import base62
+from sqlalchemy import select
+
+import config
+from archive import archive_store
+from cache import redis_store
+from database import engine
+from models import Sequence, URL
+from shards import shard_router
+
+# redis keys
+COUNTER_KEY = "shorty:codes:counter"
+SEED_LOCK_KEY = "shorty:codes:seed"
+
+# lease from the counter only while it exists, so a counter lost with
+# redis is reseeded rather than restarted from 0
+LEASE = """
+if redis.call("exists", KEYS[1]) == 0 then
+    return -1
+end
+return redis.call("incrby", KEYS[1], ARGV[1])
+"""
+
+DIGITS = {digit: value for value, digit in enumerate(base62.CHARSET_DEFAULT)}
+
+# move the counter forward, never back
+ADVANCE_TO = """
+local current = tonumber(redis.call("get", KEYS[1]) or "0")
+if current < tonumber(ARGV[1]) then
+    redis.call("set", KEYS[1], ARGV[1])
+    return tonumber(ARGV[1])
+end
+return current
+"""
+
+
+class RedisBlockAllocator(object):
+    """
+    Lease ranges of ids from a shared redis counter.  When the counter is
+    missing, e.g. after redis lost its data, it is seeded from seed, a
+    callable returning the first id known to be unused.
+    """
+    def __init__(self, redis_client, key=COUNTER_KEY, seed=None):
+        self.redis = redis_client
+        self.key = key
+        self.seed = seed
+        self._advance = redis_client.register_script(ADVANCE_TO)
+        self._lease = redis_client.register_script(LEASE)
+
+    def lease(self, size):
+        """
+        Reserve size consecutive ids
+        :return tuple of (first id, end id)
+        """
+        end = self._lease(keys=[self.key], args=[size])
+        if end < 0:
+            with self.redis.lock(SEED_LOCK_KEY, timeout=600, blocking_timeout=600):
+                if not self.redis.exists(self.key):
+                    value = self.seed() if self.seed is not None else 0
+                    self.redis.set(self.key, value, nx=True)
+            end = self._lease(keys=[self.key], args=[size])
+        return end - size, end
+
+    def high_water(self):
+        """
+        :return the first id not yet leased
+        """
+        return int(self.redis.get(self.key) or 0)
+
+    def advance_to(self, value):
+        """
+        Make sure ids below value are never leased, e.g. after importing
+        codes generated elsewhere
+        """
+        self._advance(keys=[self.key], args=[value])
+
+
+class DatabaseBlockAllocator(object):
+    """
+    Lease ranges of ids from a row in the sequences table
+    """
+    def __init__(self, bind, name="short_url"):
+        self.bind = bind
+        self.name = name
+
+    def lease(self, size):
+        """
+        Reserve size consecutive ids
+        :return tuple of (first id, end id)
+        """
+        table = Sequence.__table__
+        with self.bind.begin() as conn:
+            updated = conn.execute(
+                table.update().where(
+                    table.c.name == self.name
+                ).values(value=table.c.value + size)
+            )
+            if not updated.rowcount:
+                conn.execute(table.insert().values(name=self.name, value=size))
+            end = conn.execute(
+                select([table.c.value]).where(table.c.name == self.name)
+            ).scalar()
+        return end - size, end
+
+    def high_water(self):
+        """
+        :return the first id not yet leased
+        """
+        table = Sequence.__table__
+        with self.bind.connect() as conn:
+            value = conn.execute(select([table.c.value]).where(table.c.name == self.name)).scalar()
+        return value or 0
+
+    def advance_to(self, value):
+        """
+        Make sure ids below value are never leased, e.g. after importing
+        codes generated elsewhere
+        """
+        table = Sequence.__table__
+        with self.bind.begin() as conn:
+            exists = conn.execute(select([table.c.value]).where(table.c.name == self.name)).scalar()
+            if exists is None:
+                conn.execute(table.insert().values(name=self.name, value=value))
+            else:
+                conn.execute(table.update().where(
+                    (table.c.name == self.name) & (table.c.value < value)
+                ).values(value=value))
+
+
+class CodeGenerator(object):
+    """
+    Hand out unique base62 short codes from blocks of ids leased from a
+    shared allocator, so a worker only coordinates once per block.  With
+    scrambling enabled the ids are passed through a permutation of the
+    code space, which keeps them unique but hides their order.
+    """
+    def __init__(self, allocator, length, block_size, multiplier=None, offset=0):
+        if multiplier is not None and (multiplier % 2 == 0 or multiplier % 31 == 0):
+            raise ValueError("The scramble multiplier must be coprime to 62")
+        self.allocator = allocator
+        self.length = length
+        self.block_size = block_size
+        self.multiplier = multiplier
+        self.offset = offset
+        self.space = 62 ** length
+        self._lock = threading.Lock()
+        self._reset()
+        # forked workers must not hand out their parent's block
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._next = self._end = 0
+
+    def next(self):
+        """
+        Generate one short code
+        :return str
+        """
+        return self.take(1)[0]
+
+    def take(self, count):
+        """
+        Generate count short codes, leasing more ids as needed
+        :return list of str
+        """
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                if self._next >= self._end:
+                    size = max(self.block_size, count - len(ids))
+                    self._next, self._end = self.allocator.lease(size)
+                stop = min(self._end, self._next + count - len(ids))
+                ids.extend(range(self._next, stop))
+                self._next = stop
+        return [self.encode(n) for n in ids]
+
+    def encode(self, n):
+        """
+        Map an id to its short code
+        :return str
+        """
+        if n >= self.space:
+            raise ValueError("Short code space of length {} is exhausted".format(self.length))
+        if self.multiplier is None:
+            return base62.encode(n).rjust(self.length, "0")
+        # each affine step mixes the low digits into the high ones, and
+        # reversing the digits feeds them back into the low end
+        for _ in range(3):
+            n = (n * self.multiplier + self.offset) % self.space
+            reversed_n = 0
+            for _ in range(self.length):
+                n, digit = divmod(n, 62)
+                reversed_n = reversed_n * 62 + digit
+            n = reversed_n
+        return base62.encode(n).rjust(self.length, "0")
+
+    def decode(self, code):
+        """
+        Map a short code back to its id
+        :return int
+        :raise ValueError for a code this generator cannot have made
+        """
+        if len(code) != self.length:
+            raise ValueError("Not a {} character code".format(self.length))
+        n = 0
+        for digit in code:
+            if digit not in DIGITS:
+                raise ValueError("Not a base62 code")
+            n = n * 62 + DIGITS[digit]
+        if self.multiplier is None:
+            return n
+        inverse = pow(self.multiplier, -1, self.space)
+        for _ in range(3):
+            reversed_n = 0
+            for _ in range(self.length):
+                n, digit = divmod(n, 62)
+                reversed_n = reversed_n * 62 + digit
+            n = (reversed_n - self.offset) * inverse % self.space
+        return n
+
+
+def next_free_id(generator, shards, archive, batch_size=10000):
+    """
+    One past the highest id behind any stored short code, in every shard
+    and the archive.  Codes of another length, such as the older hash
+    based ones, were never leased and are skipped.
+    :return int
+    """
+    highest = -1
+    streams = [archive.short_urls(batch_size)]
+    for shard in shards:
+        streams.append(_stored_codes(shard.engine, batch_size))
+    for stream in streams:
+        for short_url in stream:
+            try:
+                highest = max(highest, generator.decode(short_url))
+            except (TypeError, ValueError):
+                continue
+    return highest + 1
+
+
+def _stored_codes(bind, batch_size):
+    with bind.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(select([URL.short_url]))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for (short_url,) in rows:
+                yield short_url
+
+
+def make_generator():
+    """
+    Build the code generator selected in config
+    :return CodeGenerator
+    """
+    if config.CODE_ALLOCATOR == "database":
+        allocator = DatabaseBlockAllocator(engine)
+    else:
+        allocator = RedisBlockAllocator(redis_store)
+    multiplier = config.CODE_SCRAMBLE_MULTIPLIER if config.CODE_SCRAMBLE else None
+    generator = CodeGenerator(
+        allocator,
+        length=config.CODE_LENGTH,
+        block_size=config.CODE_BLOCK_SIZE,
+        multiplier=multiplier,
+        offset=config.CODE_SCRAMBLE_OFFSET
+    )
+    if isinstance(allocator, RedisBlockAllocator):
+        allocator.seed = lambda: next_free_id(generator, shard_router, archive_store)
+    return generator
+
+
+code_generator = make_generator()
@@ -1,14 +1,145 @@
-from sqlalchemy import create_engine
+import os
+import time
+
+from sqlalchemy import create_engine, event, exc, inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool, StaticPool
+
+import config
+import metrics
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout={}".format(int(config.SQLITE_BUSY_TIMEOUT)))
+    cursor.execute("PRAGMA mmap_size={}".format(int(config.SQLITE_MMAP_SIZE)))
+    cursor.execute("PRAGMA cache_size={}".format(int(config.SQLITE_CACHE_SIZE)))
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection inherited across a gunicorn or celery fork is discarded
+    # rather than shared with the parent process
+    pid = os.getpid()
+    if connection_record.info["pid"] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, attempting to check out in pid {}".format(
+                connection_record.info["pid"], pid)
+        )
+
+
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
 
-engine = create_engine("sqlite:///shorty.db", convert_unicode=True)
+
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    metrics.observe_query(statement, time.perf_counter() - conn.info["query_start"].pop())
+
+
+def _failed_query(context):
+    # a failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def make_engine(uri):
+    """
+    Create an engine for a database URI.  SQLite files get a small thread
+    local pool and WAL friendly pragmas on every new connection; server
+    databases such as PostgreSQL get a QueuePool sized per worker process.
+    :return Engine
+    """
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            options = {
+                "poolclass": StaticPool,
+                "connect_args": {"check_same_thread": False}
+            }
+        else:
+            options = {
+                "poolclass": QueuePool,
+                "pool_size": config.SQLITE_POOL_SIZE,
+                "max_overflow": 0,
+                "connect_args": {"check_same_thread": False, "timeout": config.SQLITE_BUSY_TIMEOUT / 1000.0}
+            }
+    else:
+        options = {
+            "poolclass": QueuePool,
+            "pool_size": config.DB_POOL_SIZE,
+            "max_overflow": config.DB_MAX_OVERFLOW,
+            "pool_timeout": config.DB_POOL_TIMEOUT,
+            "pool_recycle": config.DB_POOL_RECYCLE,
+            "pool_pre_ping": True
+        }
+    new_engine = create_engine(url, **options)
+    if url.get_backend_name() == "sqlite":
+        event.listen(new_engine, "connect", _set_sqlite_pragmas)
+    event.listen(new_engine, "connect", _remember_pid)
+    event.listen(new_engine, "checkout", _check_pid)
+    event.listen(new_engine, "before_cursor_execute", _start_query)
+    event.listen(new_engine, "after_cursor_execute", _end_query)
+    event.listen(new_engine, "handle_error", _failed_query)
+    return new_engine
+
+
+engine = make_engine(config.SQLALCHEMY_DATABASE_URI)
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
                                          bind=engine))
+
+# the redirect path reads from a replica when one is configured
+if config.SQLALCHEMY_READ_DATABASE_URI:
+    read_engine = make_engine(config.SQLALCHEMY_READ_DATABASE_URI)
+else:
+    read_engine = engine
+read_session = scoped_session(sessionmaker(autocommit=False,
+                                           autoflush=False,
+                                           bind=read_engine))
 Base = declarative_base()
 
 
+def upgrade_schema(metadata, bind):
+    """
+    Add the columns and indexes of metadata missing from tables created by
+    an older release, which create_all leaves as they are.  New columns are
+    added as nullable; a column that changed type or went away still needs
+    a migration by hand.
+    :return list of the columns and indexes added
+    """
+    added = []
+    inspector = inspect(bind)
+    existing = set(inspector.get_table_names())
+    quote = bind.dialect.identifier_preparer.quote
+    for table in metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            with bind.begin() as conn:
+                conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    quote(table.name), quote(column.name), column.type.compile(dialect=bind.dialect)))
+            added.append("{}.{}".format(table.name, column.name))
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=bind)
+                added.append(index.name)
+    return added
+
+
 def init_db():
     # import all modules here that might define models so that
     # they will be registered properly on the metadata.  Otherwise
@@ -0,0 +1,57 @@
+"""
+A redirect-only WSGI entry point that never opens a database connection.
+Short codes are resolved from the memory-mapped index at URL_INDEX_PATH,
+built by `flask build-url-index` or the build-url-index beat task; clicks
+are still counted through redis, and dropped if it is unavailable.
+
+    SHORTY_URL_INDEX=/var/lib/shorty/urls.idx gunicorn -w 8 edge:application
+"""
+import logging
+
+import redis
+
+import config
+from cache import GONE, redis_store
+from clicks import queue_record
+from events import click_event
+from ratelimit import RateLimitMiddleware, limiter
+from redirector import Redirector
+from urlindex import MappedIndex
+
+logger = logging.getLogger(__name__)
+
+url_index = MappedIndex(config.URL_INDEX_PATH, check_interval=config.URL_INDEX_CHECK_INTERVAL)
+
+
+def follow_index(short_url, ip, user_agent, referrer, count=True):
+    """
+    Resolve a short code from the mapped index and record the click.
+    Expired links are GONE and their clicks are not counted.
+    :return ResolvedURL, GONE or None
+    """
+    url = url_index.resolve(short_url)
+    if url is not None and url is not GONE and count:
+        try:
+            pipe = redis_store.pipeline(transaction=False)
+            queue_record(pipe, url.short_url, click_event(url.short_url, ip, user_agent, referrer))
+            pipe.execute()
+        except redis.exceptions.RedisError as err:
+            # there is no database to fall back to on these nodes
+            logger.warning("Click buffer unavailable, click dropped: %s", err)
+    return url
+
+
+def not_found(environ, start_response):
+    start_response("404 Not Found", [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", "9")
+    ])
+    return [b"Not Found"]
+
+
+application = RateLimitMiddleware(
+    Redirector(not_found, follow=follow_index),
+    limiter,
+    proxy_hops=config.RATE_LIMIT_PROXY_HOPS,
+    api_keys=config.API_KEYS
+)
@@ -0,0 +1,112 @@
+"""
+A small caching reverse proxy standing in for a CDN or Varnish in front
+of the redirect nodes, for development and testing.  It caches redirects
+marked Cache-Control: public with a max-age, keyed on the path and any
+request headers named in Vary, and drops a path's copies on PURGE /<path>.
+
+    SHORTY_UPSTREAM=http://127.0.0.1:5580 gunicorn -b 127.0.0.1:6081 edgecache:application
+"""
+import os
+import re
+import threading
+import time
+
+import requests
+
+from cache import LRUCache
+
+MAX_AGE = re.compile(r"(?:^|,)\s*max-age=(\d+)")
+
+# responses a cache may keep, other statuses always go upstream
+CACHEABLE = frozenset([301, 302, 307, 308])
+
+# hop-by-hop headers are not forwarded
+HOP_HEADERS = frozenset(["connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade",
+                         "proxy-authenticate", "proxy-authorization", "content-length", "content-encoding"])
+
+
+def cache_lifetime(status, headers):
+    """
+    How long a response may be cached, 0 if it may not
+    :return int seconds
+    """
+    if status not in CACHEABLE:
+        return 0
+    control = headers.get("Cache-Control", "").lower()
+    if "public" not in control or "no-store" in control or "private" in control:
+        return 0
+    match = MAX_AGE.search(control)
+    return int(match.group(1)) if match else 0
+
+
+class EdgeCache(object):
+    """
+    WSGI app proxying to an upstream and caching its cacheable redirects
+    """
+    def __init__(self, upstream, maxsize=100000):
+        self.upstream = upstream.rstrip("/")
+        self.cache = LRUCache(maxsize, ttl=0)
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        path = environ.get("PATH_INFO", "/")
+        if method == "PURGE":
+            self.cache.delete(path)
+            start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", "6")])
+            return [b"Purged"]
+        if method in ("GET", "HEAD") and not environ.get("QUERY_STRING"):
+            cached = self._lookup(path, environ)
+            if cached is not None:
+                status_line, headers, age = cached
+                start_response(status_line, headers + [("Age", str(age)), ("X-Cache", "HIT")])
+                return [b""]
+        return self._forward(method, path, environ, start_response)
+
+    def _lookup(self, path, environ):
+        variants = self.cache.get(path)
+        if not variants:
+            return None
+        vary, entries = variants
+        entry = entries.get(self._variant(vary, environ))
+        if entry is None:
+            return None
+        status_line, headers, stored, expires = entry
+        now = time.monotonic()
+        if now >= expires:
+            return None
+        return status_line, headers, int(now - stored)
+
+    def _variant(self, vary, environ):
+        return tuple(environ.get("HTTP_" + name.strip().upper().replace("-", "_"), "") for name in vary)
+
+    def _forward(self, method, path, environ, start_response):
+        headers = {
+            key[5:].replace("_", "-").title(): value
+            for key, value in environ.items() if key.startswith("HTTP_") and key != "HTTP_HOST"
+        }
+        if environ.get("CONTENT_TYPE"):
+            headers["Content-Type"] = environ["CONTENT_TYPE"]
+        headers["X-Forwarded-For"] = environ.get("REMOTE_ADDR", "")
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else None
+        url = self.upstream + path + ("?" + environ["QUERY_STRING"] if environ.get("QUERY_STRING") else "")
+        response = self.session.request(method, url, headers=headers, data=body, allow_redirects=False)
+        forwarded = [(k, v) for k, v in response.headers.items() if k.lower() not in HOP_HEADERS]
+        status_line = "{} {}".format(response.status_code, response.reason)
+        lifetime = cache_lifetime(response.status_code, response.headers) if method == "GET" else 0
+        if lifetime and not environ.get("QUERY_STRING"):
+            vary = [name for name in response.headers.get("Vary", "").split(",") if name.strip()]
+            now = time.monotonic()
+            with self._lock:
+                cached = self.cache.get(path)
+                entries = cached[1] if cached and cached[0] == vary else {}
+                entries[self._variant(vary, environ)] = (status_line, forwarded, now, now + lifetime)
+                self.cache.set(path, (vary, entries), ttl=lifetime)
+        content = response.content
+        start_response(status_line, forwarded + [("Content-Length", str(len(content))), ("X-Cache", "MISS")])
+        return [b"" if method == "HEAD" else content]
+
+
+application = EdgeCache(os.environ.get("SHORTY_UPSTREAM", "http://127.0.0.1:5580"))
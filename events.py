@@ -0,0 +1,230 @@
+import datetime
+import logging
+import os
+import re
+import socket
+import time
+
+import redis
+from sqlalchemy import and_, func, or_
+
+import config
+from cache import redis_store
+from database import db_session
+from models import Visitor
+
+logger = logging.getLogger(__name__)
+
+# redis keys
+EVENTS_KEY = "shorty:events"
+EVENTS_GROUP = "visitors"
+
+# user agents of crawlers, monitors and scripts rather than people
+BOT_AGENT = re.compile(r"bot|crawl|spider|slurp|curl|wget|python-requests|headless|monitor", re.IGNORECASE)
+
+
+def click_event(short_url, ip, user_agent, referrer):
+    """
+    Build a compact click event for the event stream
+    :return dict
+    """
+    return {
+        "c": short_url,
+        "t": "{:.3f}".format(time.time()),
+        "ip": ip or "",
+        "ua": (user_agent or "")[:255],
+        "ref": (referrer or "")[:2048]
+    }
+
+
+def queue_event(pipe, event):
+    """
+    Append a click event to the capped stream on a redis pipeline.  The
+    stream is trimmed approximately, so the write stays O(1) however far
+    the consumer has fallen behind.
+    """
+    pipe.xadd(EVENTS_KEY, event, maxlen=config.CLICK_EVENT_STREAM_MAXLEN, approximate=True)
+
+
+def _decode(fields):
+    return {k.decode(): v.decode() for k, v in fields.items()}
+
+
+class VisitorIngestor(object):
+    """
+    Consume click events from the redis stream and bulk insert them into
+    the visitors table.  Events are acknowledged only after their batch
+    commits; events left pending by a dead consumer are reclaimed.
+    """
+    def __init__(self, redis_client, session, batch_size, claim_timeout):
+        self.redis = redis_client
+        self.session = session
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+        self.consumer = "{}-{}".format(socket.gethostname(), os.getpid())
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(EVENTS_KEY, EVENTS_GROUP, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as err:
+            if "BUSYGROUP" not in str(err):
+                raise
+
+    def ingest(self, max_batches):
+        """
+        Insert up to max_batches batches of events
+        :return number of visitors written
+        """
+        self.ensure_group()
+        written = self._write(self._reclaim())
+        for _ in range(max_batches):
+            response = self.redis.xreadgroup(
+                EVENTS_GROUP,
+                self.consumer,
+                {EVENTS_KEY: ">"},
+                count=self.batch_size
+            )
+            messages = response[0][1] if response else []
+            if not messages:
+                break
+            written += self._write(messages)
+        return written
+
+    def _reclaim(self):
+        pending = self.redis.xpending_range(
+            EVENTS_KEY,
+            EVENTS_GROUP,
+            min="-",
+            max="+",
+            count=self.batch_size
+        )
+        stale = [p["message_id"] for p in pending
+                 if p["time_since_delivered"] >= self.claim_timeout]
+        if not stale:
+            return []
+        return self.redis.xclaim(
+            EVENTS_KEY,
+            EVENTS_GROUP,
+            self.consumer,
+            self.claim_timeout,
+            stale
+        )
+
+    def _write(self, messages):
+        rows = []
+        ids = []
+        for message_id, fields in messages:
+            ids.append(message_id)
+            if not fields:
+                # trimmed from the stream before it was read
+                continue
+            event = _decode(fields)
+            clicked = datetime.datetime.fromtimestamp(float(event["t"]))
+            rows.append({
+                "short_url": event["c"],
+                "created_date": clicked,
+                "last_visit": clicked,
+                "ip": event["ip"],
+                "user_agent": event["ua"],
+                "referrer": event["ref"],
+                "num_visits": 1,
+                "processed": False,
+                "locked": False,
+                "retry_counter": 0
+            })
+        if not ids:
+            return 0
+        try:
+            self.session.bulk_insert_mappings(Visitor, rows)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        self.redis.xack(EVENTS_KEY, EVENTS_GROUP, *ids)
+        return len(rows)
+
+
+def claim_visitors(session, limit, stale_after):
+    """
+    Claim a batch of unprocessed visitors for downstream processing.  Rows
+    locked longer than stale_after seconds are assumed abandoned and are
+    claimed again, so every visitor is processed at least once.
+    :return list of Visitor
+    """
+    now = datetime.datetime.now()
+    claimable = and_(
+        Visitor.processed.isnot(True),
+        or_(
+            Visitor.locked.isnot(True),
+            Visitor.last_retry < now - datetime.timedelta(seconds=stale_after)
+        )
+    )
+    ids = [row.id for row in session.query(Visitor.id).filter(
+        claimable
+    ).order_by(Visitor.id).limit(limit)]
+    if not ids:
+        return []
+    session.query(Visitor).filter(
+        Visitor.id.in_(ids),
+        claimable
+    ).update({
+        Visitor.locked: True,
+        Visitor.last_retry: now,
+        Visitor.retry_counter: func.coalesce(Visitor.retry_counter, 0) + 1
+    }, synchronize_session=False)
+    session.commit()
+    return session.query(Visitor).filter(
+        Visitor.id.in_(ids),
+        Visitor.last_retry == now
+    ).all()
+
+
+def complete_visitors(session, ids):
+    """
+    Mark claimed visitors as processed and release their lock
+    """
+    session.query(Visitor).filter(
+        Visitor.id.in_(ids)
+    ).update({
+        Visitor.processed: True,
+        Visitor.locked: False,
+        Visitor.status: "done"
+    }, synchronize_session=False)
+    session.commit()
+
+
+def traffic_type(user_agent, referrer):
+    """
+    Classify a click by what sent it
+    :return "bot", "referral" or "direct"
+    """
+    if not user_agent or BOT_AGENT.search(user_agent):
+        return "bot"
+    return "referral" if referrer else "direct"
+
+
+def classify_visitors(session, batch_size, max_batches, stale_after):
+    """
+    Claim unprocessed visitors a batch at a time, classify their traffic
+    and mark them processed.  Rows claimed by a worker that died are left
+    locked until stale_after seconds have passed, then claimed again.
+    :return number of visitors processed
+    """
+    processed = 0
+    for _ in range(max_batches):
+        visitors = claim_visitors(session, batch_size, stale_after)
+        if not visitors:
+            break
+        for visitor in visitors:
+            visitor.traffic_type = traffic_type(visitor.user_agent, visitor.referrer)
+        complete_visitors(session, [visitor.id for visitor in visitors])
+        processed += len(visitors)
+    return processed
+
+
+visitor_ingestor = VisitorIngestor(
+    redis_store,
+    db_session,
+    batch_size=config.VISITOR_INGEST_BATCH_SIZE,
+    claim_timeout=config.VISITOR_CLAIM_TIMEOUT * 1000
+)
@@ -0,0 +1,7 @@
+# gunicorn reads this file from the working directory on startup
+
+
+def child_exit(server, worker):
+    # counters of the exited worker are kept, its live gauges are dropped
+    import metrics
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+
+import redis
+from sqlalchemy import desc, exc
+
+import config
+from cache import GONE, redis_store, resolver
+from models import URL
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+# redis keys
+ALL_TIME_KEY = "shorty:top:all"
+BUILDING_KEY = "shorty:top:all:building"
+SNAPSHOT_KEY = "shorty:top:all:snapshot"
+SEEDED_KEY = "shorty:top:all:seeded"
+SEED_LOCK_KEY = "shorty:top:lock"
+BUCKET_KEY = "shorty:top:{}:{}"
+WINDOW_KEY = "shorty:top:window:{}"
+
+# bucket name -> (seconds per bucket, seconds to keep the bucket)
+BUCKETS = {
+    "5m": (300, 2 * 3600),
+    "1h": (3600, 2 * 86400),
+    "1d": (86400, 8 * 86400)
+}
+
+# window name -> (bucket name, number of buckets summed)
+WINDOWS = {
+    "hour": ("5m", 12),
+    "day": ("1h", 24),
+    "week": ("1d", 7)
+}
+
+# swap a rebuilt ranking in, keeping the clicks counted on the live one
+# since its snapshot was taken
+SWAP = """
+redis.call("zunionstore", KEYS[1], 3, KEYS[1], KEYS[2], KEYS[3], "WEIGHTS", 1, 1, -1)
+redis.call("zremrangebyscore", KEYS[1], "-inf", 0)
+redis.call("del", KEYS[3])
+if redis.call("exists", KEYS[1]) == 1 then
+    redis.call("rename", KEYS[1], KEYS[2])
+else
+    redis.call("del", KEYS[2])
+end
+redis.call("set", KEYS[4], 1)
+"""
+
+
+def queue_click(pipe, short_url, now=None):
+    """
+    Count a click in the all-time and time bucketed sorted sets on
+    a redis pipeline
+    """
+    now = int(now or time.time())
+    pipe.zincrby(ALL_TIME_KEY, 1, short_url)
+    for name, (width, keep) in BUCKETS.items():
+        key = BUCKET_KEY.format(name, now // width)
+        pipe.zincrby(key, 1, short_url)
+        pipe.expire(key, keep)
+
+
+class Leaderboard(object):
+    """
+    The most clicked links, maintained incrementally in redis sorted sets.
+    Windowed rankings are the union of their time buckets, materialized
+    for a short while so reads are a single ZREVRANGE.  The all-time
+    ranking is seeded from the urls tables in the background the first
+    time it is read, and read from the tables until then.
+    """
+    def __init__(self, redis_client, shards, window_ttl):
+        self.redis = redis_client
+        self.shards = shards
+        self.window_ttl = window_ttl
+        self._swap = redis_client.register_script(SWAP)
+        self._seeding = None
+        self._lock = threading.Lock()
+
+    def top(self, window="all", limit=100):
+        """
+        Rank links by clicks over a window, skipping archived or
+        deactivated links
+        :return list of dicts
+        """
+        if window not in WINDOWS and window != "all":
+            raise ValueError("Unknown leaderboard window: {}".format(window))
+        try:
+            ranked = self._ranked(window, limit)
+        except redis.exceptions.RedisError as err:
+            logger.warning("Redis leaderboard unavailable: %s", err)
+            ranked = None
+        if ranked is None:
+            if window != "all":
+                return []
+            ranked = []
+            for shard in self.shards:
+                ranked.extend((row.short_url, row.clicks or 0) for row in shard.session.query(
+                    URL.short_url, URL.clicks
+                ).order_by(desc(URL.clicks), desc(URL.id)).limit(limit * 2))
+            ranked.sort(key=lambda item: item[1], reverse=True)
+        links = []
+        for short_url, clicks in ranked:
+            if isinstance(short_url, bytes):
+                short_url = short_url.decode()
+            url = resolver.resolve(short_url)
+            if url is None or url is GONE:
+                continue
+            links.append({
+                "short_url": short_url,
+                "full_url": url.full_url,
+                "clicks": int(clicks)
+            })
+            if len(links) == limit:
+                break
+        return links
+
+    def _ranked(self, window, limit):
+        # over fetch a little so links that no longer resolve can be skipped
+        count = limit + limit // 4 + 4
+        if window == "all":
+            # the first click after a deploy or a redis restart creates the
+            # key, so whether it has been seeded is tracked separately
+            if not self.redis.exists(SEEDED_KEY):
+                self._seed_later()
+                return None
+            return self.redis.zrevrange(ALL_TIME_KEY, 0, count - 1, withscores=True)
+        key = WINDOW_KEY.format(window)
+        ranked = self.redis.zrevrange(key, 0, count - 1, withscores=True)
+        if ranked or self.redis.exists(key):
+            return ranked
+        bucket, buckets = WINDOWS[window]
+        width = BUCKETS[bucket][0]
+        current = int(time.time()) // width
+        sources = [BUCKET_KEY.format(bucket, current - i) for i in range(buckets)]
+        pipe = self.redis.pipeline()
+        pipe.zunionstore(key, sources)
+        pipe.expire(key, self.window_ttl)
+        pipe.execute()
+        return self.redis.zrevrange(key, 0, count - 1, withscores=True)
+
+    def rebuild(self, chunk_size=10000):
+        """
+        Reload the all-time ranking from the click counts in the urls table
+        of every shard.  It is built aside and swapped in, and clicks counted
+        on the live ranking while the tables were read are carried over.
+        :return number of links ranked
+        """
+        loaded = 0
+        pipe = self.redis.pipeline()
+        pipe.delete(BUILDING_KEY)
+        pipe.zunionstore(SNAPSHOT_KEY, [ALL_TIME_KEY])
+        pipe.execute()
+        batch = {}
+        for short_url, clicks in (row for shard in self.shards for row in shard.read_session.query(
+                URL.short_url, URL.clicks).filter(URL.clicks > 0).yield_per(chunk_size)):
+            batch[short_url] = clicks
+            if len(batch) >= chunk_size:
+                self.redis.zadd(BUILDING_KEY, batch)
+                loaded += len(batch)
+                batch = {}
+        if batch:
+            self.redis.zadd(BUILDING_KEY, batch)
+            loaded += len(batch)
+        self.shards.remove_readers()
+        self._swap(keys=[BUILDING_KEY, ALL_TIME_KEY, SNAPSHOT_KEY, SEEDED_KEY])
+        return loaded
+
+    def seed(self):
+        """
+        Rebuild the all-time ranking unless it has been seeded already or
+        another worker is seeding it
+        :return number of links ranked
+        """
+        lock = self.redis.lock(SEED_LOCK_KEY, timeout=600, blocking_timeout=0)
+        if not lock.acquire():
+            return 0
+        try:
+            if self.redis.exists(SEEDED_KEY):
+                return 0
+            logger.info("Seeding the all-time leaderboard.")
+            return self.rebuild()
+        finally:
+            lock.release()
+
+    def _seed_later(self):
+        with self._lock:
+            if self._seeding is not None and self._seeding.is_alive():
+                return
+            self._seeding = threading.Thread(target=self._seed_quietly, name="leaderboard-seed", daemon=True)
+            self._seeding.start()
+
+    def _seed_quietly(self):
+        try:
+            self.seed()
+        except (redis.exceptions.RedisError, exc.SQLAlchemyError) as err:
+            logger.warning("Could not seed the all-time leaderboard: %s", err)
+
+
+leaderboard = Leaderboard(redis_store, shard_router, window_ttl=config.LEADERBOARD_WINDOW_TTL)
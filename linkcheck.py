@@ -0,0 +1,261 @@
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from urllib.parse import urlparse
+
+import requests
+from lxml.html import fromstring
+from requests.adapters import HTTPAdapter
+from sqlalchemy import and_, bindparam, literal, or_
+
+import config
+from cache import resolver
+from purge import purger
+from models import URL
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+
+def make_http_session(pool_size):
+    """
+    Build a requests session with a connection pool shared by
+    the worker's threads
+    :return requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = config.LINK_CHECK_USER_AGENT
+    return session
+
+
+http_session = make_http_session(config.LINK_CHECK_POOL_SIZE)
+
+
+def fetch_title(url):
+    """
+    Request a URL and read at most TITLE_FETCH_MAX_BYTES of the body,
+    stopping as soon as the closing title tag has arrived
+    :return tuple of (status code, title or None)
+    """
+    with http_session.get(url, timeout=config.LINK_CHECK_TIMEOUT, stream=True) as r:
+        if r.status_code >= 400 or "html" not in r.headers.get("Content-Type", ""):
+            return r.status_code, None
+        body = b""
+        for chunk in r.iter_content(chunk_size=4096):
+            body += chunk
+            if b"</title>" in body.lower() or len(body) >= config.TITLE_FETCH_MAX_BYTES:
+                break
+    if not body.strip():
+        return r.status_code, None
+    title = fromstring(body[:config.TITLE_FETCH_MAX_BYTES]).findtext(".//title")
+    return r.status_code, title.strip() if title else None
+
+
+class HostThrottle(object):
+    """
+    Politeness for the link checker: one request at a time per host, at
+    least interval seconds apart
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def slot(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = [threading.Lock(), 0.0]
+            return self._hosts[host]
+
+    def run(self, host, fn, *args):
+        slot = self.slot(host)
+        with slot[0]:
+            wait = slot[1] - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return fn(*args)
+            finally:
+                slot[1] = time.monotonic() + self.interval
+
+
+def check_link(url, etag=None, last_modified=None):
+    """
+    Check a link with a conditional HEAD request, falling back to GET
+    for servers that do not support HEAD
+    :return tuple of (status code, etag, last modified)
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    r = http_session.head(url, headers=headers, timeout=config.LINK_CHECK_TIMEOUT, allow_redirects=True)
+    if r.status_code in (403, 405, 501):
+        # only the status line and headers are read, the body is discarded
+        with http_session.get(url, headers=headers, timeout=config.LINK_CHECK_TIMEOUT, stream=True) as r:
+            pass
+    if r.status_code == 304:
+        return r.status_code, etag, last_modified
+    return r.status_code, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+
+class LinkChecker(object):
+    """
+    Re-validate stored links in batches, least recently checked first,
+    with bounded concurrency and per host politeness.  A link is only
+    deactivated after max_failures failed checks in a row.
+    """
+    def __init__(self, shards, concurrency, host_interval, max_per_host, max_failures):
+        self.shards = shards
+        self.concurrency = concurrency
+        self.throttle = HostThrottle(host_interval)
+        self.max_per_host = max_per_host
+        self.max_failures = max_failures
+
+    def due(self, limit, min_age, page_size=None):
+        """
+        The links most in need of a check across every shard, at most
+        max_per_host of them per host.  Each shard is read oldest first, a
+        page at a time, until it has given limit links, so a host with a
+        large backlog cannot crowd every other host out of the batch.
+        :return list of rows
+        """
+        checked_before = datetime.datetime.now() - datetime.timedelta(seconds=min_age)
+        rows = []
+        for shard in self.shards:
+            rows.extend(self._due_on(shard, limit, checked_before, page_size or limit))
+        # never checked first, as the database orders NULLs
+        rows.sort(key=lambda row: (row.url_last_checked_datetime is not None,
+                                   row.url_last_checked_datetime or checked_before))
+        return self._cap_hosts(rows)[:limit]
+
+    def _due_on(self, shard, limit, checked_before, page_size):
+        query = shard.session.query(
+            URL.id, URL.short_url, URL.full_url, URL.is_url_active,
+            URL.check_etag, URL.check_last_modified, URL.check_failures,
+            URL.url_last_checked_datetime, literal(shard.index).label("shard")
+        ).filter(URL.archived.isnot(True))
+        never = query.filter(URL.url_last_checked_datetime.is_(None)).order_by(URL.id)
+        stale = query.filter(URL.url_last_checked_datetime < checked_before).order_by(
+            URL.url_last_checked_datetime, URL.id)
+        picked = []
+        hosts = defaultdict(int)
+        for pages, after in ((never, lambda row: URL.id > row.id),
+                             (stale, lambda row: or_(
+                                 URL.url_last_checked_datetime > row.url_last_checked_datetime,
+                                 and_(URL.url_last_checked_datetime == row.url_last_checked_datetime,
+                                      URL.id > row.id)))):
+            last = None
+            while len(picked) < limit:
+                page = (pages if last is None else pages.filter(after(last))).limit(page_size).all()
+                for row in page:
+                    host = urlparse(row.full_url).hostname or ""
+                    if hosts[host] < self.max_per_host:
+                        hosts[host] += 1
+                        picked.append(row)
+                if len(page) < page_size:
+                    break
+                last = page[-1]
+        return picked[:limit]
+
+    def _cap_hosts(self, rows):
+        counts = defaultdict(int)
+        capped = []
+        for row in rows:
+            host = urlparse(row.full_url).hostname or ""
+            if counts[host] < self.max_per_host:
+                counts[host] += 1
+                capped.append(row)
+        return capped
+
+    def outcome(self, status, failures):
+        """
+        The failure count and active flag of a link after a check which
+        returned status, None when the request failed
+        :return tuple of (failures, active)
+        """
+        failures = 0 if status is not None and status < 400 else (failures or 0) + 1
+        return failures, failures < self.max_failures
+
+    def check(self, rows):
+        """
+        Check a batch of links and write the results back in one bulk update
+        per shard
+        :return number of links checked
+        """
+        rows = self._interleave(rows)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = list(pool.map(self._check_one, rows))
+        now = datetime.datetime.now()
+        updates = defaultdict(list)
+        changed = []
+        for row, (status, etag, last_modified) in zip(rows, results):
+            failures, active = self.outcome(status, row.check_failures)
+            if active != bool(row.is_url_active):
+                changed.append(row.short_url)
+            updates[row.shard].append({
+                "_id": row.id,
+                "is_url_active": active,
+                "url_last_checked_datetime": now,
+                "check_status": status,
+                "check_etag": etag,
+                "check_last_modified": last_modified,
+                "check_failures": failures
+            })
+        table = URL.__table__
+        for index, shard_updates in updates.items():
+            session = self.shards.shards[index].session
+            session.execute(
+                table.update().where(table.c.id == bindparam("_id")).values(
+                    is_url_active=bindparam("is_url_active"),
+                    url_last_checked_datetime=bindparam("url_last_checked_datetime"),
+                    check_status=bindparam("check_status"),
+                    check_etag=bindparam("check_etag"),
+                    check_last_modified=bindparam("check_last_modified"),
+                    check_failures=bindparam("check_failures")
+                ),
+                shard_updates
+            )
+            session.commit()
+        if changed:
+            resolver.invalidate_many(changed)
+            purger.purge_many(changed)
+        return sum(len(shard_updates) for shard_updates in updates.values())
+
+    def _interleave(self, rows):
+        # round robin across hosts so no host's links are checked back to
+        # back, and leave a host's excess links for a later batch
+        by_host = defaultdict(list)
+        for row in rows:
+            host = urlparse(row.full_url).hostname or ""
+            if len(by_host[host]) < self.max_per_host:
+                by_host[host].append(row)
+        ordered = []
+        for group in zip_longest(*by_host.values()):
+            ordered.extend(row for row in group if row is not None)
+        return ordered
+
+    def _check_one(self, row):
+        host = urlparse(row.full_url).hostname or ""
+        try:
+            return self.throttle.run(host, check_link, row.full_url, row.check_etag, row.check_last_modified)
+        except (requests.RequestException, ValueError) as err:
+            logger.info("Link check failed for %s: %s", row.full_url, err)
+            return None, row.check_etag, row.check_last_modified
+
+
+link_checker = LinkChecker(
+    shard_router,
+    concurrency=config.LINK_CHECK_CONCURRENCY,
+    host_interval=config.LINK_CHECK_HOST_INTERVAL,
+    max_per_host=config.LINK_CHECK_MAX_PER_HOST,
+    max_failures=config.LINK_CHECK_MAX_FAILURES
+)
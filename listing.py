@@ -0,0 +1,83 @@
+from sqlalchemy import and_, asc, desc, literal, or_
+
+from models import URL
+
+
+def parse_cursor(value):
+    """
+    Parse a "clicks.shard.id" keyset cursor, or an older "clicks.id" one
+    which can only point into shard 0
+    :return tuple of (clicks, shard, id) or None
+    """
+    if not value:
+        return None
+    try:
+        parts = [int(part) for part in value.split(".")]
+    except ValueError:
+        return None
+    if len(parts) == 2:
+        return parts[0], 0, parts[1]
+    if len(parts) == 3:
+        return tuple(parts)
+    return None
+
+
+def make_cursor(row):
+    return "{}.{}.{}".format(row.clicks or 0, row.shard, row.id)
+
+
+def sort_key(row):
+    return row.clicks or 0, row.shard, row.id
+
+
+def _seek(shard, cursor, forward):
+    """
+    Rows of a shard on one side of a cursor.  The listing is ordered by
+    (clicks, shard, id) so ties on clicks are broken first by shard.
+    :return filter clause
+    """
+    clicks, cursor_shard, url_id = cursor
+    if forward:
+        if shard.index < cursor_shard:
+            return URL.clicks <= clicks
+        if shard.index > cursor_shard:
+            return URL.clicks < clicks
+        return or_(URL.clicks < clicks, and_(URL.clicks == clicks, URL.id < url_id))
+    if shard.index < cursor_shard:
+        return URL.clicks > clicks
+    if shard.index > cursor_shard:
+        return URL.clicks >= clicks
+    return or_(URL.clicks > clicks, and_(URL.clicks == clicks, URL.id > url_id))
+
+
+def url_page(shards, per_page, after=None, before=None):
+    """
+    Fetch one page of the dashboard listing, most clicked first, by seeking
+    on the (clicks, id) index of every shard from a cursor instead of using
+    an offset, then merging what each shard returned
+    :return tuple of (rows, next cursor or None, previous cursor or None)
+    """
+    forward = before is None
+    cursor = after if forward else before
+    order = (desc(URL.clicks), desc(URL.id)) if forward else (asc(URL.clicks), asc(URL.id))
+    rows = []
+    for shard in shards:
+        query = shard.session.query(
+            URL.id, URL.short_url, URL.name, URL.full_hash, URL.clicks, literal(shard.index).label("shard"))
+        if cursor is not None:
+            query = query.filter(_seek(shard, cursor, forward))
+        rows.extend(query.order_by(*order).limit(per_page + 1).all())
+    rows = sorted(rows, key=sort_key, reverse=forward)[:per_page + 1]
+    if forward:
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = after is not None
+    else:
+        has_prev = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        has_next = True
+    if not rows:
+        return rows, None, None
+    next_cursor = make_cursor(rows[-1]) if has_next else None
+    prev_cursor = make_cursor(rows[0]) if has_prev else None
+    return rows, next_cursor, prev_cursor
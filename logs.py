@@ -0,0 +1,158 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# attributes every LogRecord has; anything else was passed with extra=
+RESERVED_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# the process's writer, once setup_logging has run
+_writer = None
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format a record as one line of JSON.  Values passed with extra= are
+    included as fields, so a record can be filtered on them downstream.
+    """
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a fraction of the records of each configured event, then allow at
+    most rate records per second for any one event or message template.
+    The number of records dropped since the last one kept is attached to
+    the next record as "suppressed".  Warnings and above are never sampled.
+    """
+    # messages logged pre-formatted would each be a new key
+    max_keys = 1000
+
+    def __init__(self, sample_rates=None, rate=None):
+        super(SamplingFilter, self).__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.rate = rate
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, "event", None) or record.msg
+        sample = self.sample_rates.get(key)
+        second = int(time.monotonic())
+        with self._lock:
+            if len(self._windows) > self.max_keys:
+                self._windows.clear()
+            window, count, suppressed = self._windows.get(key, (second, 0, 0))
+            if window != second:
+                window, count = second, 0
+            keep = (sample is None or random.random() < sample) and (not self.rate or count < self.rate)
+            if keep:
+                self._windows[key] = (window, count + 1, 0)
+            else:
+                self._windows[key] = (window, count, suppressed + 1)
+        if keep and suppressed:
+            record.suppressed = suppressed
+        return keep
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A queue handler that drops records rather than block or raise when the
+    writer thread falls behind
+    """
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # format the message here so arguments are not held on the queue,
+        # but leave the JSON encoding to the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogWriter(object):
+    """
+    Route every log record through a bounded queue to a single writer
+    thread, so request threads never wait on stream I/O
+    """
+    def __init__(self, handler, maxsize):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize)
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.listener = None
+        # the writer thread does not survive a fork, start one in the child
+        os.register_at_fork(after_in_child=self._restart)
+
+    def start(self):
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _restart(self):
+        if self.listener is not None:
+            self.queue = self.queue_handler.queue = queue.Queue(self.queue.maxsize)
+            self.start()
+
+
+def setup_logging(app, level, json_format=True, sample_rates=None, rate=None, queue_size=10000):
+    """
+    Send the root logger, and with it the app and module loggers, through
+    an off-thread writer to stderr.  The writer is set up once per process;
+    later calls, from apps built after the first, only hand their logger to
+    the root logger and set its level.
+    :return LogWriter
+    """
+    global _writer
+    root = logging.getLogger()
+    if _writer is None:
+        stream = logging.StreamHandler(sys.stderr)
+        if json_format:
+            stream.setFormatter(JSONFormatter())
+        else:
+            stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        _writer = LogWriter(stream, queue_size)
+        _writer.queue_handler.addFilter(SamplingFilter(sample_rates, rate))
+        root.handlers = [_writer.queue_handler]
+        _writer.start()
+        # write out whatever is still queued when the process exits
+        atexit.register(_writer.stop)
+    root.setLevel(level)
+    # the app logger defers to the root logger's handler and level
+    app.logger.handlers = []
+    app.logger.setLevel(logging.NOTSET)
+    return _writer
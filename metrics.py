@@ -0,0 +1,117 @@
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram,
+                               REGISTRY, generate_latest, multiprocess)
+
+# gunicorn and celery fork several processes; with a multiprocess directory
+# set each writes its samples there and /metrics sums them all
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
+
+# redirects and cache lookups are sub-millisecond, page renders are not
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+
+REQUEST_LATENCY = Histogram(
+    "shorty_request_duration_seconds",
+    "Time to handle a request, by endpoint",
+    ["endpoint", "method"],
+    buckets=FAST_BUCKETS
+)
+
+REDIRECTS = Counter(
+    "shorty_redirects_total",
+    "Short code lookups answered, by status and by the layer that answered",
+    ["status", "handler"]
+)
+
+STAGE_LATENCY = Histogram(
+    "shorty_stage_duration_seconds",
+    "Time spent in each stage of the redirect and dashboard paths",
+    ["stage"],
+    buckets=FAST_BUCKETS
+)
+
+DB_QUERIES = Histogram(
+    "shorty_db_query_duration_seconds",
+    "Database statement time by operation, the count is the query count",
+    ["operation"],
+    buckets=FAST_BUCKETS
+)
+
+CACHE_LOOKUPS = Counter(
+    "shorty_cache_lookups_total",
+    "Cache lookups by cache layer and result",
+    ["cache", "result"]
+)
+
+RATE_LIMITED = Counter(
+    "shorty_ratelimit_decisions_total",
+    "Rate limit decisions by rule and result",
+    ["rule", "result"]
+)
+
+TASK_LATENCY = Histogram(
+    "shorty_task_duration_seconds",
+    "Celery task run time by task and final state",
+    ["task", "state"],
+    buckets=(.01, .05, .1, .5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+
+
+def stage(name):
+    """
+    Time a block of code as a named stage, e.g. with stage("resolve"): ...
+    :return context manager
+    """
+    return STAGE_LATENCY.labels(name).time()
+
+
+def cache_result(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def observe_query(statement, seconds):
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+    DB_QUERIES.labels(operation).observe(seconds)
+
+
+def exposition():
+    """
+    Render every metric, summed across worker processes when running
+    in multiprocess mode
+    :return tuple of (body, content type)
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """
+    Drop the live gauges of an exited worker, counters and histograms are
+    kept so totals do not go backwards
+    """
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+class TaskTimer(object):
+    """
+    Time celery tasks from the prerun and postrun signals
+    """
+    def __init__(self):
+        self._started = {}
+
+    def prerun(self, task_id=None, **kwargs):
+        self._started[task_id] = time.perf_counter()
+
+    def postrun(self, task_id=None, task=None, state=None, **kwargs):
+        started = self._started.pop(task_id, None)
+        if started is not None and task is not None:
+            TASK_LATENCY.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+
+task_timer = TaskTimer()
@@ -1,6 +1,6 @@
 from database import Base
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text, Float, Index
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 # Define application Bases
@@ -57,8 +57,10 @@ class Visitor(Base):
     __tablename__ = "visitors"
     id = Column(Integer, primary_key=True)
     created_date = Column(DateTime, onupdate=datetime.now)
-    ip = Column(String(15), index=True)
+    short_url = Column(String(10), index=True)
+    ip = Column(String(45), index=True)
     user_agent = Column(String(255))
+    referrer = Column(String(2048))
     job_number = Column(Integer)
     client_id = Column(String(255))
     appended = Column(Boolean, default=False)
@@ -68,7 +70,7 @@ class Visitor(Base):
     num_visits = Column(Integer)
     last_visit = Column(DateTime)
     raw_data = Column(Text)
-    processed = Column(Boolean, default=False)
+    processed = Column(Boolean, default=False, index=True)
     country_name = Column(String(255))
     city = Column(String(255))
     time_zone = Column(String(50))
@@ -107,6 +109,10 @@ class Visitor(Base):
 
 class URL(Base):
     __tablename__ = "urls"
+    __table_args__ = (
+        Index("ix_urls_clicks_id", "clicks", "id"),
+        Index("ix_urls_user_normalized_hash", "user_id", "normalized_hash"),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     user = relationship("User")
@@ -114,15 +120,28 @@ class URL(Base):
     full_url = Column(String(5000))
     short_url = Column(String(10), unique=True)
     full_hash = Column(String(64), unique=True)
+    normalized_hash = Column(String(64))
     raw_request_headers = Column(Text)
     request_headers_hash = Column(String(255), unique=True)
     global_id = Column(String(36), unique=True)
     created_on_date = Column(DateTime, onupdate=datetime.now)
     modified_date = Column(DateTime, onupdate=datetime.now)
     clicks = Column(Integer)
-    archived = Column(Boolean, default=False)
-    url_last_checked_datetime = Column(DateTime)
+    archived = Column(Boolean, default=False, index=True)
+    url_last_checked_datetime = Column(DateTime, index=True)
     is_url_active = Column(Boolean, default=True)
+    check_status = Column(Integer)
+    check_etag = Column(String(255))
+    check_last_modified = Column(String(64))
+    check_failures = Column(Integer, default=0)
+    # redirect policy, NULL uses the REDIRECT_* defaults in config
+    redirect_status = Column(Integer)
+    cache_max_age = Column(Integer)
+    redirect_vary = Column(String(255))
+    # expiry, once either is reached the link stops resolving and is
+    # moved to the archive by the archive-links task
+    expires_at = Column(DateTime, index=True)
+    max_clicks = Column(Integer, index=True)
 
     def __repr__(self):
         return "URL ID & Hash: {}/{}".format(str(self.id), self.short_url)
@@ -141,3 +160,26 @@ class URL(Base):
     
     def get_name(self):
         return "{}".format(str(self.name))
+
+
+class Sequence(Base):
+    __tablename__ = "sequences"
+    name = Column(String(64), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "Sequence {}: {}".format(self.name, str(self.value))
+
+
+class ClickBucket(Base):
+    __tablename__ = "click_buckets"
+    __table_args__ = (
+        Index("ix_click_buckets_resolution_bucket", "resolution", "bucket"),
+    )
+    short_url = Column(String(10), primary_key=True)
+    resolution = Column(String(1), primary_key=True)
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    clicks = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "Clicks for {} at {}{}: {}".format(self.short_url, self.resolution, str(self.bucket), str(self.clicks))
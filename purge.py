@@ -0,0 +1,56 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class Purger(object):
+    """
+    Ask caching proxies to drop their copy of a short code's redirect by
+    sending them PURGE /<code>.  Requests go out on a background thread so
+    a commit never waits on a proxy.
+    """
+    def __init__(self, proxies, timeout):
+        self.proxies = list(proxies)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+        # the executor's thread does not survive a fork
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._executor = None
+        self._session = None
+
+    def purge_many(self, short_urls):
+        """
+        Queue a purge of every proxy for each short code
+        """
+        if not self.proxies or not short_urls:
+            return
+        # requests is only loaded by workers that have a proxy to purge
+        import requests
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="purge")
+                self._session = requests.Session()
+        self._executor.submit(self._purge, list(short_urls))
+
+    def _purge(self, short_urls):
+        import requests
+        for proxy in self.proxies:
+            for short_url in short_urls:
+                try:
+                    self._session.request("PURGE", urljoin(proxy, "/" + short_url), timeout=self.timeout)
+                except requests.RequestException as err:
+                    logger.warning("Could not purge %s from %s: %s", short_url, proxy, err)
+                    # do not wait out a timeout for every code on a dead proxy
+                    break
+
+
+purger = Purger(config.PURGE_URLS, config.PURGE_TIMEOUT)
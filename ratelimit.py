@@ -0,0 +1,228 @@
+import hashlib
+import logging
+import threading
+import time
+
+import redis
+
+import config
+import metrics
+from cache import LRUCache, redis_store
+from redirector import SHORT_PATH
+
+logger = logging.getLogger(__name__)
+
+# redis keys
+BUCKET_KEY = "shorty:ratelimit:{}:{}"
+DENIED_KEY = "shorty:ratelimit:denied:{}"
+
+# keys with the most denials kept per rule
+DENIED_KEEP = 10000
+
+# take up to ARGV[3] tokens from a bucket refilled at ARGV[1] a second up
+# to ARGV[2], and count the denials, including ARGV[4] made locally, in a
+# per rule sorted set.  The clock is redis' own so every node agrees.
+TOKEN_BUCKET = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local want = tonumber(ARGV[3])
+local denied = tonumber(ARGV[4])
+local clock = redis.call("time")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call("hmget", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local granted = math.min(want, math.floor(tokens))
+tokens = tokens - granted
+redis.call("hset", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("expire", KEYS[1], math.ceil(burst / rate) + 1)
+if granted < 1 then
+    denied = denied + 1
+end
+if denied > 0 then
+    redis.call("zincrby", KEYS[2], denied, ARGV[5])
+    if redis.call("zcard", KEYS[2]) > tonumber(ARGV[6]) then
+        redis.call("zremrangebyrank", KEYS[2], 0, 0)
+    end
+end
+if granted < 1 then
+    return {0, tostring((1 - tokens) / rate)}
+end
+return {granted, "0"}
+"""
+
+
+class _Lease(object):
+    __slots__ = ("tokens", "denied_until", "denied")
+
+    def __init__(self):
+        self.tokens = 0
+        self.denied_until = 0
+        self.denied = 0
+
+
+class TokenBucketLimiter(object):
+    """
+    Token buckets shared through redis.  Each worker leases a few tokens
+    at a time and spends them locally, and remembers a denial until the
+    bucket will have refilled, so a hot key costs one round trip per lease
+    rather than per request.  Fails open when redis is unavailable.
+    """
+    def __init__(self, redis_client, rules, lease, lease_ttl):
+        self.redis = redis_client
+        self.rules = rules
+        self.lease = lease
+        self.local = LRUCache(100000, lease_ttl)
+        self._lock = threading.Lock()
+        self._bucket = redis_client.register_script(TOKEN_BUCKET)
+        self._down_until = 0
+
+    def allow(self, rule, identity):
+        """
+        Spend one token from a key's bucket
+        :return tuple of (allowed, seconds to wait before retrying)
+        """
+        now = time.monotonic()
+        decided, lease, keys, args = self._spend_local(rule, identity, now)
+        if decided is not None:
+            return decided
+        try:
+            granted, wait = self._bucket(keys=keys, args=args)
+        except redis.exceptions.RedisError as err:
+            return self._fail_open(now, err)
+        return self._settle(lease, now, granted, wait)
+
+    async def allow_async(self, rule, identity, bucket):
+        """
+        As allow, with bucket the TOKEN_BUCKET script registered on an
+        asyncio redis client
+        :return tuple of (allowed, seconds to wait before retrying)
+        """
+        now = time.monotonic()
+        decided, lease, keys, args = self._spend_local(rule, identity, now)
+        if decided is not None:
+            return decided
+        try:
+            granted, wait = await bucket(keys=keys, args=args)
+        except redis.exceptions.RedisError as err:
+            return self._fail_open(now, err)
+        return self._settle(lease, now, granted, wait)
+
+    def _spend_local(self, rule, identity, now):
+        # answer from this worker's lease when it can, otherwise return
+        # the keys and arguments of the TOKEN_BUCKET call to make
+        rate, burst = self.rules[rule]
+        key = BUCKET_KEY.format(rule, identity)
+        with self._lock:
+            lease = self.local.get(key)
+            if lease is None:
+                lease = _Lease()
+                self.local.set(key, lease)
+            if lease.denied_until > now:
+                lease.denied += 1
+                return (False, lease.denied_until - now), lease, None, None
+            if lease.tokens >= 1:
+                lease.tokens -= 1
+                return (True, 0), lease, None, None
+            if self._down_until > now:
+                return (True, 0), lease, None, None
+            pending, lease.denied = lease.denied, 0
+        keys = [key, DENIED_KEY.format(rule)]
+        args = [rate, burst, min(self.lease, burst), pending, identity, DENIED_KEEP]
+        return None, lease, keys, args
+
+    def _fail_open(self, now, err):
+        # let traffic through, and do not try again for a second
+        self._down_until = now + 1
+        logger.warning("Rate limiter unavailable, allowing requests: %s", err)
+        return True, 0
+
+    def _settle(self, lease, now, granted, wait):
+        with self._lock:
+            if granted < 1:
+                wait = float(wait)
+                lease.denied_until = now + wait
+                return False, wait
+            lease.tokens += granted - 1
+        return True, 0
+
+    def top_denied(self, rule, limit=50):
+        """
+        The keys denied most often under a rule
+        :return list of (identity, denials)
+        """
+        return [(identity.decode(), int(score)) for identity, score in
+                self.redis.zrevrange(DENIED_KEY.format(rule), 0, limit - 1, withscores=True)]
+
+
+def client_identity(environ, proxy_hops=0, api_keys=()):
+    """
+    Rate limit by API key when one of api_keys is sent, otherwise by client
+    address, taken from X-Forwarded-For when behind proxy_hops trusted
+    proxies.  Unknown keys are ignored, so made up ones do not each get a
+    fresh bucket.
+    :return str
+    """
+    api_key = environ.get("HTTP_X_API_KEY")
+    if api_key and api_key in api_keys:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8", "replace")).hexdigest()[:16]
+    address = environ.get("REMOTE_ADDR") or ""
+    if proxy_hops:
+        forwarded = [hop.strip() for hop in environ.get("HTTP_X_FORWARDED_FOR", "").split(",") if hop.strip()]
+        if len(forwarded) >= proxy_hops:
+            address = forwarded[-proxy_hops]
+    return "ip:" + address
+
+
+def classify(method, path, reserved=()):
+    """
+    The rate limit rule a request falls under, if any
+    :return str or None
+    """
+    if method == "POST" and path in ("/", "/api/urls/bulk"):
+        return "create"
+    if method in ("GET", "HEAD"):
+        if path == "/":
+            return "index"
+        match = SHORT_PATH.match(path)
+        if match is not None and match.group(1) not in reserved:
+            return "redirect"
+    return None
+
+
+class RateLimitMiddleware(object):
+    """
+    WSGI middleware answering over-limit requests with a bare 429 before
+    the redirect middleware or the Flask app do any work
+    """
+    def __init__(self, app, limiter, reserved=(), proxy_hops=0, api_keys=()):
+        self.app = app
+        self.limiter = limiter
+        self.reserved = frozenset(reserved)
+        self.proxy_hops = proxy_hops
+        self.api_keys = api_keys
+
+    def __call__(self, environ, start_response):
+        rule = classify(environ.get("REQUEST_METHOD"), environ.get("PATH_INFO", ""), self.reserved)
+        if rule is None or rule not in self.limiter.rules:
+            return self.app(environ, start_response)
+        allowed, wait = self.limiter.allow(rule, client_identity(environ, self.proxy_hops, self.api_keys))
+        metrics.RATE_LIMITED.labels(rule, "allowed" if allowed else "denied").inc()
+        if allowed:
+            return self.app(environ, start_response)
+        start_response("429 Too Many Requests", [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", "17"),
+            ("Retry-After", str(max(1, int(wait + 0.999))))
+        ])
+        return [b"Too Many Requests"]
+
+
+limiter = TokenBucketLimiter(
+    redis_store,
+    config.RATE_LIMITS,
+    lease=config.RATE_LIMIT_LEASE,
+    lease_ttl=config.RATE_LIMIT_LEASE_TTL
+)
@@ -0,0 +1,134 @@
+import logging
+import re
+import time
+
+from sqlalchemy import exc
+from werkzeug.urls import iri_to_uri
+
+import config
+from bloom import short_url_filter
+from cache import GONE, resolver
+from clicks import click_counter
+from events import click_event
+import metrics
+from shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+# a short code in the path, with or without a trailing slash
+SHORT_PATH = re.compile(r"^/([0-9A-Za-z]{1,16})/?$")
+
+# the redirect statuses a link may use
+REDIRECT_STATUSES = {
+    301: "301 Moved Permanently",
+    302: "302 Found",
+    307: "307 Temporary Redirect",
+    308: "308 Permanent Redirect"
+}
+
+
+def follow(short_url, ip, user_agent, referrer, count=True):
+    """
+    Resolve a short code and record the click.  Expired and archived
+    links are GONE and their clicks are not counted.
+    :return ResolvedURL, GONE or None
+    """
+    with metrics.stage("bloom"):
+        known = short_url_filter.might_contain(short_url)
+    metrics.cache_result("bloom", known)
+    if not known:
+        return None
+    with metrics.stage("resolve"):
+        url = resolver.resolve(short_url)
+    if url is not None and url is not GONE and count:
+        with metrics.stage("record"):
+            click_counter.record(url, click_event(url.short_url, ip, user_agent, referrer))
+    return url
+
+
+def redirect_policy(url):
+    """
+    The status and headers of a resolved URL's redirect, from its own
+    policy or the config defaults.  A max-age of 0 forbids caching so
+    that every click is counted; it never runs past the link's expiry.
+    :return tuple of (status code, list of header tuples)
+    """
+    status = url.redirect_status or config.REDIRECT_STATUS
+    max_age = config.REDIRECT_MAX_AGE if url.cache_max_age is None else url.cache_max_age
+    if url.expires_at is not None:
+        max_age = min(max_age, max(0, int(url.expires_at - time.time())))
+    vary = url.redirect_vary or config.REDIRECT_VARY
+    headers = [
+        ("Location", iri_to_uri(url.full_url, safe_conversion=True)),
+        ("Cache-Control", "public, max-age={}".format(max_age) if max_age > 0 else "no-store")
+    ]
+    if vary:
+        headers.append(("Vary", vary))
+    return status, headers
+
+
+def reserved_segments(app):
+    """
+    The first path segments claimed by the Flask app's own routes, which
+    must never be treated as short codes
+    :return set of str
+    """
+    segments = set()
+    for rule in app.url_map.iter_rules():
+        first = rule.rule.lstrip("/").split("/", 1)[0]
+        if first and "<" not in first:
+            segments.add(first)
+    return segments
+
+
+class Redirector(object):
+    """
+    WSGI middleware that answers short code redirects before the Flask app
+    is reached, so a redirect does no session, user or template work.
+    Unknown codes get a bare 404 and archived ones a 410; other paths and
+    lookup errors are passed through to the wrapped app.  follow can be
+    swapped for another lookup with the same signature.
+    """
+    def __init__(self, app, reserved=(), follow=follow):
+        self.app = app
+        self.reserved = frozenset(reserved)
+        self.follow = follow
+
+    def __call__(self, environ, start_response):
+        method = environ.get("REQUEST_METHOD")
+        match = SHORT_PATH.match(environ.get("PATH_INFO", ""))
+        if method not in ("GET", "HEAD") or match is None or match.group(1) in self.reserved:
+            return self.app(environ, start_response)
+        started = time.perf_counter()
+        try:
+            url = self.follow(
+                match.group(1),
+                environ.get("REMOTE_ADDR"),
+                environ.get("HTTP_USER_AGENT"),
+                environ.get("HTTP_REFERER"),
+                count=method == "GET"
+            )
+        except exc.SQLAlchemyError as db_err:
+            logger.warning("Redirect lookup failed, passing to the app: %s", db_err)
+            return self.app(environ, start_response)
+        finally:
+            shard_router.remove_readers()
+        metrics.REQUEST_LATENCY.labels("redirector", method).observe(time.perf_counter() - started)
+        if url is None:
+            metrics.REDIRECTS.labels("404", "redirector").inc()
+            start_response("404 Not Found", [
+                ("Content-Type", "text/plain"),
+                ("Content-Length", "9")
+            ])
+            return [b"Not Found"]
+        if url is GONE:
+            metrics.REDIRECTS.labels("410", "redirector").inc()
+            start_response("410 Gone", [
+                ("Content-Type", "text/plain"),
+                ("Content-Length", "4")
+            ])
+            return [b"Gone"]
+        status, headers = redirect_policy(url)
+        metrics.REDIRECTS.labels(str(status), "redirector").inc()
+        start_response(REDIRECT_STATUSES[status], headers + [("Content-Length", "0")])
+        return [b""]
@@ -0,0 +1,184 @@
+import bisect
+import hashlib
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import exc, select
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import config
+from database import Base, db_session, engine, make_engine, read_engine, read_session, upgrade_schema
+from models import URL
+
+logger = logging.getLogger(__name__)
+
+# points per shard on the hash ring, more spread the keys more evenly
+RING_POINTS = 128
+
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class Shard(object):
+    """
+    One database holding a share of the urls table, with its own engine
+    and thread local sessions
+    """
+    def __init__(self, index, engine, session, read_engine, read_session):
+        self.index = index
+        self.engine = engine
+        self.session = session
+        self.read_engine = read_engine
+        self.read_session = read_session
+
+    def __repr__(self):
+        return "Shard {}: {}".format(self.index, self.engine.url)
+
+
+class ShardRouter(object):
+    """
+    Place short codes on shards with a consistent hash ring.  Each shard
+    owns RING_POINTS points on the ring named after its index, so adding
+    a shard moves only the codes that now hash to its points, about 1/N.
+    """
+    def __init__(self, shards, points=RING_POINTS):
+        self.shards = list(shards)
+        self._ring = sorted(
+            (_ring_hash("shard-{}-{}".format(shard.index, point)), shard.index)
+            for shard in self.shards for point in range(points)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def index_for(self, short_url):
+        """
+        :return the index of the shard owning a short code
+        """
+        if len(self.shards) == 1:
+            return 0
+        i = bisect.bisect(self._keys, _ring_hash(short_url)) % len(self._ring)
+        return self._ring[i][1]
+
+    def shard_for(self, short_url):
+        return self.shards[self.index_for(short_url)]
+
+    def session_for(self, short_url):
+        return self.shard_for(short_url).session
+
+    def read_session_for(self, short_url):
+        return self.shard_for(short_url).read_session
+
+    def group(self, items, key=None):
+        """
+        Split short codes, or items whose short code is key(item), by shard
+        :return OrderedDict of Shard -> list
+        """
+        groups = OrderedDict()
+        for item in items:
+            short_url = item if key is None else key(item)
+            groups.setdefault(self.shard_for(short_url), []).append(item)
+        return groups
+
+    def remove(self):
+        """
+        Close every shard's thread local sessions
+        """
+        for shard in self.shards:
+            shard.session.remove()
+            shard.read_session.remove()
+
+    def rollback(self):
+        """
+        Roll back every shard's thread local session
+        """
+        for shard in self.shards:
+            shard.session.rollback()
+
+    def remove_readers(self):
+        """
+        Close every shard's thread local read sessions
+        """
+        for shard in self.shards:
+            shard.read_session.remove()
+
+
+def _scoped(bind):
+    return scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=bind))
+
+
+def make_router(uris):
+    """
+    Build the router for the primary database plus any extra shard URIs.
+    Shard 0 is the primary, which also keeps every table other than urls.
+    :return ShardRouter
+    """
+    shards = [Shard(0, engine, db_session, read_engine, read_session)]
+    for index, uri in enumerate(uris, start=1):
+        shard_engine = make_engine(uri)
+        shards.append(Shard(index, shard_engine, _scoped(shard_engine), shard_engine, _scoped(shard_engine)))
+    return ShardRouter(shards)
+
+
+def init_shards(router):
+    """
+    Create the schema on every shard, adding any columns and indexes that
+    tables from an older release are missing
+    """
+    for shard in router:
+        Base.metadata.create_all(bind=shard.engine)
+        for added in upgrade_schema(Base.metadata, shard.engine):
+            logger.info("Added %s to shard %s", added, shard.index)
+
+
+shard_router = make_router(config.URL_SHARDS)
+
+
+def rebalance(router, batch_size=1000, dry_run=False, on_moved=None):
+    """
+    Move every urls row not on the shard its short code now maps to, for
+    use offline after adding a shard.  Rows are copied in batches, given
+    a new id by their new shard, then deleted from the old one; a copy
+    left by an interrupted run is kept and the original deleted.
+    on_moved is called with the short codes of each batch moved.
+    :return dict of (from shard, to shard) -> rows moved
+    """
+    table = URL.__table__
+    moved = {}
+    for source in router:
+        last_id = 0
+        while True:
+            with source.engine.connect() as conn:
+                rows = conn.execute(select([table]).where(
+                    table.c.id > last_id).order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            groups = router.group([row for row in rows if row["short_url"] is not None
+                                   and router.index_for(row["short_url"]) != source.index],
+                                  key=lambda row: row["short_url"])
+            for target, strays in groups.items():
+                moved[source.index, target.index] = moved.get((source.index, target.index), 0) + len(strays)
+                if dry_run:
+                    continue
+                copies = [{name: value for name, value in row.items() if name != "id"} for row in strays]
+                try:
+                    with target.engine.begin() as conn:
+                        conn.execute(table.insert(), copies)
+                except exc.IntegrityError:
+                    for copy in copies:
+                        try:
+                            with target.engine.begin() as conn:
+                                conn.execute(table.insert(), [copy])
+                        except exc.IntegrityError:
+                            logger.info("%s is already on shard %s", copy["short_url"], target.index)
+                with source.engine.begin() as conn:
+                    conn.execute(table.delete().where(table.c.id.in_([row["id"] for row in strays])))
+                if on_moved is not None:
+                    on_moved([row["short_url"] for row in strays])
+    return moved
@@ -0,0 +1,276 @@
+import datetime
+import gzip
+import heapq
+import logging
+import mmap
+import struct
+from contextlib import ExitStack
+
+from sqlalchemy import exc, select
+
+from cache import ResolvedURL
+from models import URL
+
+logger = logging.getLogger(__name__)
+
+# file header: magic, format version, the code counter at export time
+MAGIC = b"SHRT"
+VERSION = 3
+HEADER = struct.Struct("<4sBq")
+
+# per row: id, user_id, clicks, created (microseconds since the epoch),
+# redirect status, cache max-age, expires_at (microseconds since the
+# epoch), max clicks, flags, then the byte length of each string column,
+# then the strings
+RECORD = struct.Struct("<qqiqiiqiB7H")
+STRINGS = ("short_url", "full_url", "full_hash", "normalized_hash", "global_id", "name", "redirect_vary")
+COLUMNS = ("id", "user_id", "clicks", "created_on_date", "redirect_status", "cache_max_age",
+           "expires_at", "max_clicks", "archived", "is_url_active") + STRINGS
+
+# sentinels for NULL columns
+NULL_INT = -1 << 63
+NULL_SMALL = -1
+NULL_LENGTH = 0xFFFF
+
+ARCHIVED = 1
+ACTIVE = 2
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def open_snapshot(path, mode):
+    """
+    Open a snapshot file, gzip compressed if its name ends in .gz
+    :return file object
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=6)
+    return open(path, mode)
+
+
+def pack_row(row):
+    """
+    Encode one urls row
+    :return bytes
+    """
+    strings = [None if row[name] is None else row[name].encode("utf-8") for name in STRINGS]
+    flags = (ARCHIVED if row["archived"] else 0) | (ACTIVE if row["is_url_active"] is not False else 0)
+    created = row["created_on_date"]
+    expires = row["expires_at"]
+    return RECORD.pack(
+        row["id"],
+        NULL_INT if row["user_id"] is None else row["user_id"],
+        row["clicks"] or 0,
+        NULL_INT if created is None else (created - EPOCH) // datetime.timedelta(microseconds=1),
+        NULL_SMALL if row["redirect_status"] is None else row["redirect_status"],
+        NULL_SMALL if row["cache_max_age"] is None else row["cache_max_age"],
+        NULL_INT if expires is None else (expires - EPOCH) // datetime.timedelta(microseconds=1),
+        NULL_SMALL if row["max_clicks"] is None else row["max_clicks"],
+        flags,
+        *[NULL_LENGTH if value is None else len(value) for value in strings]
+    ) + b"".join(value for value in strings if value)
+
+
+def unpack_row(buffer, offset):
+    """
+    Decode the row starting at offset
+    :return tuple of (row dict, offset of the next row)
+    """
+    id, user_id, clicks, created, status, max_age, expires, max_clicks, flags, *lengths = RECORD.unpack_from(
+        buffer, offset)
+    offset += RECORD.size
+    row = {
+        "id": id,
+        "user_id": None if user_id == NULL_INT else user_id,
+        "clicks": clicks,
+        "created_on_date": None if created == NULL_INT else EPOCH + datetime.timedelta(microseconds=created),
+        "redirect_status": None if status == NULL_SMALL else status,
+        "cache_max_age": None if max_age == NULL_SMALL else max_age,
+        "expires_at": None if expires == NULL_INT else EPOCH + datetime.timedelta(microseconds=expires),
+        "max_clicks": None if max_clicks == NULL_SMALL else max_clicks,
+        "archived": bool(flags & ARCHIVED),
+        "is_url_active": bool(flags & ACTIVE)
+    }
+    for name, length in zip(STRINGS, lengths):
+        if length == NULL_LENGTH:
+            row[name] = None
+        else:
+            row[name] = bytes(buffer[offset:offset + length]).decode("utf-8")
+            offset += length
+    return row, offset
+
+
+def _stream(result, batch_size):
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def write_snapshot(shards, fileobj, counter=0, batch_size=10000):
+    """
+    Stream every urls row of every shard into a snapshot, the most clicked
+    first so a partial read warms the hottest links
+    :return number of rows written
+    """
+    fileobj.write(HEADER.pack(MAGIC, VERSION, counter))
+    query = select([getattr(URL.__table__.c, name) for name in COLUMNS]).order_by(
+        URL.clicks.desc(), URL.id.desc())
+    written = 0
+    with ExitStack() as stack:
+        streams = [
+            _stream(stack.enter_context(shard.engine.connect()).execution_options(
+                stream_results=True).execute(query), batch_size)
+            for shard in shards
+        ]
+        batch = []
+        for row in heapq.merge(*streams, key=lambda row: (row["clicks"] or 0, row["id"]), reverse=True):
+            batch.append(pack_row(row))
+            if len(batch) >= batch_size:
+                fileobj.write(b"".join(batch))
+                written += len(batch)
+                batch = []
+        fileobj.write(b"".join(batch))
+        written += len(batch)
+    return written
+
+
+def read_header(header):
+    """
+    Check a snapshot header
+    :return the code counter recorded at export time
+    :raise ValueError
+    """
+    if len(header) < HEADER.size:
+        raise ValueError("Not a shorty snapshot")
+    magic, version, counter = HEADER.unpack_from(header)
+    if magic != MAGIC:
+        raise ValueError("Not a shorty snapshot")
+    if version != VERSION:
+        raise ValueError("Unsupported snapshot version {}".format(version))
+    return counter
+
+
+def read_snapshot(fileobj):
+    """
+    Stream the rows of a snapshot, compressed or not
+    :return tuple of (code counter, generator of row dicts)
+    """
+    counter = read_header(fileobj.read(HEADER.size))
+
+    def rows():
+        while True:
+            fixed = fileobj.read(RECORD.size)
+            if not fixed:
+                return
+            lengths = RECORD.unpack(fixed)[9:]
+            strings = fileobj.read(sum(length for length in lengths if length != NULL_LENGTH))
+            yield unpack_row(fixed + strings, 0)[0]
+
+    return counter, rows()
+
+
+class SnapshotTable(object):
+    """
+    A read-only view of an uncompressed snapshot through mmap.  Rows are
+    decoded as they are read, and the pages are shared by every process
+    mapping the same file.
+    """
+    def __init__(self, path):
+        if path.endswith(".gz"):
+            raise ValueError("Compressed snapshots cannot be mapped, export without .gz")
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.counter = read_header(self.buffer)
+
+    def __iter__(self):
+        offset = HEADER.size
+        end = len(self.buffer)
+        while offset < end:
+            row, offset = unpack_row(self.buffer, offset)
+            yield row
+
+    def resolved(self, limit=None):
+        """
+        The live, unexpired rows in file order, as the resolver caches them
+        :return generator of ResolvedURL
+        """
+        count = 0
+        now = datetime.datetime.now()
+        for row in self:
+            if limit is not None and count >= limit:
+                return
+            if row["archived"] or not row["is_url_active"]:
+                continue
+            if row["expires_at"] is not None and row["expires_at"] <= now:
+                continue
+            if row["max_clicks"] is not None and row["clicks"] >= row["max_clicks"]:
+                continue
+            count += 1
+            yield ResolvedURL(row["id"], row["short_url"], row["full_url"],
+                              row["redirect_status"], row["cache_max_age"], row["redirect_vary"],
+                              None if row["expires_at"] is None else row["expires_at"].timestamp(),
+                              row["max_clicks"], row["clicks"])
+
+    def close(self):
+        self.buffer.close()
+
+
+def import_rows(shards, rows, chunk_size, on_chunk=None):
+    """
+    Insert snapshot rows in large transactions, one executemany per shard
+    each.  Rows get new ids, the exported ones may be taken here or, from
+    a sharded export, repeat.  A chunk that conflicts with existing rows is
+    retried row by row; rows whose short code is already here are skipped
+    and any other conflict is logged and counted as failed.  on_chunk is
+    called with the short codes of each chunk before it is inserted.
+    :return tuple of (rows inserted, rows skipped, rows failed)
+    """
+    table = URL.__table__
+    totals = [0, 0, 0]
+    chunk = []
+    for row in rows:
+        row["modified_date"] = row["created_on_date"]
+        del row["id"]
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            _insert_chunk(shards, table, chunk, on_chunk, totals)
+            chunk = []
+    if chunk:
+        _insert_chunk(shards, table, chunk, on_chunk, totals)
+    return tuple(totals)
+
+
+def _insert_chunk(shards, table, chunk, on_chunk, totals):
+    if on_chunk is not None:
+        on_chunk([row["short_url"] for row in chunk])
+    for shard, shard_chunk in shards.group(chunk, key=lambda row: row["short_url"]).items():
+        for i, count in enumerate(_insert_shard(shard.engine, table, shard_chunk)):
+            totals[i] += count
+
+
+def _insert_shard(bind, table, chunk):
+    try:
+        with bind.begin() as conn:
+            conn.execute(table.insert(), chunk)
+        return len(chunk), 0, 0
+    except exc.IntegrityError:
+        pass
+    inserted = skipped = failed = 0
+    for row in chunk:
+        try:
+            with bind.begin() as conn:
+                conn.execute(table.insert(), [row])
+            inserted += 1
+        except exc.IntegrityError as err:
+            with bind.connect() as conn:
+                existing = conn.execute(select([table.c.id]).where(
+                    table.c.short_url == row["short_url"]).limit(1)).first()
+            if existing is not None:
+                skipped += 1
+            else:
+                failed += 1
+                logger.warning("Could not import %s: %s", row["short_url"], err.orig)
+    return inserted, skipped, failed
@@ -1 +1,187 @@
-# tasks.py
\ No newline at end of file
+# tasks.py
+import datetime
+import random
+import time
+import requests
+from app import create_app
+from celery_app import celery
+from analytics import click_analytics
+from archive import archiver
+from clicks import click_counter
+from database import db_session
+from events import classify_visitors, visitor_ingestor
+from cache import forget_urls, redis_store
+from linkcheck import fetch_title, link_checker
+from models import URL
+from shards import shard_router
+from urlindex import build_index
+import config
+
+app = create_app("worker")
+
+
+# tasks sections, for async functions, etc...
+@celery.task(serializer="pickle")
+def send_async_email(msg):
+    """Background task to send an email with Flask-Mailman."""
+    with app.app_context():
+        msg.send()
+        app.logger.info("Sending email as background task.")
+
+
+@celery.task(bind=True)
+def long_task(self):
+    """Background task that runs a long function with progress reports."""
+    verb = ["Starting up", "Booting", "Repairing", "Loading", "Checking", "Resolving"]
+    adjective = ["master", "radiant", "silent", "harmonic", "fast", "network nodes"]
+    noun = ["solar array", "particle reshaper", "cosmic ray", "orbiter", "bit"]
+    message = ""
+    total = random.randint(10, 500)
+    for i in range(total):
+        if not message or random.random() < 0.25:
+            message = "{0} {1} {2}...".format(random.choice(verb),
+                                              random.choice(adjective),
+                                              random.choice(noun))
+        
+        self.update_state(
+            state =  "PROGRESS", 
+            meta = {
+                "current": i, 
+                "total": total,
+                "status": message
+            }
+        )
+        # log the result
+        app.logger.info("Comms %s Received New Message: %s", i, message)
+        time.sleep(0.25)
+    
+    return {
+            "current": 100, 
+            "total": 100, 
+            "status": "Task completed!",
+            "result": total
+            }
+
+
+@celery.task
+def flush_clicks():
+    """Periodic task to write buffered click counts to the urls table."""
+    try:
+        flushed = click_counter.flush()
+        if flushed:
+            app.logger.info("Flushed %s buffered clicks.", flushed)
+        return flushed
+    finally:
+        shard_router.remove()
+
+
+@celery.task
+def ingest_visitors():
+    """Periodic task to drain the click event stream into the visitors table."""
+    try:
+        written = visitor_ingestor.ingest(config.VISITOR_INGEST_MAX_BATCHES)
+        if written:
+            app.logger.info("Ingested %s click events.", written)
+        return written
+    finally:
+        db_session.remove()
+
+
+@celery.task
+def process_visitors():
+    """Periodic task to claim, classify and complete ingested visitors."""
+    try:
+        processed = classify_visitors(
+            db_session,
+            config.VISITOR_PROCESS_BATCH_SIZE,
+            config.VISITOR_PROCESS_MAX_BATCHES,
+            config.VISITOR_CLAIM_TIMEOUT
+        )
+        if processed:
+            app.logger.info("Processed %s visitors.", processed)
+        return processed
+    finally:
+        db_session.remove()
+
+
+@celery.task
+def fetch_url_title(short_url):
+    """Background task to fetch a new URL's page title and check it is up."""
+    session = shard_router.session_for(short_url)
+    try:
+        url = session.query(URL).filter(URL.short_url == short_url).first()
+        if url is None:
+            return None
+        try:
+            status, title = fetch_title(url.full_url)
+        except requests.RequestException as err:
+            app.logger.info("HTTP call to: %s failed: %s", url.full_url, err)
+            status, title = None, None
+        if title:
+            url.name = title[:500]
+        url.url_last_checked_datetime = datetime.datetime.now()
+        # a failed first fetch counts towards the same limit as the sweep
+        url.check_failures, url.is_url_active = link_checker.outcome(status, url.check_failures)
+        url.check_status = status
+        session.commit()
+        app.logger.info("HTTP call to: %s returned Status: %s", url.full_url, status)
+        return status
+    finally:
+        session.remove()
+
+
+@celery.task
+def rollup_clicks():
+    """Periodic task to write minute click buckets and compact old ones."""
+    try:
+        minutes = click_analytics.flush()
+        removed = click_analytics.compact()
+        if minutes or removed:
+            app.logger.info("Rolled up %s minutes of clicks, compacted %s buckets.", minutes, removed)
+        return minutes
+    finally:
+        db_session.remove()
+
+
+@celery.task
+def check_links():
+    """Periodic task to re-validate the least recently checked links."""
+    lock = redis_store.lock("shorty:linkcheck:lock", timeout=config.LINK_CHECK_INTERVAL * 5, blocking_timeout=0)
+    if not lock.acquire():
+        return 0
+    try:
+        rows = link_checker.due(config.LINK_CHECK_BATCH_SIZE, config.LINK_CHECK_MIN_AGE)
+        checked = link_checker.check(rows)
+        if checked:
+            app.logger.info("Checked %s links.", checked)
+        return checked
+    finally:
+        lock.release()
+        shard_router.remove()
+
+
+@celery.task
+def build_url_index():
+    """Periodic task to rebuild the mapped short code index for edge nodes."""
+    try:
+        written = build_index(shard_router, config.URL_INDEX_PATH)
+        app.logger.info("Indexed %s short codes.", written)
+        return written
+    finally:
+        shard_router.remove()
+
+
+@celery.task
+def archive_links():
+    """Periodic task to move expired and archived links to the archive."""
+    lock = redis_store.lock("shorty:archive:lock", timeout=config.ARCHIVE_INTERVAL * 5, blocking_timeout=0)
+    if not lock.acquire():
+        return 0
+    try:
+        moved = archiver.run(config.ARCHIVE_MAX_BATCHES, on_moved=forget_urls)
+        if moved:
+            app.logger.info("Archived %s links.", sum(moved.values()))
+        return sum(moved.values())
+    finally:
+        lock.release()
+        shard_router.remove()
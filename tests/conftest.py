@@ -0,0 +1,52 @@
+import os
+import sys
+
+# the modules configure their engines on import, so point them at memory
+# before any of them is loaded
+os.environ.setdefault("SHORTY_DATABASE_URI", "sqlite://")
+os.environ.setdefault("SHORTY_ARCHIVE_DATABASE_URI", "sqlite://")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from database import Base, make_engine
+from models import URL
+from shards import Shard, ShardRouter, _scoped
+
+
+def make_shards(count):
+    """
+    Build a router over count empty in-memory databases
+    :return ShardRouter
+    """
+    shards = []
+    for index in range(count):
+        engine = make_engine("sqlite://")
+        Base.metadata.create_all(bind=engine)
+        shards.append(Shard(index, engine, _scoped(engine), engine, _scoped(engine)))
+    return ShardRouter(shards)
+
+
+def add_urls(router, rows):
+    """
+    Insert a urls row for each short code -> column values in rows, on
+    the shard that owns the code
+    """
+    for short_url, columns in rows.items():
+        session = router.session_for(short_url)
+        session.add(URL(short_url=short_url, **columns))
+        session.commit()
+
+
+@pytest.fixture
+def shards():
+    router = make_shards(1)
+    yield router
+    router.remove()
+
+
+@pytest.fixture
+def sharded():
+    router = make_shards(3)
+    yield router
+    router.remove()
@@ -0,0 +1,71 @@
+import datetime
+
+import pytest
+from sqlalchemy import select
+
+from archive import ArchiveStore, Archiver, archived_urls, due_clauses, live_clause
+from conftest import add_urls
+from database import make_engine
+from models import URL
+
+NOW = datetime.datetime(2026, 1, 1, 12, 0)
+HOUR = datetime.timedelta(hours=1)
+
+ROWS = {
+    "plain": {},
+    "future": {"expires_at": NOW + HOUR},
+    "past": {"expires_at": NOW - HOUR},
+    "deadline": {"expires_at": NOW},
+    "under": {"clicks": 4, "max_clicks": 5},
+    "unclicked": {"max_clicks": 1},
+    "reached": {"clicks": 5, "max_clicks": 5},
+    "over": {"clicks": 6, "max_clicks": 5},
+    "archived": {"archived": True},
+    "both": {"clicks": 9, "max_clicks": 1, "expires_at": NOW - HOUR},
+}
+
+
+def matching(router, clause):
+    return {row.short_url for shard in router for row in shard.session.query(URL.short_url).filter(clause)}
+
+
+@pytest.fixture
+def rows(sharded):
+    add_urls(sharded, {short_url: dict(columns, full_url="http://example.com/" + short_url)
+                       for short_url, columns in ROWS.items()})
+    return sharded
+
+
+def test_live_clause(rows):
+    assert matching(rows, live_clause(NOW)) == {"plain", "future", "under", "unclicked", "archived"}
+
+
+def test_due_clauses_by_reason(rows):
+    due = {reason: matching(rows, clause) for reason, clause in due_clauses(NOW)}
+    assert due == {
+        "archived": {"archived"},
+        "expired": {"past", "deadline", "both"},
+        "max_clicks": {"reached", "over", "both"}
+    }
+
+
+def test_expired_links_are_exactly_the_ones_not_live(rows):
+    expired = set().union(*(matching(rows, clause) for reason, clause in due_clauses(NOW) if reason != "archived"))
+    assert expired == set(ROWS) - matching(rows, live_clause(NOW))
+
+
+def test_run_moves_due_links_to_the_archive(rows):
+    store = ArchiveStore(make_engine("sqlite://"))
+    store.create()
+    archiver = Archiver(rows, store, batch_size=2, vacuum_free_ratio=0.25, vacuum_min_pages=1000)
+    moved = []
+    assert sum(archiver.run(now=NOW, on_moved=moved.extend).values()) == 6
+    assert sorted(moved) == ["archived", "both", "deadline", "over", "past", "reached"]
+    kept = {row.short_url for shard in rows for row in shard.session.query(URL.short_url)}
+    assert kept == {"plain", "future", "under", "unclicked"}
+    with store.engine.connect() as conn:
+        archived = dict(conn.execute(select([archived_urls.c.short_url, archived_urls.c.archive_reason])).fetchall())
+    assert archived == {"archived": "archived", "past": "expired", "deadline": "expired", "both": "expired",
+                        "reached": "max_clicks", "over": "max_clicks"}
+    assert store.contains("past") and not store.contains("plain")
+    assert archiver.run(now=NOW) == {}
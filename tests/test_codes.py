@@ -0,0 +1,67 @@
+import pytest
+
+import config
+from codes import CodeGenerator, DatabaseBlockAllocator
+from database import Base, make_engine
+
+
+def scrambled(length, allocator=None, block_size=10):
+    return CodeGenerator(allocator, length, block_size,
+                         config.CODE_SCRAMBLE_MULTIPLIER, config.CODE_SCRAMBLE_OFFSET)
+
+
+def test_scramble_is_a_bijection_of_the_code_space():
+    generator = scrambled(2)
+    codes = [generator.encode(n) for n in range(generator.space)]
+    assert len(set(codes)) == generator.space
+    assert all(len(code) == 2 for code in codes)
+    assert [generator.decode(code) for code in codes] == list(range(generator.space))
+
+
+def test_scramble_round_trips_full_length_codes():
+    generator = scrambled(config.CODE_LENGTH)
+    ids = [0, 1, 2, 61, 62, 999, 123456789, generator.space - 1]
+    codes = [generator.encode(n) for n in ids]
+    assert len(set(codes)) == len(ids)
+    assert [generator.decode(code) for code in codes] == ids
+
+
+def test_scramble_hides_the_order_of_consecutive_ids():
+    generator = scrambled(config.CODE_LENGTH)
+    codes = [generator.encode(n) for n in range(100)]
+    assert codes != sorted(codes)
+
+
+def test_plain_codes_are_padded_base62():
+    generator = CodeGenerator(None, 4, 10)
+    assert generator.encode(0) == "0000"
+    assert generator.encode(62) == "0010"
+    assert generator.decode("0010") == 62
+
+
+def test_exhausted_space_and_foreign_codes_are_rejected():
+    generator = scrambled(2)
+    with pytest.raises(ValueError):
+        generator.encode(generator.space)
+    with pytest.raises(ValueError):
+        generator.decode("abc")
+    with pytest.raises(ValueError):
+        generator.decode("a-")
+
+
+def test_multiplier_must_be_coprime_to_62():
+    with pytest.raises(ValueError):
+        CodeGenerator(None, 7, 10, multiplier=62)
+    with pytest.raises(ValueError):
+        CodeGenerator(None, 7, 10, multiplier=31)
+
+
+def test_take_leases_new_blocks_without_repeating_codes():
+    engine = make_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    allocator = DatabaseBlockAllocator(engine)
+    first = scrambled(3, allocator, block_size=4)
+    second = scrambled(3, allocator, block_size=4)
+    codes = first.take(3) + second.take(6) + first.take(5)
+    assert len(set(codes)) == len(codes) == 14
+    assert allocator.high_water() == 4 + 6 + 4
@@ -0,0 +1,60 @@
+from conftest import add_urls
+from listing import parse_cursor, url_page
+
+
+def fill(router, count):
+    # few distinct click counts, so most rows tie and the cursor has to
+    # break ties across shards
+    add_urls(router, {"c{:03d}".format(i): {"clicks": i % 4} for i in range(count)})
+
+
+def walk_forward(router, per_page):
+    pages = []
+    rows, next_cursor, prev_cursor = url_page(router, per_page)
+    assert prev_cursor is None
+    pages.append((rows, prev_cursor))
+    while next_cursor is not None:
+        rows, next_cursor, prev_cursor = url_page(router, per_page, after=parse_cursor(next_cursor))
+        assert prev_cursor is not None
+        pages.append((rows, prev_cursor))
+    return pages
+
+
+def test_pages_cover_every_row_once_most_clicked_first(sharded):
+    fill(sharded, 23)
+    pages = walk_forward(sharded, 5)
+    assert [len(rows) for rows, _ in pages] == [5, 5, 5, 5, 3]
+    codes = [row.short_url for rows, _ in pages for row in rows]
+    assert sorted(codes) == ["c{:03d}".format(i) for i in range(23)]
+    keys = [(row.clicks or 0, row.shard, row.id) for rows, _ in pages for row in rows]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_previous_cursor_returns_the_page_before(sharded):
+    fill(sharded, 23)
+    pages = walk_forward(sharded, 5)
+    for (before_rows, _), (_, prev_cursor) in zip(pages, pages[1:]):
+        rows, next_cursor, _ = url_page(sharded, 5, before=parse_cursor(prev_cursor))
+        assert [row.short_url for row in rows] == [row.short_url for row in before_rows]
+        assert next_cursor is not None
+
+
+def test_first_page_reached_backwards_has_no_previous_cursor(shards):
+    fill(shards, 6)
+    first, next_cursor, _ = url_page(shards, 3)
+    second, _, prev_cursor = url_page(shards, 3, after=parse_cursor(next_cursor))
+    rows, _, prev_cursor = url_page(shards, 3, before=parse_cursor(prev_cursor))
+    assert [row.short_url for row in rows] == [row.short_url for row in first]
+    assert prev_cursor is None
+
+
+def test_empty_listing(sharded):
+    assert url_page(sharded, 5) == ([], None, None)
+
+
+def test_parse_cursor():
+    assert parse_cursor("3.1.42") == (3, 1, 42)
+    assert parse_cursor("3.42") == (3, 0, 42)
+    assert parse_cursor("") is None
+    assert parse_cursor("3.x") is None
+    assert parse_cursor("1.2.3.4") is None
@@ -0,0 +1,44 @@
+from collections import Counter
+
+from shards import Shard, ShardRouter
+
+CODES = ["code{}".format(i) for i in range(6000)]
+
+
+def router(count):
+    return ShardRouter(Shard(index, None, None, None, None) for index in range(count))
+
+
+def test_single_shard_owns_everything():
+    single = router(1)
+    assert {single.index_for(code) for code in CODES[:100]} == {0}
+
+
+def test_placement_is_stable_across_routers():
+    first, second = router(4), router(4)
+    assert [first.index_for(code) for code in CODES] == [second.index_for(code) for code in CODES]
+
+
+def test_codes_spread_over_every_shard():
+    four = router(4)
+    counts = Counter(four.index_for(code) for code in CODES)
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > len(CODES) / 4 * 0.7
+
+
+def test_adding_a_shard_only_moves_codes_to_it():
+    before, after = router(3), router(4)
+    moved = [code for code in CODES if before.index_for(code) != after.index_for(code)]
+    assert {after.index_for(code) for code in moved} == {3}
+    assert len(CODES) / 4 * 0.7 < len(moved) < len(CODES) / 4 * 1.3
+
+
+def test_group_splits_by_owning_shard_in_order():
+    three = router(3)
+    rows = [{"short_url": code, "n": n} for n, code in enumerate(CODES[:50])]
+    groups = three.group(rows, key=lambda row: row["short_url"])
+    assert sum(len(items) for items in groups.values()) == len(rows)
+    for shard, items in groups.items():
+        assert all(three.shard_for(row["short_url"]) is shard for row in items)
+        assert [row["n"] for row in items] == sorted(row["n"] for row in items)
+    assert list(three.group(CODES[:3])) == list(dict.fromkeys(three.shard_for(code) for code in CODES[:3]))
@@ -0,0 +1,115 @@
+import datetime
+import io
+
+import pytest
+
+from conftest import add_urls, make_shards
+from models import URL
+from snapshot import SnapshotTable, import_rows, open_snapshot, read_snapshot, write_snapshot
+
+NOW = datetime.datetime.now().replace(microsecond=0)
+
+ROWS = {
+    "hot": {"user_id": 1, "full_url": "http://example.com/hot", "clicks": 50, "created_on_date": NOW,
+            "redirect_status": 301, "cache_max_age": 3600, "redirect_vary": "Accept-Language",
+            "name": "Hot ☃", "full_hash": "h1", "normalized_hash": "n1"},
+    "warm": {"full_url": "http://example.com/warm", "clicks": 10, "max_clicks": 100,
+             "expires_at": NOW + datetime.timedelta(days=1)},
+    "capped": {"full_url": "http://example.com/capped", "clicks": 7, "max_clicks": 7},
+    "expired": {"full_url": "http://example.com/expired", "clicks": 3,
+                "expires_at": NOW - datetime.timedelta(days=1)},
+    "archived": {"full_url": "http://example.com/archived", "clicks": 2, "archived": True},
+    "inactive": {"full_url": "http://example.com/inactive", "clicks": 1, "is_url_active": False},
+    "cold": {"full_url": "http://example.com/cold", "clicks": 0},
+}
+
+
+def export(router, path, counter=0):
+    with open_snapshot(str(path), "wb") as f:
+        return write_snapshot(router, f, counter=counter, batch_size=2)
+
+
+def stored(router):
+    rows = {}
+    for shard in router:
+        for url in shard.session.query(URL):
+            rows[url.short_url] = url
+    return rows
+
+
+@pytest.fixture
+def source(sharded):
+    add_urls(sharded, ROWS)
+    return sharded
+
+
+@pytest.mark.parametrize("name", ["urls.snap", "urls.snap.gz"])
+def test_round_trip_keeps_every_column(source, tmp_path, name):
+    assert export(source, tmp_path / name, counter=1234) == len(ROWS)
+    with open_snapshot(str(tmp_path / name), "rb") as f:
+        counter, rows = read_snapshot(f)
+        rows = list(rows)
+    assert counter == 1234
+    assert [row["clicks"] for row in rows] == sorted((row["clicks"] for row in rows), reverse=True)
+    by_code = {row["short_url"]: row for row in rows}
+    assert set(by_code) == set(ROWS)
+    for short_url, columns in ROWS.items():
+        for name, value in columns.items():
+            assert by_code[short_url][name] == value, (short_url, name)
+    assert by_code["cold"]["user_id"] is None
+    assert by_code["cold"]["redirect_vary"] is None
+    assert by_code["hot"]["is_url_active"] and not by_code["hot"]["archived"]
+
+
+def test_mapped_table_reads_the_same_rows(source, tmp_path):
+    export(source, tmp_path / "urls.snap", counter=9)
+    with open(str(tmp_path / "urls.snap"), "rb") as f:
+        _, rows = read_snapshot(f)
+        rows = list(rows)
+    table = SnapshotTable(str(tmp_path / "urls.snap"))
+    try:
+        assert table.counter == 9
+        assert list(table) == rows
+        resolved = list(table.resolved())
+        assert [url.short_url for url in resolved] == ["hot", "warm", "cold"]
+        assert resolved[0].redirect_status == 301
+        assert resolved[1].expires_at == ROWS["warm"]["expires_at"].timestamp()
+        assert [url.short_url for url in table.resolved(limit=1)] == ["hot"]
+    finally:
+        table.close()
+
+
+def test_compressed_snapshots_cannot_be_mapped(source, tmp_path):
+    export(source, tmp_path / "urls.snap.gz")
+    with pytest.raises(ValueError):
+        SnapshotTable(str(tmp_path / "urls.snap.gz"))
+
+
+def test_bad_headers_are_rejected():
+    with pytest.raises(ValueError):
+        read_snapshot(io.BytesIO(b"SHR"))
+    with pytest.raises(ValueError):
+        read_snapshot(io.BytesIO(b"NOPE" + bytes(9)))
+
+
+def test_import_gives_new_ids_and_skips_codes_already_present(source, tmp_path):
+    export(source, tmp_path / "urls.snap")
+    target = make_shards(2)
+    # takes the ids the export used, under a code of its own
+    add_urls(target, {"local{}".format(i): {"full_url": "http://example.com/local"} for i in range(len(ROWS))})
+    chunks = []
+
+    def load():
+        with open(str(tmp_path / "urls.snap"), "rb") as f:
+            _, rows = read_snapshot(f)
+            return import_rows(target, rows, chunk_size=3, on_chunk=chunks.append)
+
+    assert load() == (len(ROWS), 0, 0)
+    assert sum(len(chunk) for chunk in chunks) == len(ROWS)
+    imported = stored(target)
+    assert len(imported) == 2 * len(ROWS)
+    for short_url, columns in ROWS.items():
+        assert imported[short_url].full_url == columns["full_url"]
+        assert imported[short_url].modified_date == imported[short_url].created_on_date
+    assert load() == (0, len(ROWS), 0)
+    target.remove()
@@ -0,0 +1,78 @@
+import datetime
+import os
+import time
+
+import pytest
+
+from cache import GONE
+from conftest import add_urls
+from urlindex import MappedIndex, build_index
+
+NOW = datetime.datetime.now().replace(microsecond=0)
+TOMORROW = NOW + datetime.timedelta(days=1)
+
+ROWS = {
+    "plain": {"full_url": "http://example.com/plain"},
+    "policy": {"full_url": "http://example.com/ünïcode", "redirect_status": 308, "cache_max_age": 60,
+               "redirect_vary": "Accept"},
+    "expiring": {"full_url": "http://example.com/expiring", "expires_at": TOMORROW},
+    "capped": {"full_url": "http://example.com/capped", "clicks": 2, "max_clicks": 3},
+    "spent": {"full_url": "http://example.com/spent", "clicks": 3, "max_clicks": 3},
+    "expired": {"full_url": "http://example.com/expired", "expires_at": NOW - datetime.timedelta(days=1)},
+    "archived": {"full_url": "http://example.com/archived", "archived": True},
+    "inactive": {"full_url": "http://example.com/inactive", "is_url_active": False},
+}
+
+
+@pytest.fixture
+def index(sharded, tmp_path):
+    add_urls(sharded, ROWS)
+    path = str(tmp_path / "urls.idx")
+    assert build_index(sharded, path, batch_size=2) == 4
+    return MappedIndex(path)
+
+
+def test_round_trip_of_live_links(index):
+    assert len(index) == 4
+    plain = index.resolve("plain")
+    assert plain.full_url == "http://example.com/plain"
+    assert (plain.redirect_status, plain.cache_max_age, plain.redirect_vary) == (None, None, None)
+    assert (plain.expires_at, plain.max_clicks, plain.clicks) == (None, None, 0)
+    policy = index.resolve("policy")
+    assert policy.short_url == "policy"
+    assert policy.full_url == "http://example.com/ünïcode"
+    assert (policy.redirect_status, policy.cache_max_age, policy.redirect_vary) == (308, 60, "Accept")
+    assert index.resolve("expiring").expires_at == int(TOMORROW.timestamp())
+    capped = index.resolve("capped")
+    assert (capped.max_clicks, capped.clicks) == (3, 2)
+
+
+def test_dead_and_unknown_codes_are_not_indexed(index):
+    for short_url in ("spent", "expired", "archived", "inactive", "missing", "plai", "plainer", "ünï"):
+        assert index.resolve(short_url) is None
+
+
+def test_links_expiring_after_the_build_are_gone(index, monkeypatch):
+    later = TOMORROW.timestamp() + 1
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert index.resolve("expiring") is GONE
+    assert index.resolve("plain").full_url == "http://example.com/plain"
+
+
+def test_rebuilt_index_is_picked_up(sharded, index):
+    index.check_interval = 0
+    add_urls(sharded, {"added": {"full_url": "http://example.com/added"}})
+    assert index.resolve("added") is None
+    build_index(sharded, index.path)
+    assert index.resolve("added").full_url == "http://example.com/added"
+    assert len(index) == 5
+
+
+def test_unreadable_replacement_keeps_the_mapped_index(index, tmp_path):
+    index.check_interval = 0
+    bad = tmp_path / "bad.idx"
+    bad.write_bytes(b"not an index, but long enough to unpack a header")
+    os.replace(str(bad), index.path)
+    assert index.resolve("plain").full_url == "http://example.com/plain"
+    with pytest.raises(ValueError):
+        MappedIndex(index.path)
@@ -0,0 +1,209 @@
+import bisect
+import datetime
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from sqlalchemy import and_, select
+
+from archive import live_clause
+from cache import GONE, ResolvedURL, is_expired
+from models import URL
+
+# file header: magic, format version, code width, entry count
+MAGIC = b"SHIX"
+VERSION = 3
+HEADER = struct.Struct("<4sBBxxQ")
+
+# the widest short code, codes are NUL padded to this width
+CODE_WIDTH = 16
+
+# per entry after the padded code: id, offset and length of the full url
+# in the string blob that follows the entries, then the redirect policy:
+# status, max-age and the length of the Vary value stored after the url,
+# and the expiry: seconds since the epoch, the click cap and the clicks
+# counted when the index was built
+ENTRY = struct.Struct("<qQIHiHqqq")
+
+# policy and expiry columns left NULL, for the config defaults and no expiry
+NULL_STATUS = 0
+NULL_MAX_AGE = -1
+NULL_EXPIRES_AT = -1
+NULL_MAX_CLICKS = -1
+
+
+class _Codes(object):
+    """
+    The sorted code column of a mapped index as a sequence, for bisect
+    """
+    def __init__(self, buffer, width, count):
+        self.buffer = buffer
+        self.width = width
+        self.stride = width + ENTRY.size
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = HEADER.size + i * self.stride
+        return self.buffer[start:start + self.width]
+
+
+def build_index(shards, path, batch_size=10000):
+    """
+    Write every live short code of every shard, sorted, with its full URL
+    to an index file.  The file is built beside path and swapped in with a
+    rename so readers never see a partial index.  Expiry times are kept
+    and checked on lookup; a link that reaches its click cap after the
+    build is served until the next one.
+    :return number of entries written
+    """
+    query = select([
+        URL.short_url, URL.id, URL.full_url, URL.redirect_status, URL.cache_max_age, URL.redirect_vary,
+        URL.expires_at, URL.max_clicks, URL.clicks
+    ]).where(and_(
+        URL.short_url.isnot(None),
+        URL.archived.isnot(True),
+        URL.is_url_active.isnot(False),
+        live_clause(datetime.datetime.now())
+    ))
+    directory = os.path.dirname(os.path.abspath(path))
+    entries = []
+    blob_size = 0
+    with tempfile.TemporaryFile(dir=directory) as blob, \
+            tempfile.NamedTemporaryFile(dir=directory, prefix=".urlindex-", delete=False) as out:
+        try:
+            for shard in shards:
+                with shard.read_engine.connect() as conn:
+                    result = conn.execution_options(stream_results=True).execute(query)
+                    while True:
+                        rows = result.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        for short_url, id, full_url, status, max_age, vary, expires_at, max_clicks, clicks in rows:
+                            target = (full_url or "").encode("utf-8")
+                            vary = (vary or "").encode("latin-1")
+                            entries.append(short_url.encode("ascii").ljust(CODE_WIDTH, b"\0") + ENTRY.pack(
+                                id,
+                                blob_size,
+                                len(target),
+                                status or NULL_STATUS,
+                                NULL_MAX_AGE if max_age is None else max_age,
+                                len(vary),
+                                NULL_EXPIRES_AT if expires_at is None else int(expires_at.timestamp()),
+                                NULL_MAX_CLICKS if max_clicks is None else max_clicks,
+                                clicks or 0
+                            ))
+                            blob.write(target + vary)
+                            blob_size += len(target) + len(vary)
+            # sorted here, database collations need not agree with byte order
+            entries.sort()
+            out.write(HEADER.pack(MAGIC, VERSION, CODE_WIDTH, len(entries)))
+            out.write(b"".join(entries))
+            blob.seek(0)
+            while True:
+                data = blob.read(1 << 20)
+                if not data:
+                    break
+                out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        except BaseException:
+            os.unlink(out.name)
+            raise
+    os.chmod(out.name, 0o644)
+    os.replace(out.name, path)
+    return len(entries)
+
+
+class MappedIndex(object):
+    """
+    A read-only short code lookup over a memory-mapped index file.  Each
+    worker maps the same file, so its pages are shared between processes
+    and memory does not grow with the number of workers.  The file is
+    checked for replacement at most every check_interval seconds.
+    """
+    def __init__(self, path, check_interval=30):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._identity = None
+        self._state = None
+        self.reload()
+
+    def __len__(self):
+        return self._state[1].count
+
+    def reload(self):
+        """
+        Map the current index file if it has been replaced
+        :return bool, whether a new file was mapped
+        """
+        stat = os.stat(self.path)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self._identity:
+            return False
+        with open(self.path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, width, count = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            buffer.close()
+            raise ValueError("{} is not a shorty URL index".format(self.path))
+        codes = _Codes(buffer, width, count)
+        blob_start = HEADER.size + count * codes.stride
+        # readers holding the previous mapping keep it alive until they finish
+        self._state = (buffer, codes, blob_start)
+        self._identity = identity
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            try:
+                self.reload()
+            except (OSError, ValueError):
+                # keep serving the mapped index until a good file appears
+                pass
+
+    def resolve(self, short_url):
+        """
+        Binary search for a short code
+        :return ResolvedURL, GONE or None
+        """
+        self._maybe_reload()
+        buffer, codes, blob_start = self._state
+        try:
+            key = short_url.encode("ascii").ljust(codes.width, b"\0")
+        except UnicodeEncodeError:
+            return None
+        if len(key) != codes.width:
+            return None
+        i = bisect.bisect_left(codes, key)
+        if i == codes.count or codes[i] != key:
+            return None
+        id, offset, length, status, max_age, vary_length, expires_at, max_clicks, clicks = ENTRY.unpack_from(
+            buffer, HEADER.size + i * codes.stride + codes.width)
+        start = blob_start + offset
+        vary = buffer[start + length:start + length + vary_length].decode("latin-1")
+        url = ResolvedURL(
+            id,
+            short_url,
+            buffer[start:start + length].decode("utf-8"),
+            status or None,
+            None if max_age == NULL_MAX_AGE else max_age,
+            vary or None,
+            None if expires_at == NULL_EXPIRES_AT else expires_at,
+            None if max_clicks == NULL_MAX_CLICKS else max_clicks,
+            clicks
+        )
+        return GONE if is_expired(url) else url
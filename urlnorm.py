@@ -0,0 +1,63 @@
+import datetime
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from archive import live_clause
+from models import URL
+
+DEFAULT_PORTS = {
+    "http": 80,
+    "https": 443
+}
+
+
+def normalize_url(url):
+    """
+    Reduce a URL to a canonical form so equivalent submissions compare
+    equal: lowercase scheme and host, no default port, an explicit root
+    path and sorted query parameters.  The fragment is kept, since it is
+    part of the stored URL and pages can route on it.
+    :return str
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = "{}:{}".format(host, parts.port)
+    if parts.username:
+        userinfo = parts.username
+        if parts.password:
+            userinfo += ":" + parts.password
+        host = userinfo + "@" + host
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, parts.fragment))
+
+
+def url_fingerprint(url):
+    """
+    :return hex sha256 of the normalized URL
+    """
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+
+def find_duplicates(shards, user_id, fingerprints):
+    """
+    Look up a user's live short URLs by normalized URL fingerprint, on
+    every shard since a URL's code, not the URL, decides its shard.  Only
+    links the resolver would still redirect are returned.
+    :return dict of fingerprint -> (id, short_url, full_hash)
+    """
+    now = datetime.datetime.now()
+    found = {}
+    fingerprints = list(set(fingerprints))
+    for shard, i in ((shard, i) for shard in shards for i in range(0, len(fingerprints), 500)):
+        rows = shard.session.query(URL.id, URL.short_url, URL.full_hash, URL.normalized_hash).filter(
+            URL.user_id == user_id,
+            URL.normalized_hash.in_(fingerprints[i:i + 500]),
+            URL.archived.isnot(True),
+            URL.is_url_active.isnot(False),
+            live_clause(now)
+        ).order_by(URL.id)
+        for row in rows:
+            found.setdefault(row.normalized_hash, row)
+    return found
@@ -0,0 +1,669 @@
+"""
+The dashboard, the JSON APIs and the management commands, added to the
+apps of the admin profile by init_app
+"""
+from flask import current_app, redirect, request, Response, render_template, url_for, flash, g, jsonify, stream_with_context
+from flask.cli import with_appcontext
+from flask_session import Session
+from flask_login import LoginManager, login_required, login_user, logout_user, current_user
+from flask_sqlalchemy import Pagination
+from sqlalchemy import exc
+from database import db_session
+from archive import archiver
+from cache import forget_urls, redis_store, resolver, url_count
+from redirector import REDIRECT_STATUSES
+from bulk import bulk_shorten, clean_expiry, clean_url, read_ndjson
+from codes import code_generator
+from snapshot import SnapshotTable, import_rows, open_snapshot, read_snapshot, write_snapshot
+from urlindex import build_index
+from bloom import short_url_filter
+from urlnorm import find_duplicates, url_fingerprint
+from listing import parse_cursor, url_page
+from leaderboard import leaderboard
+from ratelimit import limiter
+from analytics import click_analytics
+from shards import rebalance, shard_router
+import metrics
+from models import User, URL
+from forms import URLForm
+from urllib.parse import urlparse
+import click
+import config
+import datetime
+import functools
+import hashlib
+import time
+import redis
+import re
+import uuid
+import json
+
+# define our login_manager
+login_manager = LoginManager()
+login_manager.login_view = "/auth/login"
+login_manager.login_message = "Login required to access this site."
+login_manager.login_message_category = "primary"
+
+# views and commands are collected here and added to each app by init_app,
+# under the same endpoint names as when they were declared on the app
+routes = []
+commands = []
+
+
+def route(rule, **options):
+    def decorator(view):
+        routes.append((rule, view, options))
+        return view
+    return decorator
+
+
+def command(name):
+    def decorator(callback):
+        cli_command = click.command(name)(with_appcontext(callback))
+        commands.append(cli_command)
+        return cli_command
+    return decorator
+
+
+def api_user():
+    """
+    The user an API request acts for: the logged in user, or the owner of
+    a known X-Api-Key
+    :return user id or None
+    """
+    if current_user.is_authenticated:
+        return int(current_user.get_id())
+    return config.API_KEYS.get(request.headers.get("X-Api-Key", ""))
+
+
+def api_login_required(view):
+    """
+    Answer API requests from unknown callers with a JSON 401, and give the
+    view the caller's user id in g.api_user
+    """
+    @functools.wraps(view)
+    def decorated(*args, **kwargs):
+        g.api_user = api_user()
+        if g.api_user is None:
+            return jsonify(error="Login or a valid X-Api-Key required"), 401
+        return view(*args, **kwargs)
+    return decorated
+
+
+def api_admin_required(view):
+    """
+    As api_login_required, for callers in ADMIN_USER_IDS only
+    """
+    @api_login_required
+    @functools.wraps(view)
+    def decorated(*args, **kwargs):
+        if g.api_user not in config.ADMIN_USER_IDS:
+            return jsonify(error="Forbidden"), 403
+        return view(*args, **kwargs)
+    return decorated
+
+
+# load the user
+@login_manager.user_loader
+def load_user(id):
+    try:
+        current_app.logger.debug("Querying for User: %s", id)
+        return db_session.query(User).get(int(id))
+    except exc.SQLAlchemyError as err:
+        current_app.logger.warning("Could not load User: %s error: %s", id, err)
+        return None
+
+
+# run before each request
+def load_current_user():
+    g.user = current_user
+
+
+# default routes
+@route("/", methods=["GET", "POST"])
+# @route("/index", methods=["GET", "POST"])
+def index():
+    """
+    The default view
+    :return: databoxes
+    """
+    form = URLForm()
+    context = None
+    urls = None
+    pagination = None
+    top_links = None
+    next_cursor = prev_cursor = None
+    if request.method == "GET":
+        page = request.args.get("page", 1, type=int)
+        with metrics.stage("index_page"):
+            urls, next_cursor, prev_cursor = url_page(
+                shard_router,
+                config.DASHBOARD_PAGE_SIZE,
+                after=parse_cursor(request.args.get("after")),
+                before=parse_cursor(request.args.get("before"))
+            )
+        with metrics.stage("index_count"):
+            total = url_count.get()
+        pagination = Pagination(None, max(page, 1), config.DASHBOARD_PAGE_SIZE, total, urls)
+        with metrics.stage("index_top_links"):
+            top_links = leaderboard.top("day", config.LEADERBOARD_SIZE)
+    if request.method == "POST":
+        if "fetch-url" in request.form.keys(): # and form.validate_on_submit():
+            url = form.url.data
+            try:
+                p = parse_url(url)
+                if isinstance(p, tuple):
+                    scheme, netloc, path, params, query = p[0], p[1], p[2], p[3], p[4]
+                    # set the url scheme
+                    if scheme != "" and netloc != "":
+                        if scheme.startswith("https"):
+                            scheme = "https://"
+                        else:
+                            scheme = "http://"
+                    
+                        # rebuild the url string from the components
+                        req_url = scheme + netloc + path + ("?" + query if query else "")
+                        # set the request headers to encode
+                        headers = {}
+                        headers["content-type"] = request.headers["Content-Type"]
+                        headers["content-length"] = request.headers["Content-Length"]
+                        headers["host"] = request.headers["host"]
+                        headers["accept-encoding"] = request.headers["Accept-Encoding"]
+                        headers["accept"] = request.headers["Accept"]
+                        headers["timestamp"] = datetime.datetime.now()
+                        headers_hash = hashlib.sha256(str(headers).encode()).hexdigest()
+
+                        try:
+                            encoded = str(headers["timestamp"]).encode() + req_url.encode()
+                            url_hash = hashlib.sha256(encoded).hexdigest()
+                            fingerprint = url_fingerprint(req_url)
+
+                            try:
+                                existing = None
+                                if config.DEDUP_URLS:
+                                    existing = find_duplicates(shard_router, 1, [fingerprint]).get(fingerprint)
+                                if existing is not None:
+                                    # hand back the code this URL already has
+                                    new_url_id = existing.id
+                                    short_hash = existing.short_url
+                                    url_hash = existing.full_hash
+                                    current_app.logger.info("Reusing URL ID: %s for a duplicate submission", new_url_id)
+                                else:
+                                    # a code can already be taken when the counter was
+                                    # lost with redis, so retry with a fresh one
+                                    for attempt in range(config.CODE_RETRIES + 1):
+                                        short_hash = code_generator.next()
+                                        # create a new short url, the page title and
+                                        # link status are filled in by a background task
+                                        new_url = URL(
+                                            user_id=1,
+                                            name=None,
+                                            full_url=str(req_url),
+                                            short_url=short_hash,
+                                            full_hash=url_hash,
+                                            normalized_hash=fingerprint,
+                                            raw_request_headers=headers_hash,
+                                            request_headers_hash=headers_hash,
+                                            global_id=str(uuid.uuid4()),
+                                            created_on_date=datetime.datetime.now(),
+                                            modified_date=datetime.datetime.now(),
+                                            clicks=0,
+                                            archived=False,
+                                            is_url_active=True,
+                                            expires_at=clean_expiry({}, datetime.datetime.now())[0]
+                                        )
+                                        # add the url to the table
+                                        short_url_filter.add_many([short_hash])
+                                        session = shard_router.session_for(short_hash)
+                                        session.add(new_url)
+                                        try:
+                                            session.commit()
+                                            break
+                                        except exc.IntegrityError:
+                                            session.rollback()
+                                            if attempt == config.CODE_RETRIES:
+                                                raise
+                                            current_app.logger.warning("Short code %s is taken, retrying", short_hash)
+                                    new_url_id = new_url.id
+                                    url_count.incr()
+                                    # log the transaction
+                                    current_app.logger.info("Wrote new URL %s to database as ID: %s", short_hash, new_url_id)
+                                    check_url(short_hash)
+                                flash("Success.  Created Shorty URL: {} using hash: {}".format(str(new_url_id), str(url_hash)),
+                                    category="info")
+                                context = {
+                                    "id": new_url_id,
+                                    "full_url": url,
+                                    "full_hash": url_hash,
+                                    "short_hash": short_hash,
+                                    "clicks": 0,
+                                    "active": True,
+                                    "headers": headers,
+                                    "hdr_hash": headers_hash,
+                                    "title": None,
+                                    "url": {
+                                        "scheme": scheme,
+                                        "netloc": netloc,
+                                        "path": path or None,
+                                        "query": query or None
+                                    }
+                                }
+
+                            except exc.SQLAlchemyError as db_err:
+                                shard_router.rollback()
+                                current_app.logger.warning("SQLAlchemy Error: %s", db_err)
+                                flash("A database error: {}".format(str(db_err)), category="danger")
+                                return redirect(url_for("index"))
+
+                        except ValueError as err:
+                            flash("Value Error: {}".format(str(err)), category="danger")
+                            current_app.logger.info("Can not encode the input URL string.")
+                            return redirect(url_for("index"))
+                    else:
+                        # the URL in not valid format
+                        msg = "Invalid URL format, please try again..."
+                        flash("{}".format(str(msg)), category="danger")
+                        current_app.logger.info("Invalid URL format entered.")
+                        return redirect(url_for("index"))
+
+            except (ValueError, TypeError) as parse_error:
+                flash("{}".format(str(parse_error)), category="danger")
+                current_app.logger.info("URL Parse Error: %s", parse_error)
+                return redirect(url_for("index"))
+
+    with metrics.stage("index_render"):
+        return render_template(
+            "index.html",
+            today=get_date(),
+            form=form,
+            context=context,
+            urls=urls,
+            pagination=pagination,
+            top_links=top_links,
+            next_cursor=next_cursor,
+            prev_cursor=prev_cursor
+        )
+
+
+def check_url(short_url):
+    """
+    Queue the background fetch of a new URL's title and status
+    """
+    # celery is only loaded once a link is created
+    from celery_app import celery
+    try:
+        celery.send_task("tasks.fetch_url_title", args=[short_url])
+    except Exception as err:
+        current_app.logger.warning("Could not queue URL check for %s error: %s", short_url, err)
+
+
+@route("/api/urls/bulk", methods=["POST"])
+@api_login_required
+def bulk_create_urls():
+    """
+    Shorten many URLs at once for the caller.  Accepts a JSON array, or
+    NDJSON with one URL or {"url": ...} object per line which is read as it
+    streams in.  Pass dedupe=1 to reuse the codes of URLs the caller has
+    already shortened.
+    :return NDJSON stream of short codes and per item errors
+    """
+    dedupe = request.args.get("dedupe", config.DEDUP_URLS, type=lambda v: v.lower() in ("1", "true", "yes"))
+    if request.mimetype == "application/json":
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            return jsonify(error="Expected a JSON array of URLs"), 400
+    else:
+        items = read_ndjson(request.stream)
+    user_id = g.api_user
+
+    def generate():
+        for result in bulk_shorten(shard_router, items, user_id=user_id, dedupe=dedupe):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@route("/api/urls/<short_url>", methods=["PATCH"])
+@api_login_required
+def update_url(short_url):
+    """
+    Change a link's target, name or archived flag, its expiry: expires_at
+    in seconds since the epoch and max_clicks, null for none, or its
+    redirect policy: redirect_status, cache_max_age and redirect_vary, null
+    for the defaults.  Cached copies of the redirect are invalidated and
+    purged on commit.  Archived and expired links are moved to the archive
+    by the archive-links task, after which they can no longer be changed.
+    Only the link's owner may change it.
+    :return json
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="Expected a JSON object"), 400
+    try:
+        changes = clean_changes(data)
+    except ValueError as err:
+        return jsonify(error=str(err)), 400
+    session = shard_router.session_for(short_url)
+    url = session.query(URL).filter(URL.short_url == short_url).first()
+    if url is None:
+        return jsonify(error="Not Found"), 404
+    if url.user_id != g.api_user:
+        return jsonify(error="Forbidden"), 403
+    for name, value in changes.items():
+        setattr(url, name, value)
+    url.modified_date = datetime.datetime.now()
+    try:
+        session.commit()
+    except exc.SQLAlchemyError as db_err:
+        session.rollback()
+        current_app.logger.warning("SQLAlchemy Error: %s", db_err)
+        return jsonify(error="Could not update the URL"), 500
+    return jsonify(
+        short_url=url.short_url,
+        full_url=url.full_url,
+        name=url.name,
+        archived=url.archived,
+        redirect_status=url.redirect_status,
+        cache_max_age=url.cache_max_age,
+        redirect_vary=url.redirect_vary,
+        expires_at=None if url.expires_at is None else int(url.expires_at.timestamp()),
+        max_clicks=url.max_clicks
+    )
+
+
+@route("/api/top", methods=["GET"])
+def top_urls():
+    """
+    The most clicked links over a window of hour, day, week or all
+    :return json
+    """
+    window = request.args.get("window", "all")
+    limit = min(request.args.get("limit", 100, type=int), 1000)
+    try:
+        links = leaderboard.top(window, limit)
+    except ValueError as err:
+        return jsonify(error=str(err)), 400
+    return jsonify(window=window, links=links)
+
+
+@route("/api/ratelimits", methods=["GET"])
+@api_admin_required
+def rate_limits():
+    """
+    The configured rate limits and, per rule, the keys denied most often
+    :return json
+    """
+    limit = min(request.args.get("limit", 50, type=int), 1000)
+    rules = {}
+    for rule, (rate, burst) in config.RATE_LIMITS.items():
+        try:
+            denied = limiter.top_denied(rule, limit)
+        except redis.exceptions.RedisError as err:
+            return jsonify(error="Rate limit counters unavailable: {}".format(str(err))), 503
+        rules[rule] = {"rate": rate, "burst": burst, "denied": denied}
+    return jsonify(rules=rules)
+
+
+@route("/api/analytics", methods=["GET", "POST"])
+def url_analytics():
+    """
+    Clicks over time for one or more short codes, between start and end
+    epoch seconds, at minute, hour or day resolution.  GET takes them as
+    query arguments with comma separated codes; POST takes a JSON object
+    with a list of codes, for more than fit in a request line.
+    :return json
+    """
+    if request.method == "POST":
+        params = request.get_json(silent=True)
+        if not isinstance(params, dict) or not isinstance(params.get("codes"), list):
+            return jsonify(error="Expected a JSON object with a list of codes"), 400
+        codes = [code for code in params["codes"] if isinstance(code, str) and code]
+    else:
+        params = request.args
+        codes = [code for code in params.get("codes", "").split(",") if code]
+    if not codes or len(codes) > config.ANALYTICS_MAX_CODES:
+        return jsonify(error="Expected 1 to {} short codes".format(config.ANALYTICS_MAX_CODES)), 400
+    try:
+        end = int(params.get("end", time.time()))
+        start = int(params.get("start", end - 86400))
+    except (TypeError, ValueError):
+        return jsonify(error="start and end must be epoch seconds"), 400
+    try:
+        resolution, series = click_analytics.series(codes, start, end, params.get("resolution"))
+    except ValueError as err:
+        return jsonify(error=str(err)), 400
+    return jsonify(start=start, end=end, resolution=resolution, series=series)
+
+
+@route("/auth/login", methods=["GET", "POST"])
+def login():
+    """
+    Login user page
+    """
+    return render_template(
+        "login.html", 
+        today=get_date()
+    )
+
+
+@route('/logout', methods=["GET"])
+def logout():
+    logout_user()
+    return redirect(url_for("login"))
+
+
+@command("rebuild-leaderboard")
+def rebuild_leaderboard():
+    """Reload the all-time leaderboard from the urls table."""
+    loaded = leaderboard.rebuild()
+    current_app.logger.info("Ranked %s links on the leaderboard.", loaded)
+
+
+@command("rebuild-bloom")
+def rebuild_bloom():
+    """Rebuild the short code bloom filter from the urls table."""
+    loaded = short_url_filter.rebuild()
+    current_app.logger.info("Loaded %s short codes into the bloom filter.", loaded)
+
+
+@command("export-snapshot")
+@click.argument("path")
+def export_snapshot(path):
+    """Write the urls table to a binary snapshot, gzipped if PATH ends in .gz."""
+    with open_snapshot(path, "wb") as f:
+        written = write_snapshot(shard_router, f, code_generator.allocator.high_water())
+    current_app.logger.info("Exported %s URLs to %s.", written, path)
+
+
+@command("import-snapshot")
+@click.argument("path")
+def import_snapshot(path):
+    """Bulk load the urls of a snapshot, skipping rows that already exist."""
+    def prepare(short_urls):
+        # the filter must know a code before anyone can be handed it
+        short_url_filter.add_many(short_urls)
+        resolver.invalidate_many(short_urls)
+
+    with open_snapshot(path, "rb") as f:
+        counter, rows = read_snapshot(f)
+        inserted, skipped, failed = import_rows(shard_router, rows, config.SNAPSHOT_CHUNK_SIZE, on_chunk=prepare)
+    # codes generated here must not collide with the imported ones
+    code_generator.allocator.advance_to(counter)
+    url_count.incr(inserted)
+    current_app.logger.info("Imported %s URLs from %s, skipped %s existing, %s failed.",
+                            inserted, path, skipped, failed)
+
+
+@command("warm-cache")
+@click.argument("path")
+@click.option("--limit", type=int, default=None, help="Most links to load, hottest first.")
+def warm_cache(path, limit):
+    """Load the live links of an uncompressed snapshot into the shared redis cache."""
+    table = SnapshotTable(path)
+    try:
+        loaded = resolver.warm(table.resolved(limit), shared=True)
+    finally:
+        table.close()
+    current_app.logger.info("Loaded %s links from %s into the URL cache.", loaded, path)
+
+
+@command("build-url-index")
+@click.argument("path", required=False)
+def build_url_index(path):
+    """Write the memory-mapped short code index used by edge.py redirect nodes."""
+    path = path or config.URL_INDEX_PATH
+    if not path:
+        raise click.UsageError("Pass a PATH or set SHORTY_URL_INDEX")
+    written = build_index(shard_router, path)
+    current_app.logger.info("Indexed %s short codes in %s.", written, path)
+
+
+@command("rebalance-shards")
+@click.option("--batch-size", type=int, default=1000, help="Rows read from a shard at a time.")
+@click.option("--dry-run", is_flag=True, help="Only count the rows that would move.")
+def rebalance_shards(batch_size, dry_run):
+    """Move urls rows to the shard their short code maps to, after adding a shard."""
+    moved = rebalance(shard_router, batch_size, dry_run, on_moved=resolver.invalidate_many)
+    for (source, target), count in sorted(moved.items()):
+        current_app.logger.info("%s %s URLs from shard %s to shard %s.",
+                                "Would move" if dry_run else "Moved", count, source, target)
+    if not moved:
+        current_app.logger.info("Every URL is on its shard.")
+
+
+@command("archive-links")
+@click.option("--batch-size", type=int, default=config.ARCHIVE_BATCH_SIZE, help="Rows moved per transaction.")
+def archive_links(batch_size):
+    """Move expired and archived links to the archive database."""
+    moved = archiver.run(batch_size=batch_size, on_moved=forget_urls)
+    for shard, count in sorted(moved.items()):
+        current_app.logger.info("Archived %s URLs from shard %s.", count, shard)
+    if not moved:
+        current_app.logger.info("No URLs to archive.")
+
+
+def page_not_found(err):
+    return render_template("404.html"), 404
+
+
+def internal_server_error(err):
+    return render_template("500.html"), 500
+
+
+def flash_errors(form):
+    for field, errors in form.errors.items():
+        for error in errors:
+            flash(u"Error in the %s field - %s" % (
+                getattr(form, field).label.text,
+                error
+            ))
+
+
+def parse_url(url):
+    """
+    Parse the URL
+    :return tuple
+    """
+    try:
+        str(url)
+        parsed = urlparse(url)
+        # this returns a tuple of class 
+        # ParseResult(scheme='', netloc='', path='', params='', query='', fragment='')
+        return parsed
+    except ValueError as err:
+        return "{}".format(str(err))
+
+def clean_changes(data):
+    """
+    Validate the fields of a URL update
+    :return dict of column values
+    :raise ValueError
+    """
+    changes = {}
+    for name, value in data.items():
+        if name == "full_url":
+            changes["full_url"] = clean_url(value)
+            changes["normalized_hash"] = url_fingerprint(changes["full_url"])
+        elif name == "name":
+            if value is not None and (not isinstance(value, str) or len(value) > 500):
+                raise ValueError("name must be a string of at most 500 characters")
+            changes["name"] = value
+        elif name == "archived":
+            if not isinstance(value, bool):
+                raise ValueError("archived must be true or false")
+            changes["archived"] = value
+        elif name == "redirect_status":
+            if value is not None and value not in REDIRECT_STATUSES:
+                raise ValueError("redirect_status must be one of {}".format(", ".join(map(str, REDIRECT_STATUSES))))
+            changes["redirect_status"] = value
+        elif name == "cache_max_age":
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or not 0 <= value < 2 ** 31):
+                raise ValueError("cache_max_age must be a number of seconds")
+            changes["cache_max_age"] = value
+        elif name == "redirect_vary":
+            if value is not None and (not isinstance(value, str) or not re.match(r"^[A-Za-z0-9, -]{1,255}$", value)):
+                raise ValueError("redirect_vary must be a comma separated list of header names")
+            changes["redirect_vary"] = value
+        elif name == "expires_at":
+            if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+                raise ValueError("expires_at must be a number of seconds since the epoch")
+            try:
+                changes["expires_at"] = None if value is None else datetime.datetime.fromtimestamp(value)
+            except (OverflowError, OSError, ValueError):
+                raise ValueError("expires_at is out of range")
+        elif name == "max_clicks":
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or not 0 < value < 2 ** 31):
+                raise ValueError("max_clicks must be a positive whole number")
+            changes["max_clicks"] = value
+        else:
+            raise ValueError("Unknown field: {}".format(name))
+    return changes
+
+
+def get_date():
+    # set the current date time for each page
+    today = datetime.datetime.now().strftime("%c")
+    return "{}".format(today)
+
+
+def format_date(value):
+    dt = value
+    return dt.strftime("%Y-%m-%d %H:%M")
+
+
+def format_date_mdy(value):
+    dt = value
+    return dt.strftime("%m/%d/%Y")
+
+
+def format_number(value):
+    _val = int(value)
+    return "{:,}".format(_val)
+
+
+def format_phone_number(value):
+    phone_number = re.sub("[^0-9]", "", value)
+    return "{}-{}-{}".format(phone_number[:3], phone_number[3:6], phone_number[6:])
+
+
+def init_app(app):
+    """
+    Add the dashboard, APIs and commands to an app, with the server side
+    session, login and template filters they rely on
+    """
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis_store
+    app.config["SESSION_PERMANENT"] = True
+    Session().init_app(app)
+    login_manager.init_app(app)
+    app.before_request(load_current_user)
+    for rule, view, options in routes:
+        app.add_url_rule(rule, view.__name__, view, **options)
+    for cli_command in commands:
+        app.cli.add_command(cli_command)
+    app.register_error_handler(404, page_not_found)
+    app.register_error_handler(500, internal_server_error)
+    app.add_template_filter(format_date, "formatdate")
+    app.add_template_filter(format_date_mdy, "datemdy")
+    app.add_template_filter(format_number, "formatnumber")
+    app.add_template_filter(format_phone_number, "formatphonenumber")
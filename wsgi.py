@@ -8,7 +8,21 @@ import logging
 logging.basicConfig(stream=sys.stderr)
 sys.path.insert(0, "/Users/craigderington/Public/pyshorty")
 
-from app import app as application
-application.secret_key = os.urandom(64)
+from app import create_app
+from ratelimit import RateLimitMiddleware, limiter
+from redirector import Redirector, reserved_segments
+import config
+app = create_app(config.APP_PROFILE)
+app.secret_key = os.urandom(64)
 
+# over-limit clients are turned away first, then short code redirects are
+# answered before the Flask app is reached
+reserved = reserved_segments(app)
+application = RateLimitMiddleware(
+    Redirector(app, reserved),
+    limiter,
+    reserved,
+    proxy_hops=config.RATE_LIMIT_PROXY_HOPS,
+    api_keys=config.API_KEYS
+)
 